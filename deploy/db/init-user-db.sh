@@ -13,3 +13,7 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" <<-EOSQL
     GRANT ALL PRIVILEGES ON DATABASE $db_name TO $db_user;
     GRANT ALL PRIVILEGES on DATABASE $datasets_db to $db_user;
 EOSQL
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$datasets_db" <<-EOSQL
+    CREATE EXTENSION IF NOT EXISTS postgis;
+EOSQL
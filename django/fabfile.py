@@ -139,6 +139,8 @@ def setup_postgres():
     local("createuser %(db_user)s -e --createdb -U postgres" % env)
     for db in env.databases:
         local("createdb {0} -U {1}".format(db, env.db_user))
+        # spatial data files are loaded into PostGIS tables
+        local('psql {0} -U postgres -c "CREATE EXTENSION IF NOT EXISTS postgis"'.format(db))
 
 
 @task(aliases=['idb', 'initdb'])
@@ -4,5 +4,5 @@ from . import models
 
 for model_class in (models.Project, models.DataTableGroup, models.MiracleUser, models.Author, models.DataAnalysisScript,
                     models.DataColumn, models.ActivityLog, models.AnalysisOutput, models.AnalysisParameter,
-                    models.AnalysisOutputFile):
+                    models.AnalysisOutputFile, models.Blob):
     admin.site.register(model_class)
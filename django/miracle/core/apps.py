@@ -5,4 +5,4 @@ class MiracleCoreConfig(AppConfig):
     verbose_name = 'Miracle core services'
 
     def ready(self):
-        from .signals import create_project_group
+        from .signals import create_project_group, drop_datatablegroup_table
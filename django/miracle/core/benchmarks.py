@@ -0,0 +1,363 @@
+"""
+Benchmarks for the metadata pipeline
+
+Each benchmark is a function returning a dict of timings and is registered in BENCHMARKS so that it can be run with
+``./manage.py benchmark <name>``.
+"""
+
+import csv
+import dateutil.parser as date
+import os
+import random
+import resource
+import shutil
+import struct
+import tempfile
+import time
+from os import path
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from .ingest import MetadataDataFile, MetadataDataTableGroup, pipeline
+from .ingest.analyzer import ColumnTypeInference, TabularLoader
+from .ingest.loader import load_datatablegroups
+from .ingest.unarchiver import extract
+from .models import Project
+
+WGS84_PRJ = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],'
+             'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]]')
+
+
+def _generate_columns(rows, columns, seed):
+    rng = random.Random(seed)
+    generators = [
+        lambda i: str(rng.randint(-10 ** 6, 10 ** 6)),
+        lambda i: repr(rng.random() * 100),
+        lambda i: rng.choice(('true', 'false', '"t"', 'f')),
+        lambda i: rng.choice(('', 'NA', str(i))),
+        lambda i: str(i) if i < rows - 1 else '0.5',
+        lambda i: rng.choice(('forage', 'rest', 'move', 'trade')),
+        lambda i: '2016-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1),
+    ]
+    return [[generators[c % len(generators)](i) for i in xrange(rows)] for c in xrange(columns)]
+
+
+def _classify(values_by_column, chunk_size, update):
+    inferences = []
+    for values in values_by_column:
+        inference = ColumnTypeInference()
+        for start in xrange(0, len(values), chunk_size):
+            update(inference, values[start:start + chunk_size])
+        inferences.append(inference)
+    return [(inference.data_type, inference.statistics) for inference in inferences]
+
+
+def column_classification(rows=100000, columns=14, chunk_size=TabularLoader.CHUNK_SIZE, seed=0):
+    """
+    Compare classifying whole column chunks at once against checking every cell on its own
+    """
+    values_by_column = _generate_columns(rows, columns, seed)
+    timings = {}
+    results = {}
+    for name, update in (('per_cell', ColumnTypeInference.update_per_cell),
+                         ('batched', ColumnTypeInference.update)):
+        start = time.time()
+        results[name] = _classify(values_by_column, chunk_size, update)
+        timings[name] = time.time() - start
+    if results['per_cell'] != results['batched']:
+        raise AssertionError("batched column classification disagrees with the per cell path")
+    return {
+        'rows': rows,
+        'columns': columns,
+        'types': [data_type for data_type, statistics in results['batched']],
+        'per_cell_seconds': timings['per_cell'],
+        'batched_seconds': timings['batched'],
+        'speedup': timings['per_cell'] / max(timings['batched'], 1e-9),
+    }
+
+
+def date_detection(rows=100000, chunk_size=TabularLoader.CHUNK_SIZE, seed=0):
+    """
+    Compare detecting a date column by parsing every value with dateutil against checking the column's learned format
+    """
+    rng = random.Random(seed)
+    values = ['{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(rng.randint(1900, 2100), rng.randint(1, 12),
+                                                                  rng.randint(1, 28), rng.randint(0, 23),
+                                                                  rng.randint(0, 59), rng.randint(0, 59))
+              for _ in xrange(rows)]
+    start = time.time()
+    for value in values:
+        date.parse(value)
+    dateutil_seconds = time.time() - start
+
+    start = time.time()
+    inference = ColumnTypeInference()
+    for i in xrange(0, rows, chunk_size):
+        inference.update(values[i:i + chunk_size])
+    learned_seconds = time.time() - start
+    if inference.data_type != 'date':
+        raise AssertionError("date column detected as {}".format(inference.data_type))
+    return {
+        'rows': rows,
+        'date_format': inference.date_format,
+        'dateutil_seconds': dateutil_seconds,
+        'learned_format_seconds': learned_seconds,
+        'speedup': dateutil_seconds / max(learned_seconds, 1e-9),
+    }
+
+
+class _Rollback(Exception):
+    pass
+
+
+def datafile_loading(files=10000, groups=10, columns=5):
+    """
+    Load the metadata of an archive with many DataFiles into the database, in a transaction that is rolled back
+    """
+    metadata_datatablegroups = []
+    for g in xrange(groups):
+        group_columns = tuple(('g{}_c{}'.format(g, c), 'bigint') for c in xrange(columns))
+        statistics = [{'values': 100, 'empty': 1, 'null': 0, 'date_format': None} for _ in group_columns]
+        datafiles = [MetadataDataFile(name='file {}'.format(f), path='data/{}/file{}.csv'.format(g, f),
+                                      column_statistics=statistics, columns=group_columns)
+                     for f in xrange(g, files, groups)]
+        metadata_datatablegroups.append(MetadataDataTableGroup(name='data', properties=group_columns,
+                                                               datafiles=datafiles))
+    try:
+        with transaction.atomic():
+            creator = User.objects.create(username='benchmark-{}'.format(time.time()))
+            project = Project.objects.create(name='benchmark', creator=creator)
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                load_datatablegroups(metadata_datatablegroups, project)
+                seconds = time.time() - start
+            raise _Rollback
+    except _Rollback:
+        pass
+    return {
+        'files': files,
+        'groups': groups,
+        'seconds': seconds,
+        'files_per_second': files / max(seconds, 1e-9),
+        'queries': len(queries),
+    }
+
+
+def generate_project(folder, token, data_files=10, rows=1000, columns=8, netlogo_files=2, shapefiles=2,
+                     features=100, rasters=2, raster_size=256, scripts=2, seed=0):
+    """
+    Write a synthetic project with the layout unarchiver expects: a packrat folder and a project folder named after
+    the token with src and data folders
+
+    :return: the root folder of the project, to be archived
+    """
+    rng = random.Random(seed)
+    root = path.join(folder, token)
+    src = path.join(root, token, 'src')
+    data = path.join(root, token, 'data')
+    for directory in (path.join(root, 'packrat'), src, data):
+        os.makedirs(directory)
+    with open(path.join(root, 'packrat', 'packrat.lock'), 'w') as f:
+        f.write('PackratFormat: 1.4\nPackratVersion: 0.4.8.1\nRVersion: 3.3.1\n')
+    with open(path.join(root, token, 'README.md'), 'w') as f:
+        f.write('Synthetic benchmark project\n')
+    for i in xrange(scripts):
+        with open(path.join(src, 'analysis{}.R'.format(i)), 'w') as f:
+            f.write('# @param n integer\nn <- 10\nsummary(rnorm(n))\n')
+    for i in xrange(data_files):
+        # files share a schema in pairs so that group_metadata has something to group
+        _write_csv(path.join(data, 'table{}.csv'.format(i)), rows, columns, i // 2, rng)
+    for i in xrange(netlogo_files):
+        _write_netlogo_csv(path.join(data, 'experiment{}.csv'.format(i)), rows, rng)
+    for i in xrange(shapefiles):
+        _write_shapefile(path.join(data, 'sites{}'.format(i)), features, rng)
+    for i in xrange(rasters):
+        _write_ascii_grid(path.join(data, 'elevation{}.asc'.format(i)), raster_size, rng)
+    return root
+
+
+def generate_archive(folder, token, **kwargs):
+    """
+    Write a synthetic project archive, see generate_project for the parameters
+
+    :return: the path of the zip archive
+    """
+    root = generate_project(folder, token, **kwargs)
+    try:
+        return shutil.make_archive(root, 'zip', root_dir=folder, base_dir=token)
+    finally:
+        shutil.rmtree(root)
+
+
+def _column_values(column, schema, rng):
+    kind = (column + schema) % 5
+    if kind == 0:
+        return lambda i: str(i)
+    if kind == 1:
+        return lambda i: repr(rng.random() * 100)
+    if kind == 2:
+        return lambda i: rng.choice(('true', 'false'))
+    if kind == 3:
+        return lambda i: rng.choice(('forage', 'rest', 'move', 'trade', ''))
+    return lambda i: '2016-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1)
+
+
+def _write_csv(file_path, rows, columns, schema, rng):
+    values = [_column_values(c, schema, rng) for c in xrange(columns)]
+    with open(file_path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(['s{}_column{}'.format(schema, c) for c in xrange(columns)])
+        for i in xrange(rows):
+            writer.writerow([value(i) for value in values])
+
+
+def _write_netlogo_csv(file_path, rows, rng):
+    with open(file_path, 'wb') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(['BehaviorSpace results (NetLogo 5.0)'])
+        writer.writerow(['benchmark.nlogo'])
+        writer.writerow(['experiment'])
+        writer.writerow(['01/02/2016 10:00:00:000 -0700'])
+        writer.writerow(['min-pxcor', 'max-pxcor', 'min-pycor', 'max-pycor'])
+        writer.writerow(['-16', '16', '-16', '16'])
+        writer.writerow(['[run number]', 'population', 'growth-rate', '[step]', 'count turtles', 'mean energy'])
+        for i in xrange(rows):
+            writer.writerow([i // 10 + 1, rng.choice((50, 100, 200)), rng.choice((0.1, 0.5)), i % 10,
+                             rng.randint(0, 500), repr(rng.random() * 10)])
+
+
+def _write_shapefile(base_path, features, rng):
+    """
+    Write a point shapefile (.shp, .shx, .dbf and .prj) with an integer, a decimal and a text attribute
+    """
+    points = [(rng.uniform(-180, 180), rng.uniform(-90, 90)) for _ in xrange(features)]
+    xs = [x for x, y in points] or [0]
+    ys = [y for x, y in points] or [0]
+    bbox = (min(xs), min(ys), max(xs), max(ys))
+    record_size = 28
+
+    def header(file_length):
+        return (struct.pack('>7i', 9994, 0, 0, 0, 0, 0, file_length // 2) +
+                struct.pack('<2i4d4d', 1000, 1, *(bbox + (0, 0, 0, 0))))
+
+    with open(base_path + '.shp', 'wb') as f:
+        f.write(header(100 + record_size * features))
+        for i, (x, y) in enumerate(points):
+            f.write(struct.pack('>2i', i + 1, 10) + struct.pack('<i2d', 1, x, y))
+    with open(base_path + '.shx', 'wb') as f:
+        f.write(header(100 + 8 * features))
+        for i in xrange(features):
+            f.write(struct.pack('>2i', (100 + record_size * i) // 2, 10))
+
+    fields = (('ID', 'N', 10, 0), ('VALUE', 'N', 18, 6), ('NAME', 'C', 20, 0))
+    with open(base_path + '.dbf', 'wb') as f:
+        f.write(struct.pack('<4BIHH20x', 3, 116, 1, 1, features, 33 + 32 * len(fields),
+                            1 + sum(length for name, kind, length, decimals in fields)))
+        for name, kind, length, decimals in fields:
+            f.write(struct.pack('<11sc4xBB14x', name, kind, length, decimals))
+        f.write('\r')
+        for i in xrange(features):
+            f.write(' ' + str(i).rjust(10) + '{:.6f}'.format(rng.random() * 1000).rjust(18) +
+                    'site {}'.format(i).ljust(20))
+        f.write('\x1a')
+    with open(base_path + '.prj', 'w') as f:
+        f.write(WGS84_PRJ)
+
+
+def _write_ascii_grid(file_path, size, rng):
+    with open(file_path, 'w') as f:
+        f.write('ncols {0}\nnrows {0}\nxllcorner 0.0\nyllcorner 0.0\ncellsize 1.0\nNODATA_value -9999\n'.format(size))
+        for _ in xrange(size):
+            f.write(' '.join(str(rng.randint(0, 1000)) for _ in xrange(size)))
+            f.write('\n')
+
+
+def _peak_rss_kb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss
+
+
+def pipeline_stages(data_files=10, rows=1000, columns=8, netlogo_files=2, shapefiles=2, features=100, rasters=2,
+                    raster_size=256, scripts=2, seed=0):
+    """
+    Time the extract, group_files, group_metadata and load_project stages of pipeline.run on a synthetic archive, in
+    temporary project folders and a transaction that is rolled back
+
+    Peak memory is the high water mark of the process (and of the file analysis worker processes) after each stage,
+    so it only grows from one stage to the next.
+    """
+    folder = tempfile.mkdtemp(prefix='miracle-benchmark-')
+    projects_folder = path.join(folder, 'projects')
+    packrat_folder = path.join(folder, 'packrat')
+    os.makedirs(projects_folder)
+    os.makedirs(packrat_folder)
+    results = {'data_files': data_files, 'rows': rows, 'columns': columns, 'shapefiles': shapefiles,
+               'rasters': rasters}
+    try:
+        with override_settings(PROJECT_DIRECTORY=projects_folder, PACKRAT_DIRECTORY=packrat_folder,
+                               BLOB_DIRECTORY=path.join(projects_folder, '.blobs')):
+            try:
+                with transaction.atomic():
+                    creator = User.objects.create(username='benchmark-{}'.format(time.time()))
+                    project = Project.objects.create(name='benchmark', creator=creator)
+                    archive = generate_archive(folder, project.slug, data_files=data_files, rows=rows,
+                                               columns=columns, netlogo_files=netlogo_files, shapefiles=shapefiles,
+                                               features=features, rasters=rasters, raster_size=raster_size,
+                                               scripts=scripts, seed=seed)
+                    results['archive_bytes'] = path.getsize(archive)
+                    _time_stages(project, archive, results)
+                    raise _Rollback
+            except _Rollback:
+                pass
+    finally:
+        shutil.rmtree(folder)
+    return results
+
+
+def _time_stages(project, archive, results):
+    output = archive
+    total = 0
+    for stage in pipeline.STAGES[:pipeline.STAGES.index('load_project') + 1]:
+        start = time.time()
+        if stage == pipeline.STAGES[0]:
+            output = extract(project, archive)
+            results['files'] = len(output.paths)
+        else:
+            output = pipeline.STAGE_FUNCTIONS[stage](output)
+        seconds = time.time() - start
+        total += seconds
+        results[stage + '_seconds'] = seconds
+        results[stage + '_peak_rss_kb'] = _peak_rss_kb()
+        results[stage + '_children_peak_rss_kb'] = _peak_rss_kb(resource.RUSAGE_CHILDREN)
+    results['total_seconds'] = total
+
+
+def is_cost(name):
+    """
+    :return: whether a result is a duration or memory size, where larger values are worse
+    """
+    return name == 'seconds' or name.endswith('_seconds') or name.endswith('_kb')
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare benchmark results against a baseline run of the same benchmark
+
+    :param tolerance: fraction by which a duration or memory size may exceed its baseline value
+    :return: dict of result name to (baseline value, value) for the results that regressed
+    """
+    regressions = {}
+    for name, value in results.items():
+        if is_cost(name) and name in baseline and value > baseline[name] * (1 + tolerance):
+            regressions[name] = (baseline[name], value)
+    return regressions
+
+
+BENCHMARKS = {
+    'column_classification': column_classification,
+    'datafile_loading': datafile_loading,
+    'date_detection': date_detection,
+    'pipeline_stages': pipeline_stages,
+}
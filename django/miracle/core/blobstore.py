@@ -0,0 +1,98 @@
+"""
+Content addressed store for extracted project files
+
+Every extracted project file is stored once under BLOB_DIRECTORY, named by the SHA-256 of its contents, and the project
+tree is built from hardlinks into the store. Identical files shipped by different projects (or by re-uploads of the same
+project) therefore share a single copy on disk. Blob reference counts are tracked by miracle.core.models.Blob.
+
+Since project files are hardlinks, they must never be modified in place.
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def new_hash():
+    return hashlib.sha256()
+
+
+def blob_path(digest):
+    return os.path.join(settings.BLOB_DIRECTORY, digest[:2], digest)
+
+
+def hash_file(file_path):
+    """
+    :return: the hex digest and size of the file contents
+    """
+    h = new_hash()
+    size = 0
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+            h.update(block)
+            size += len(block)
+    return h.hexdigest(), size
+
+
+def link(file_path, digest):
+    """
+    Store the file at file_path under digest and replace it with a hardlink to the stored blob
+
+    If the blob is already stored the file is simply swapped for a link to it. If the blob store is on a different
+    filesystem the file is copied into the store and left in place.
+    """
+    dest = blob_path(digest)
+    if not os.path.exists(dest):
+        _makedirs(os.path.dirname(dest))
+        try:
+            os.link(file_path, dest)
+            return
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                logger.warning("blob store %s is not on the same filesystem as %s, copying instead of linking",
+                               settings.BLOB_DIRECTORY, file_path)
+                shutil.copy2(file_path, dest)
+                return
+            # another ingest stored the same blob in the meantime, link to it instead
+            if e.errno != errno.EEXIST:
+                raise
+    _replace_with_link(dest, file_path)
+
+
+def remove(digest):
+    dest = blob_path(digest)
+    if os.path.exists(dest):
+        logger.debug("removing unreferenced blob %s", dest)
+        os.unlink(dest)
+
+
+def _replace_with_link(src, file_path):
+    # link to a temporary name first so that file_path is swapped for the link atomically
+    parent_dir = os.path.dirname(file_path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.blob-', dir=parent_dir)
+    os.close(fd)
+    os.unlink(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            return
+        raise
+    os.rename(tmp_path, file_path)
+
+
+def _makedirs(folder):
+    try:
+        os.makedirs(folder)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -1,15 +1,36 @@
 from django.conf import settings
 
+from collections import namedtuple
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+import errno
 import json
 import logging
 import os
 import requests
-import tempfile
 import time
 import re
 
 logger = logging.getLogger(__name__)
 
+ScriptUpload = namedtuple('ScriptUpload', [
+    'path',
+    'response',     # the last response received for the upload
+    'seconds',      # wall clock time spent on the upload, retries included
+    'attempts'
+])
+
+FileTransfer = namedtuple('FileTransfer', [
+    'result',       # the DeployR metadata of the file
+    'path',
+    'bytes',
+    'seconds'       # wall clock time spent on the download
+])
+
+# responses worth retrying an upload for, the server may succeed the next time
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
 DEFAULT_WORKING_DIRECTORY = getattr(settings, 'DEFAULT_WORKING_DIRECTORY_NAME', 'luxedemo')
 
 
@@ -40,10 +61,18 @@ def get_auth_tuple(user=None):
     return (settings.DEFAULT_DEPLOYR_USER, settings.DEFAULT_DEPLOYR_PASSWORD)
 
 
-def login(user=None):
+def login(user=None, pool_size=None):
     auth_tuple = get_auth_tuple(user)
     s = requests.Session()
-    r = s.post(login_url, data={'username': auth_tuple[0], 'password': auth_tuple[1], 'format': 'json'})
+    # keep enough connections alive for concurrent requests, see DeployrAPI.upload_scripts, query_jobs and
+    # Job.retrieve_files
+    if pool_size is None:
+        pool_size = settings.DEPLOYR_UPLOAD_CONCURRENCY
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    r = s.post(login_url, data={'username': auth_tuple[0], 'password': auth_tuple[1], 'format': 'json'},
+               timeout=settings.DEPLOYR_TIMEOUT)
     logger.debug("LOGIN response using auth tuple %s: %s", auth_tuple, r.text)
     response200orError(r)
     return s
@@ -53,6 +82,10 @@ class DeployrUnexpectedStatusCode(Exception):
     pass
 
 
+class DeployrJobTimeout(Exception):
+    pass
+
+
 class DeployrAPI(object):
     """
     Add projects and scripts to deployr
@@ -72,15 +105,61 @@ class DeployrAPI(object):
     @staticmethod
     def upload_script(script_path, project_name, session):
         base_script_path = os.path.basename(script_path)
-        response = session.post(upload_script_url,
-                                files={'file': open(script_path, 'rb')},
-                                data={'format': 'json',
-                                      'filename': base_script_path,
-                                      'directory': project_name
-                                      })
+        with open(script_path, 'rb') as script_file:
+            response = session.post(upload_script_url,
+                                    files={'file': script_file},
+                                    data={'format': 'json',
+                                          'filename': base_script_path,
+                                          'directory': project_name
+                                          },
+                                    timeout=settings.DEPLOYR_TIMEOUT)
         logger.debug("UPLOAD SCRIPT response: %s", response.text)
         return response
 
+    @staticmethod
+    def upload_scripts(script_paths, project_name, session, concurrency=None):
+        """
+        Upload scripts with up to concurrency uploads in flight over the session's pooled connections
+
+        Uploads that fail to connect, time out or get a 502, 503 or 504 response are retried with exponential backoff,
+        which is safe since uploading a script again overwrites it.
+
+        :return: a ScriptUpload for each of script_paths, in the same order
+        """
+        if concurrency is None:
+            concurrency = settings.DEPLOYR_UPLOAD_CONCURRENCY
+        concurrency = min(concurrency, len(script_paths))
+        upload = lambda script_path: DeployrAPI._upload_with_retries(script_path, project_name, session)
+        if concurrency <= 1:
+            return [upload(script_path) for script_path in script_paths]
+        pool = ThreadPool(concurrency)
+        try:
+            return pool.map(upload, script_paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def _upload_with_retries(script_path, project_name, session):
+        retries = settings.DEPLOYR_UPLOAD_RETRIES
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = DeployrAPI.upload_script(script_path, project_name, session)
+                if response.status_code not in RETRY_STATUS_CODES or attempt > retries:
+                    break
+                logger.warning("upload of %s failed with status %s", script_path, response.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt > retries:
+                    raise
+                logger.warning("upload of %s failed", script_path, exc_info=True)
+            time.sleep(settings.DEPLOYR_RETRY_BACKOFF * 2 ** (attempt - 1))
+        seconds = time.time() - start
+        logger.info("uploaded %s in %.3fs (%s attempts)", script_path, seconds, attempt)
+        return ScriptUpload(path=script_path, response=response, seconds=seconds, attempts=attempt)
+
     @staticmethod
     def run_job(script_path, project_name, parameters, session):
         job_name = '{0}.job'.format(project_name)
@@ -101,12 +180,17 @@ class DeployrAPI(object):
 
 
 class Job(object):
-    def __init__(self, session=None, user=None):
+    # statuses of jobs that will not run any further
+    FINISHED_STATUSES = ('Completed', 'Failed', 'Cancelled', 'Interrupted', 'Aborted')
+
+    def __init__(self, session=None, user=None, job_id=None):
         if session is None:
             if user is None:
                 raise ValueError("must provide an active session or user to login")
             session = login(user)
         self.session = session
+        if job_id is not None:
+            self.job_id = job_id
 
     def get(self, url, **kwargs):
         return self.session.get(url, **kwargs)
@@ -126,31 +210,28 @@ class Job(object):
         self.submit_successful = self.submit_response_json['deployr']['response']['success']
         return response
 
-    def check_status(self, retry=True, counter=0, limit=30, job_id=None):
+    def check_status(self, job_id=None):
+        """
+        Check once whether the job has completed and retrieve its results if it has. Callers wait for jobs by checking
+        again later, see miracle.core.tasks.check_analysis_job
+
+        :return: the results response of a completed job, None while the job is still running
+        """
         if job_id is None:
             job_id = getattr(self, 'job_id', None)
             if job_id is None:
                 raise ValueError("Submit a job first or pass a valid job id into this method")
 
-        logger.debug("checking status of job %s with counter %s", job_id, counter)
+        logger.debug("checking status of job %s", job_id)
         response = self.post(job_status_url, job=job_id)
         response_json = response.json()
         logger.debug("response was %s", response)
         completed = self.is_job_completed(response_json)
-        while not completed:
-            logger.debug("job was completed? %s with response %s", completed, response.text)
-            if retry and counter < limit:
-                # recur up to the limit
-                time.sleep(10)
-                logger.debug("done sleeping, about to retry")
-                counter += 1
-                response = self.post(job_status_url, job=job_id)
-                response_json = response.json()
-                logger.debug("response json: %s", response_json)
-                completed = self.is_job_completed(response_json)
-            else:
-                logger.warning("job %s failed to complete in %s retries - aborting", job_id, limit)
-                return None
+        self.status = self.get_job_data(response_json)['status']
+        if not completed:
+            logger.debug("job %s has not completed yet, response %s", job_id, response.text)
+            self.completed = False
+            return None
 
         self.project_id = self.get_project_id(response_json)
         logger.debug("project id %s", self.project_id)
@@ -169,34 +250,62 @@ class Job(object):
     def get_results(self, response_json):
         return response_json['deployr']['response']['directory']['files']
 
-    def retrieve_files(self):
+    def retrieve_files(self, destination, concurrency=None):
         """
-        Returns a list of (File, JSON metadata about the file) tuples.
+        Download the result files of a completed job with up to concurrency downloads in flight over the session's
+        pooled connections, streaming each file straight to the path it is kept at
+
+        :param destination: callable returning the path to write a file to given its DeployR metadata
+        :return: a FileTransfer for each file retrieved. Files that could not be retrieved are logged and left out,
+                 and whatever was written to their path is removed.
         """
         results = getattr(self, 'results', None)
         if results is None or not self.completed:
             raise ValueError("No results available, try running check_status again.")
-        files = []
-        temp_directory = tempfile.mkdtemp(prefix=self.project_id)
-        for result in results:
-            url = result['url']
-            if settings.DEPLOYR_HOST is not 'localhost':
-                url = re.sub('localhost', settings.DEPLOYR_HOST, url)
-                logger.debug("changed url from %s to %s", result['url'], url)
-            filename = result['filename']
-            response = self.get(url, stream=True)
-            if not response.ok:
-                logger.error("unable to retrieve file %s at url %s.\nResponse: %s", filename, url, response)
-                continue
-            result_file = os.path.join(temp_directory, filename)
-            with open(result_file, 'wb') as f:
-                for block in response.iter_content(1024):
-                    f.write(block)
-                files.append((f.name, result))
-        return files
+        if concurrency is None:
+            concurrency = settings.DEPLOYR_DOWNLOAD_CONCURRENCY
+        downloads = [(result, destination(result)) for result in results]
+        concurrency = min(concurrency, len(downloads))
+        download = lambda result_path: self._download(*result_path)
+        if concurrency <= 1:
+            transfers = [download(result_path) for result_path in downloads]
+        else:
+            pool = ThreadPool(concurrency)
+            try:
+                transfers = pool.map(download, downloads)
+            finally:
+                pool.close()
+                pool.join()
+        return [transfer for transfer in transfers if transfer is not None]
+
+    def _download(self, result, file_path):
+        url = result['url']
+        if settings.DEPLOYR_HOST != 'localhost':
+            url = re.sub('localhost', settings.DEPLOYR_HOST, url)
+            logger.debug("changed url from %s to %s", result['url'], url)
+        start = time.time()
+        try:
+            with closing(self.get(url, stream=True, timeout=settings.DEPLOYR_TIMEOUT)) as response:
+                if not response.ok:
+                    raise DeployrUnexpectedStatusCode(response)
+                with open(file_path, 'wb') as f:
+                    for block in response.iter_content(settings.DEPLOYR_DOWNLOAD_CHUNK_SIZE):
+                        f.write(block)
+                    size = f.tell()
+        except (requests.exceptions.RequestException, DeployrUnexpectedStatusCode, IOError):
+            logger.exception("unable to retrieve file %s at url %s", result['filename'], url)
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            return None
+        seconds = time.time() - start
+        logger.info("retrieved %s (%s bytes) in %.3fs", file_path, size, seconds)
+        return FileTransfer(result=result, path=file_path, bytes=size, seconds=seconds)
 
     def is_job_completed(self, response_json):
-        return self.get_job_data(response_json)['status'] in ['Completed', 'Failed']
+        return self.get_job_data(response_json)['status'] in Job.FINISHED_STATUSES
 
     def get_job_data(self, response_json):
         try:
@@ -211,8 +320,42 @@ class Job(object):
         return self.get_job_data(response_json)['project']
 
 
-def run_script(script_name=None, workdir=DEFAULT_WORKING_DIRECTORY, parameters=None, user=None, job_name=None):
+def query_jobs(job_ids, session, concurrency=None):
+    """
+    Query the status of many jobs with up to concurrency queries in flight over the session's pooled connections
+
+    :return: dict of job id to its query response json, leaving out the jobs that could not be queried
     """
+    if concurrency is None:
+        concurrency = settings.DEPLOYR_JOB_MONITOR_CONCURRENCY
+    job = Job(session)
+
+    def query(job_id):
+        try:
+            response = job.post(job_status_url, job=job_id)
+            response200orError(response)
+            return job_id, response.json()
+        except (requests.exceptions.RequestException, DeployrUnexpectedStatusCode, ValueError):
+            logger.warning("could not query the status of job %s", job_id, exc_info=True)
+            return job_id, None
+
+    concurrency = min(concurrency, len(job_ids))
+    if concurrency <= 1:
+        responses = [query(job_id) for job_id in job_ids]
+    else:
+        pool = ThreadPool(concurrency)
+        try:
+            responses = pool.map(query, job_ids)
+        finally:
+            pool.close()
+            pool.join()
+    return dict((job_id, response_json) for job_id, response_json in responses if response_json is not None)
+
+
+def submit_script(script_name=None, workdir=DEFAULT_WORKING_DIRECTORY, parameters=None, user=None, job_name=None):
+    """
+    Submit a job running an R script without waiting for it to complete
+
     :param script_name: Script name (such as "Figure1.R")
     :param workdir: Working directory (corresponds to project slug)
     :param parameters: Parameters to run the R script with (e.g [{"value": 30, "id": 1, "label": "x", "rclass": "integer", "description": "helllo"}])
@@ -242,7 +385,5 @@ def run_script(script_name=None, workdir=DEFAULT_WORKING_DIRECTORY, parameters=N
         # submit job
         job = Job(session)
         job.submit(execute_script_data)
-        time.sleep(15)
-        job.check_status()
-        logger.debug("RUN SCRIPT successful? [{}] response: {}".format(job.completed, job.response.text))
+        logger.debug("SUBMIT SCRIPT successful? [%s] job %s", job.submit_successful, job.job_id)
         return job
@@ -6,18 +6,58 @@ ProjectFilePaths = namedtuple('ProjectFilePaths', [
     'paths'             # list of all paths contained in the archive
 ])
 
+ExtractionStats = namedtuple('ExtractionStats', [
+    'files',            # number of files written out of the archive
+    'bytes',            # number of uncompressed bytes written
+    'seconds'           # wall clock time spent extracting
+])
+
+ArchiveMember = namedtuple('ArchiveMember', [
+    'name',             # normalized path of the member inside the archive
+    'is_dir',
+    'size',             # uncompressed size in bytes
+    'compressed_size',  # compressed size in bytes, None if the format does not record it per member
+    'offset'            # offset of the member's header in the archive file, None for tar archives
+])
+
 ProjectGroupedFilePaths = namedtuple('ProjectGroupedFilePaths', [
     'project_token',
     'grouped_paths',    # metadata entries for a group of files
     'paths'
 ])
 
+ProjectManifestDiff = namedtuple('ProjectManifestDiff', [
+    'added',            # paths only in the new archive
+    'changed',          # paths whose contents differ from the ingested file
+    'removed',          # paths only in the ingested project
+    'unchanged'
+])
+
+StagedProjectUpdate = namedtuple('StagedProjectUpdate', [
+    'project_token',
+    'staging_folder',   # folder the new archive was extracted into
+    'project_folder',   # extracted project folder inside the staging folder
+    'paths',            # list of all paths contained in the new archive
+    'digests',          # dict of extracted file path to (digest, size)
+    'diff'              # ProjectManifestDiff against the ingested project
+])
+
+TabularFileProbe = namedtuple('TabularFileProbe', [
+    'is_netlogo',       # True for NetLogo BehaviorSpace table output
+    'delimiter',
+    'has_header'        # True if the first row (after the NetLogo preamble) holds column names
+])
+
 DataTypes = Enum('DataTypes', 'none archive code data document vizualization')
 
 MetadataDataFile = namedtuple('MetadataDataFile', [
     'name',
-    'path'
+    'path',
+    'column_statistics',    # list of per column value, empty and null counts, None if not tabular
+    'layer_statistics',     # list of per layer feature count, geometry type, extent and SRS, None if not spatial
+    'columns'               # (name, type) pairs of the file's columns in the file's order
 ])
+MetadataDataFile.__new__.__defaults__ = (None, None, None)
 
 MetadataDataTableGroup = namedtuple('MetadataDataTableGroup', [
     'name',
@@ -41,4 +81,7 @@ class PackratException(Exception):
     pass
 
 class ProjectDirectoryAlreadyExists(IOError):
+    pass
+
+class IngestInProgress(Exception):
     pass
\ No newline at end of file
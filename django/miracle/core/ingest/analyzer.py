@@ -1,20 +1,30 @@
 import csv
 import collections
 import dateutil.parser as date
+import hashlib
+import io
 import json
 import logging
+import itertools
+import multiprocessing
+import random
 import re
+import select
+import time
 
 import abc
 
 from collections import defaultdict
+from datetime import datetime
 from django.conf import settings
 from django.contrib.gis.gdal import DataSource, GDALRaster, GDALException
 from os import path
 import os
 
+from ..models import MetadataCacheEntry, ProjectManifestEntry
 from ..utils import Chdir
-from . import ProjectGroupedFilePaths, DataTypes
+from . import ProjectGroupedFilePaths, DataTypes, TabularFileProbe
+from .grouper import is_loaded
 
 logger = logging.getLogger(__name__)
 
@@ -26,10 +36,16 @@ Only current grouped filetype are shapefiles
 class FileGroup(object):
     """
     Interface for FileGroups
+
+    Metadata is extracted the first time it is accessed unless it was passed in or assigned,
+    see analyze_file_groups to extract the metadata of many groups at once. Relative group names
+    are resolved against project_folder when it is set, not against the current directory.
     """
 
     __metaclass__ = abc.ABCMeta
 
+    project_folder = None
+
     @abc.abstractmethod
     def _analyze(self):
         pass
@@ -46,9 +62,23 @@ class FileGroup(object):
     def inds(self):
         pass
 
-    @abc.abstractproperty
+    @property
     def metadata(self):
-        pass
+        if self._metadata is None:
+            if self.project_folder is None:
+                self._metadata = self._analyze()
+            else:
+                with Chdir(self.project_folder):
+                    self._metadata = self._analyze()
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata):
+        self._metadata = metadata
+
+    @property
+    def is_analyzed(self):
+        return self._metadata is not None
 
     @abc.abstractproperty
     def title(self):
@@ -63,7 +93,7 @@ class ShapefileFileGroup(FileGroup):
     def __init__(self, file_paths, inds, metadata=None):
         self._file_paths = file_paths
         self._inds = inds
-        self._metadata = metadata or self._analyze()
+        self._metadata = metadata
 
     def __eq__(self, other):
         return isinstance(other, ShapefileFileGroup) and self._file_paths == other._file_paths \
@@ -89,23 +119,23 @@ class ShapefileFileGroup(FileGroup):
     def inds(self):
         return self._inds
 
-    @property
-    def metadata(self):
-        return self._metadata
-
     @property
     def title(self):
         bname, ext = path.splitext(path.basename(self.group_name))
         return bname
 
 
+SHAPEFILE_EXTENSIONS = ['.shp', '.dbf', '.prj', '.shx']
+
+
 class ShapefileGrouper(object):
-    def __init__(self):
+    def __init__(self, metadata=None):
         self._groups = defaultdict(lambda: [])
+        self._metadata = metadata or {}
 
     def add(self, file_path, ind):
         file_name, ext = path.splitext(file_path)
-        is_part_of_shapefile = ext in ['.shp', '.dbf', '.prj', '.shx']
+        is_part_of_shapefile = ext in SHAPEFILE_EXTENSIONS
         if is_part_of_shapefile:
             self._groups[file_name].append((ind, ext))
             return True
@@ -123,10 +153,11 @@ class ShapefileGrouper(object):
             if ('.dbf' not in exts) or ('.shp' not in exts):
                 i = 0
                 for ext in exts:
-                    file_paths.append(OtherFile(file_name + ext, inds[i]))
+                    file_paths.append(OtherFile(file_name + ext, inds[i], self._metadata.get(file_name + ext)))
                     i += 1
             else:
-                file_paths.append(ShapefileFileGroup([file_name + ext for ext in exts], inds))
+                file_paths.append(ShapefileFileGroup([file_name + ext for ext in exts], inds,
+                                                     self._metadata.get(file_name + ".shp")))
         return file_paths
 
 
@@ -134,7 +165,7 @@ class OtherFile(FileGroup):
     def __init__(self, file_path, ind, metadata=None):
         self._file_path = file_path
         self._ind = ind
-        self._metadata = metadata or self._analyze()
+        self._metadata = metadata
 
     def __eq__(self, other):
         return isinstance(other, OtherFile) and self._file_path == other._file_path \
@@ -157,10 +188,6 @@ class OtherFile(FileGroup):
     def inds(self):
         return [self._ind]
 
-    @property
-    def metadata(self):
-        return self._metadata
-
     @property
     def title(self):
         bname, ext = path.splitext(path.basename(self.group_name))
@@ -168,39 +195,260 @@ class OtherFile(FileGroup):
 
 
 class OtherFileGrouper(object):
-    def __init__(self):
+    def __init__(self, metadata=None):
         self._groups = []
+        self._metadata = metadata or {}
 
     def add(self, file_path, ind):
-        self._groups.append(OtherFile(file_path, ind))
+        self._groups.append(OtherFile(file_path, ind, self._metadata.get(file_path)))
         return True
 
     def groups(self):
         return self._groups
 
 
-def group_files(project_file_paths):
+def group_files(project_file_paths, processes=None, project_folder=None, digests=None):
     """
     :param project_file_paths:
     :type project_file_paths: ProjectFilePaths
+    :param processes: number of processes used to extract metadata, defaults to the
+                      METADATA_EXTRACTION_PROCESSES setting (0 means one per CPU)
+    :param project_folder: folder the paths are relative to, defaults to the project's
+                           folder in PROJECT_DIRECTORY
+    :param digests: dict of path to content digest used to look up cached metadata, defaults
+                    to the project's manifest when project_folder is not given
     :return:
     :rtype: ProjectGroupedFilePaths
     """
+    if project_folder is None:
+        project_folder = os.path.join(settings.PROJECT_DIRECTORY, project_file_paths.project_token)
+        if digests is None:
+            digests = dict(ProjectManifestEntry.objects
+                           .filter(project__slug=project_file_paths.project_token)
+                           .values_list('path', 'blob_id'))
     shapefile_grouper = ShapefileGrouper()
     otherfile = OtherFileGrouper()
 
-    with Chdir(os.path.join(settings.PROJECT_DIRECTORY, project_file_paths.project_token)):
-        i = 0
-        for file_path in project_file_paths.paths:
-            shapefile_grouper.add(file_path, i) or otherfile.add(file_path, i)
-            i += 1
+    for i, file_path in enumerate(project_file_paths.paths):
+        shapefile_grouper.add(file_path, i) or otherfile.add(file_path, i)
+    file_groups = shapefile_grouper.groups() + otherfile.groups()
+    file_groups.sort(key=lambda file_group: min(file_group.inds))
+    for file_group in file_groups:
+        file_group.project_folder = project_folder
 
-        file_groups = shapefile_grouper.groups() + otherfile.groups()
+    # only groups in the data and src folders are loaded, the others are analyzed if their metadata is ever accessed
+    analyze_file_groups(project_folder, [file_group for file_group in file_groups if is_loaded(file_group)],
+                        processes, digests)
     return ProjectGroupedFilePaths(project_file_paths.project_token,
                                    file_groups,
                                    project_file_paths.paths)
 
 
+def analyze_file_groups(project_folder, file_groups, processes=None, digests=None):
+    """
+    Extract the metadata of every file group that has not been analyzed yet in one batch
+
+    :param project_folder: absolute path of the extracted project the groups' paths are relative to
+    :type file_groups: list of FileGroup
+    :param processes: size of the process pool, see group_files
+    :param digests: dict of path to content digest, see analyze_paths
+    """
+    pending = dict((file_group.group_name, file_group) for file_group in file_groups if not file_group.is_analyzed)
+    metadata = analyze_paths(project_folder, pending.keys(), processes, digests)
+    for group_name, file_group in pending.items():
+        file_group.metadata = metadata[group_name]
+
+
+def related_paths(changed_paths, paths):
+    """
+    Expand changed paths with the other paths their file groups are built from (the
+    components of a shapefile), so that the groups can be analyzed again
+
+    :param changed_paths: paths that were added, changed or removed
+    :param paths: all paths currently in the project
+    :return: the subset of paths that belong to a file group touched by changed_paths
+    """
+    changed_shapefiles = set()
+    for file_path in changed_paths:
+        file_name, ext = path.splitext(file_path)
+        if ext in SHAPEFILE_EXTENSIONS:
+            changed_shapefiles.add(file_name)
+    changed_paths = set(changed_paths)
+    return [file_path for file_path in paths
+            if file_path in changed_paths or path.splitext(file_path)[0] in changed_shapefiles]
+
+
+def analyze_paths(project_folder, paths, processes=None, digests=None):
+    """
+    Extract metadata for every path in a project folder
+
+    With more than one process the loaders run in worker processes. Each loader gets the
+    timeout listed in FORMAT_TIMEOUTS, counted from when its worker starts on the file, and
+    a worker stuck past it is killed and replaced. With a single process the loaders run
+    in this process without a timeout. A loader that fails or times out produces a Metadata
+    entry with an error instead of aborting the ingest.
+
+    Metadata of files handled by one of the CACHED_LOADERS is looked up in the metadata cache
+    by content digest first, only the misses are analyzed and then added to the cache.
+
+    :param project_folder: absolute path of the extracted project
+    :param paths: paths relative to the project folder
+    :param processes: size of the process pool, see group_files
+    :param digests: dict of path to content digest, files without a digest are not cached
+    :return: a dict of path to Metadata
+    """
+    keys = _cache_keys(paths, digests or {})
+    metadata = MetadataCacheEntry.objects.get_many(keys)
+    if metadata:
+        logger.debug("found cached metadata for %s of %s files", len(metadata), len(paths))
+    paths = [file_path for file_path in paths if file_path not in metadata]
+    metadata.update(_analyze_paths(project_folder, paths, processes))
+    MetadataCacheEntry.objects.set_many(
+        dict((file_path, key) for file_path, key in keys.items() if file_path in paths), metadata)
+    return metadata
+
+
+def _analyze_paths(project_folder, paths, processes):
+    if not paths:
+        return {}
+    if processes is None:
+        processes = getattr(settings, 'METADATA_EXTRACTION_PROCESSES', 1)
+    if processes == 0:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(paths))
+
+    if processes <= 1:
+        return dict((file_path, _analyze_path(project_folder, file_path)) for file_path in paths)
+
+    queue = collections.deque(paths)
+    workers = [_AnalysisWorker() for i in range(processes)]
+    metadata = {}
+    try:
+        while queue or any(worker.file_path for worker in workers):
+            for worker in workers:
+                if worker.file_path is None and queue:
+                    worker.start(project_folder, queue.popleft())
+            busy = [worker for worker in workers if worker.file_path]
+            wait = max(min(worker.deadline for worker in busy) - time.time(), 0)
+            ready, _, _ = select.select([worker.connection for worker in busy], [], [], wait)
+            for i, worker in enumerate(workers):
+                if worker.connection in ready:
+                    file_path = worker.file_path
+                    try:
+                        metadata[file_path] = worker.result()
+                    except EOFError:
+                        # the loader took the worker down with it, e.g. with a segfault in GDAL
+                        logger.error("metadata extraction for %s killed its worker", file_path)
+                        metadata[file_path] = _failed_metadata(file_path, "worker died")
+                        worker.stop()
+                        workers[i] = _AnalysisWorker()
+                elif worker.file_path and worker.deadline <= time.time():
+                    timeout = FORMAT_TIMEOUTS[_dispatch(worker.file_path)]
+                    logger.error("metadata extraction for %s timed out after %s seconds", worker.file_path, timeout)
+                    metadata[worker.file_path] = _failed_metadata(worker.file_path,
+                                                                  "timed out after {} seconds".format(timeout))
+                    # the worker is stuck on the file, replace it so that the files queued behind it still run
+                    worker.stop()
+                    workers[i] = _AnalysisWorker()
+        return metadata
+    finally:
+        for worker in workers:
+            worker.stop()
+
+
+class _AnalysisWorker(object):
+    """
+    A process analyzing one file at a time, sent to it over a pipe so that each file's timeout runs from when the
+    worker starts on it
+    """
+
+    def __init__(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_analysis_worker_loop, args=(child_connection,))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+        self.file_path = None
+        self.deadline = None
+
+    def start(self, project_folder, file_path):
+        self.file_path = file_path
+        self.deadline = time.time() + FORMAT_TIMEOUTS[_dispatch(file_path)]
+        self.connection.send((project_folder, file_path))
+
+    def result(self):
+        try:
+            return self.connection.recv()
+        finally:
+            self.file_path = None
+            self.deadline = None
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+def _analysis_worker_loop(connection):
+    while True:
+        project_folder, file_path = connection.recv()
+        connection.send(_analyze_path(project_folder, file_path))
+
+
+def _cache_keys(paths, digests):
+    """
+    :return: a dict of path to the (digest, loader, version, options) its metadata is cached under, see
+             _cache_options
+    """
+    # a shapefile's layers depend on its sibling components so it is keyed by all of their digests
+    shapefile_components = defaultdict(list)
+    for file_path, digest in digests.items():
+        file_name, ext = path.splitext(file_path)
+        if ext in SHAPEFILE_EXTENSIONS:
+            shapefile_components[file_name].append((ext, digest))
+
+    keys = {}
+    for file_path in paths:
+        loader = CACHED_LOADERS.get(FORMAT_DISPATCH[_dispatch(file_path)])
+        digest = digests.get(file_path)
+        if loader is None or digest is None:
+            continue
+        file_name, ext = path.splitext(file_path)
+        if ext == '.shp':
+            digest = hashlib.sha256(' '.join('{}:{}'.format(*component)
+                                             for component in sorted(shapefile_components[file_name]))).hexdigest()
+        keys[file_path] = (digest, loader.__name__, loader.VERSION, _cache_options(loader, ext))
+    return keys
+
+
+def _cache_options(loader, ext):
+    """
+    Digest of what the metadata of a file depends on besides its contents and the loader version: its extension,
+    e.g. the default delimiter of .tsv files, and the loader's CACHE_SETTINGS
+    """
+    options = [ext.lower()] + [[name, getattr(settings, name)] for name in getattr(loader, 'CACHE_SETTINGS', ())]
+    return hashlib.sha1(json.dumps(options)).hexdigest()
+
+
+def _dispatch(file_path):
+    _, ext = path.splitext(file_path)
+    return sanitize_ext(ext)
+
+
+def _analyze_path(project_folder, file_path):
+    try:
+        with Chdir(project_folder):
+            return FORMAT_DISPATCH[_dispatch(file_path)](file_path)
+    except Exception as e:
+        logger.exception("metadata extraction failed for %s", file_path)
+        return _failed_metadata(file_path, "{}: {}".format(type(e).__name__, e))
+
+
+def _failed_metadata(file_path, error):
+    return Metadata(file_path, DataTypes.none, {}, [], [error])
+
+
 class Metadata(object):
     """
     :type grouped_file_path: GroupedFilePath
@@ -213,9 +461,7 @@ class Metadata(object):
         self.datatype = datatype
         self.properties = properties
         self.layers = layers
-        if not errors:
-            self.errors = []
-        self.errors = errors
+        self.errors = errors or []
 
     def __repr__(self):
         res = "Metadata(%s, %s, %s, %s)\n" % \
@@ -224,13 +470,16 @@ class Metadata(object):
 
 
 class GDALLoader(object):
+    VERSION = 1
+
     @staticmethod
     def from_file(path):
         datasource = GDALRaster(path)
         properties = {"width": datasource.width,
                       "height": datasource.height}
         try:
-            properties["srs"] = datasource.srs
+            # store the WKT rather than the SpatialReference so metadata can be pickled
+            properties["srs"] = datasource.srs.wkt
         except GDALException:
             pass
         layers = [(band.description or None, GDALLoader.from_layer(band)) for band in datasource.bands]
@@ -243,25 +492,56 @@ class GDALLoader(object):
 
 
 class OGRLoader(object):
+    VERSION = 2
+
     @staticmethod
     def from_file(path):
         datasource = DataSource(path)
-        properties = {}
-        layers = [(layer.name or None, OGRLoader.from_layer(layer)) for layer in datasource]
+        layers = []
+        statistics = []
+        for layer in datasource:
+            layers.append((layer.name or None, OGRLoader.from_layer(layer)))
+            statistics.append(OGRLoader.layer_statistics(layer))
 
-        return Metadata(path, DataTypes.data, properties, layers)
+        return Metadata(path, DataTypes.data, {"layers": statistics}, layers)
 
     OGR_DATATYPE_CONVERSIONS = {
         "OFTString": "text",
+        "OFTWideString": "text",
+        "OFTInteger": "bigint",
+        "OFTInteger64": "bigint",
         "OFTReal": "decimal",
-        "OFTDate": "date"
+        "OFTDate": "date",
+        "OFTDateTime": "date",
     }
 
     @staticmethod
     def from_layer(layer):
-        return tuple((field, OGRLoader.OGR_DATATYPE_CONVERSIONS[datatype.__name__])
+        return tuple((field, OGRLoader.OGR_DATATYPE_CONVERSIONS.get(datatype.__name__, "text"))
                      for (field, datatype) in zip(layer.fields, layer.field_types))
 
+    @staticmethod
+    def layer_statistics(layer):
+        """
+        Feature count, geometry type, extent and SRS of a layer, all read from the layer's header so no
+        feature is visited
+        """
+        statistics = {"features": layer.num_feat,
+                      "geometry_type": layer.geom_type.name,
+                      "extent": None,
+                      "srid": None,
+                      "srs": None}
+        try:
+            statistics["extent"] = layer.extent.tuple
+        except GDALException:
+            # layers without features have no extent
+            pass
+        srs = layer.srs
+        if srs is not None:
+            statistics["srid"] = srs.srid
+            statistics["srs"] = srs.wkt
+        return statistics
+
 
 class ArchiveLoader(object):
     @staticmethod
@@ -269,18 +549,286 @@ class ArchiveLoader(object):
         return Metadata(path, DataTypes.archive, {}, [])
 
 
+BIGINT_REGEX = r'[+\-]?(?:0|[1-9]\d*)'
+# following the specification at www.json.org
+DECIMAL_REGEX = r'[+\-]?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?'
+BOOLEAN_REGEX = r'[\'"]?(true|false|t|f|yes|no)[\'"]?'
+NULL_VALUES = ('NA', 'N/A', 'NULL', 'null', 'None')
+# strptime formats tried, in order, to learn the format of a date column from its first value
+DATE_FORMATS = (
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y/%m/%d',
+    '%m/%d/%Y',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %H:%M',
+    '%d/%m/%Y',
+    '%d.%m.%Y',
+    '%d-%b-%Y',
+    '%d %b %Y',
+    '%b %d %Y',
+    '%B %d, %Y',
+    '%a %b %d %H:%M:%S UTC %Y',
+    '%a %b %d %H:%M:%S %Y',
+)
+
+
+def _line_patterns():
+    """
+    Patterns applied to a whole chunk of column values joined by newlines at once
+
+    NEUTRAL_LINE matches the empty and null lines of a chunk. The MISMATCH patterns find the first line that is
+    neither neutral nor of the candidate type, so a single search in C replaces a regex match per value.
+    """
+    nulls = '|'.join(re.escape(value) for value in NULL_VALUES)
+    # the null markers are case sensitive so spell out the case insensitivity of the boolean pattern
+    boolean = re.sub(r'[a-z]', lambda m: '[{}{}]'.format(m.group(0), m.group(0).upper()), BOOLEAN_REGEX)
+    neutral_line = re.compile(r'^ *(?:(' + nulls + r')|) *$', re.MULTILINE)
+    mismatch = dict((candidate, re.compile(r'^(?! *(?:' + regex + '|' + nulls + r')? *$)', re.MULTILINE))
+                    for candidate, regex in (('bigint', BIGINT_REGEX),
+                                             ('decimal', DECIMAL_REGEX),
+                                             ('boolean', boolean)))
+    numeric_or_boolean_line = re.compile(r'^ *(?:' + DECIMAL_REGEX + '|' + boolean + r') *$', re.MULTILINE)
+    return neutral_line, mismatch, numeric_or_boolean_line
+
+
+class ColumnTypeInference(object):
+    """
+    Infer the type of a column from all of its values, one chunk of values at a time
+
+    A column starts out as any of the candidate types and every value eliminates the candidates it does not match, so
+    the column type widens (e.g. bigint to decimal to text) as values are seen. The inferred type is the first
+    remaining candidate in the same order TabularLoader has always tried them, or text if none remain.
+
+    Empty cells and null markers (NA, NULL, ...) do not constrain the type and are counted instead.
+
+    The strptime format of a date column is learned from its first date and checked on every following value before
+    falling back to dateutil. Values matching the learned format are not passed to dateutil at all. The format is
+    dropped (date_format is None) once a value only dateutil understands shows up.
+
+    update classifies a chunk by running a few patterns over the newline joined values. update_per_cell checks each
+    value on its own and is used for chunks with values containing newlines. Both give the same results.
+    """
+
+    CANDIDATES = ('bigint', 'decimal', 'boolean', 'date')
+    NULL_VALUES = frozenset(NULL_VALUES)
+    NEUTRAL_LINE, MISMATCH, NUMERIC_OR_BOOLEAN_LINE = _line_patterns()
+
+    def __init__(self):
+        self.candidates = list(self.CANDIDATES)
+        self.values = 0
+        self.empty = 0
+        self.null = 0
+        self.date_format = None
+        self._date_format_learned = False
+
+    def update(self, values):
+        if not values:
+            return
+        joined = '\n'.join(values)
+        if joined.count('\n') != len(values) - 1:
+            # a value spans several lines
+            self.update_per_cell(values)
+            return
+        n_empty, n_null = self._count_neutral(values, joined)
+        n_present = len(values) - n_empty - n_null
+        self.empty += n_empty
+        self.null += n_null
+        self.values += n_present
+        if not n_present or not self.candidates:
+            return
+        candidates = []
+        for candidate in self.candidates:
+            if candidate == 'decimal' and 'bigint' in candidates:
+                # every bigint is a decimal
+                pass
+            elif candidate == 'date':
+                if self.NUMERIC_OR_BOOLEAN_LINE.search(joined):
+                    continue
+                present = [value for value in (value.strip(' ') for value in values)
+                           if value and value not in self.NULL_VALUES]
+                if not self._all_dates(present):
+                    continue
+            elif self.MISMATCH[candidate].search(joined):
+                continue
+            candidates.append(candidate)
+        self.candidates = candidates
+
+    @classmethod
+    def count_neutral(cls, values):
+        """
+        :return: the number of empty cells and the number of null markers in values
+        """
+        joined = '\n'.join(values)
+        if joined.count('\n') != len(values) - 1:
+            values = [value.strip(' ') for value in values]
+            return values.count(''), sum(1 for value in values if value in cls.NULL_VALUES)
+        return cls._count_neutral(values, joined)
+
+    @classmethod
+    def _count_neutral(cls, values, joined):
+        if joined.startswith(' ') or joined.endswith(' ') or ' \n' in joined or '\n ' in joined:
+            neutral = cls.NEUTRAL_LINE.findall(joined)
+            n_null = sum(1 for null in neutral if null)
+            return len(neutral) - n_null, n_null
+        # no value is padded with spaces, so count empty and null values without scanning the chunk
+        return values.count(''), sum(values.count(null) for null in cls.NULL_VALUES)
+
+    def update_per_cell(self, values):
+        present = []
+        for value in values:
+            value = value.strip(' ')
+            if not value:
+                self.empty += 1
+            elif value in self.NULL_VALUES:
+                self.null += 1
+            else:
+                present.append(value)
+        self.values += len(present)
+        if present and self.candidates:
+            self.candidates = [candidate for candidate in self.candidates if self._matches(candidate, present)]
+
+    def _matches(self, candidate, values):
+        if candidate == 'bigint':
+            return all(TabularLoader.PATTERN_BIGINT.match(value) for value in values)
+        elif candidate == 'decimal':
+            return all(TabularLoader.PATTERN_DECIMAL.match(value) for value in values)
+        elif candidate == 'boolean':
+            return all(TabularLoader.PATTERN_BOOLEAN.match(value) for value in values)
+        # dateutil reads bare numbers as days or years, do not let numeric columns keep the date candidate alive
+        if any(TabularLoader.PATTERN_DECIMAL.match(value) or TabularLoader.PATTERN_BOOLEAN.match(value)
+               for value in values):
+            return False
+        return self._all_dates(values)
+
+    def _all_dates(self, values):
+        for value in values:
+            if self.date_format is not None:
+                try:
+                    datetime.strptime(value, self.date_format)
+                    continue
+                except ValueError:
+                    pass
+            try:
+                date.parse(value)
+            except (ValueError, OverflowError):
+                return False
+            if self._date_format_learned:
+                self.date_format = None
+            else:
+                self.date_format = learn_date_format(value)
+                self._date_format_learned = True
+        return True
+
+    @property
+    def data_type(self):
+        if not self.values or not self.candidates:
+            return "text"
+        return self.candidates[0]
+
+    @property
+    def statistics(self):
+        return {"values": self.values,
+                "empty": self.empty,
+                "null": self.null,
+                "date_format": self.date_format if self.data_type == "date" else None}
+
+
+def learn_date_format(value):
+    """
+    :return: the first of DATE_FORMATS that value is written in, None if there is none
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            datetime.strptime(value, date_format)
+            return date_format
+        except ValueError:
+            pass
+    return None
+
+
+class _DelimiterSniffer(csv.Sniffer):
+    """
+    A csv.Sniffer that only considers the given delimiters and falls back to a default one instead of failing, so that
+    Sniffer.has_header also works on single column files
+    """
+
+    def __init__(self, delimiters, default_delimiter):
+        csv.Sniffer.__init__(self)
+        self.delimiters = delimiters
+        self.default_delimiter = default_delimiter
+
+    def sniff(self, sample, delimiters=None):
+        try:
+            return csv.Sniffer.sniff(self, sample, delimiters or self.delimiters)
+        except csv.Error:
+            class dialect(csv.excel):
+                delimiter = self.default_delimiter
+            return dialect
+
+
 class TabularLoader(object):
+    VERSION = 2
+    # settings the extracted metadata depends on, part of its cache key
+    CACHE_SETTINGS = ('TYPE_INFERENCE_MAX_BYTES', 'TYPE_INFERENCE_SAMPLE_ROWS')
+
     @staticmethod
     def from_file(path):
-        with open(path, "rb") as f:
-            if TabularLoader._is_netlogo(f):
-                f.seek(0)
+        with TabularLoader.open(path) as f:
+            probe = TabularLoader.probe(f, path)
+            if probe.is_netlogo:
                 return TabularLoader._read_netlogo_csv(path, f)
             else:
-                f.seek(0)
-                return TabularLoader._read_normal_csv(path, f)
+                return TabularLoader._read_normal_csv(path, f, probe)
 
-    ROW_SAMPLE_SIZE = 3
+    # number of rows handed to ColumnTypeInference at a time
+    CHUNK_SIZE = 10000
+    # bytes read from the start of a file to detect its layout
+    PROBE_SIZE = 64 * 1024
+    # bytes of the probe passed to csv.Sniffer
+    SNIFF_SIZE = 4096
+    DELIMITERS = ',\t;|'
+
+    @classmethod
+    def open(cls, path):
+        # the probe is served from the buffer so reading the rows afterwards does not read the start of the file again
+        return io.open(path, 'rb', buffering=cls.PROBE_SIZE)
+
+    @classmethod
+    def probe(cls, f, path):
+        """
+        Detect the layout of a tabular file from a single buffered read of its start
+
+        The file position is left at the start of the file.
+
+        :param f: a file opened with TabularLoader.open
+        :param path: the file's path, its extension decides the default delimiter
+        :rtype: TabularFileProbe
+        """
+        prefix = f.peek(cls.PROBE_SIZE)[:cls.PROBE_SIZE]
+        if len(prefix) == cls.PROBE_SIZE:
+            # do not hand a partial last row to the detectors
+            prefix = prefix[:prefix.rfind('\n') + 1] or prefix
+        if cls._is_netlogo(io.BytesIO(prefix)):
+            return TabularFileProbe(is_netlogo=True, delimiter=',', has_header=True)
+
+        if path.lower().endswith('.tsv'):
+            sniffer = _DelimiterSniffer('\t', '\t')
+        else:
+            sniffer = _DelimiterSniffer(cls.DELIMITERS, ',')
+        sample = prefix[:cls.SNIFF_SIZE]
+        if len(prefix) > cls.SNIFF_SIZE:
+            sample = sample[:sample.rfind('\n') + 1] or sample
+        delimiter = sniffer.sniff(sample).delimiter
+        try:
+            has_header = sniffer.has_header(sample)
+        except Exception:
+            logger.debug("could not tell whether %s has a header", path, exc_info=True)
+            has_header = None
+        return TabularFileProbe(is_netlogo=False, delimiter=delimiter, has_header=has_header)
 
     @classmethod
     def _read_netlogo_csv(cls, path, f):
@@ -295,83 +843,115 @@ class TabularLoader(object):
         next(data)  # ignore slider ranges
 
         colnames = next(data)
-        datasample = cls._take_up_to_n_rows(data, cls.ROW_SAMPLE_SIZE)
-        datatypes = [TabularLoader._guess_type(el) for el in datasample]
+        inferences, properties = cls._infer_column_types(path, data, len(colnames))
+        datatypes = [inference.data_type for inference in inferences]
 
-        properties = {"file_name": file_name, "model_name": model_name}
+        properties.update({"file_name": file_name, "model_name": model_name})
         layers = [(None, tuple((name, datatype) for name, datatype in zip(colnames, datatypes)))]
 
         return Metadata(path, DataTypes.data, properties, layers)
 
     @classmethod
-    def _read_normal_csv(cls, path, f):
+    def _read_normal_csv(cls, path, f, probe):
         properties = {}
-        try:
-            has_header = csv.Sniffer().has_header(f.read(4096))
-        except Exception as e:
-            return Metadata(path, DataTypes.data, properties, [], [e])
+        if probe.has_header is None:
+            return Metadata(path, DataTypes.data, properties, [],
+                            [csv.Error("could not determine whether the file has a header")])
 
-        f.seek(0)
-        layer = []
-        reader = csv.reader(f)
-        if has_header:
+        reader = csv.reader(f, delimiter=probe.delimiter)
+        if probe.has_header:
             row = reader.next()
-            row = [re.sub(r'^ *"?|"? *$', '', el) for el in row]
-            row_types = cls._take_up_to_n_rows(reader, cls.ROW_SAMPLE_SIZE)
-            for k, v in zip(row, row_types):
-                layer.append((k, TabularLoader._guess_type(v)))
+            names = [re.sub(r'^ *"?|"? *$', '', el) for el in row]
+            inferences, properties = cls._infer_column_types(path, reader, len(names))
         else:
-            row_types = cls._take_up_to_n_rows(reader, cls.ROW_SAMPLE_SIZE)
-            n = len(row_types)
-            for col in range(n):
-                layer.append((None, TabularLoader._guess_type(row_types[col])))
+            rows = iter(reader)
+            first_row = next(rows, [])
+            names = [None] * len(first_row)
+            inferences, properties = cls._infer_column_types(path, itertools.chain([first_row], rows), len(names))
 
+        properties["delimiter"] = probe.delimiter
+        layer = [(name, inference.data_type) for name, inference in zip(names, inferences)]
         layers = [(None, tuple(layer))]
 
         return Metadata(path, DataTypes.data, properties, layers)
 
-    PATTERN_BIGINT = re.compile(r'^[+\-]?(?:0|[1-9]\d*)$')
-    # following the specification at www.json.org
-    PATTERN_DECIMAL = re.compile(r'^[+\-]?(?:0|[1-9]\d*)(?:\.\d*)?(?:[eE][+\-]?\d+)?$')
-    PATTERN_BOOLEAN = re.compile(r'^[\'"]?(true|false|t|f|yes|no)[\'"]?$', re.IGNORECASE)
-
     @classmethod
-    def _guess_type(cls, elements):
-        # strip leading and trailing spaces
-        elements = [re.sub(r'^ *| *$', '', el) for el in elements]
-        datatype = cls._try_type(cls.PATTERN_BIGINT, elements, "bigint") \
-            or cls._try_type(cls.PATTERN_DECIMAL, elements, "decimal") \
-            or cls._try_type(cls.PATTERN_BOOLEAN, elements, "boolean")
+    def _infer_column_types(cls, path, rows, n_columns):
+        """
+        Infer the type of each column from every row of a file, or from a reservoir sample of
+        TYPE_INFERENCE_SAMPLE_ROWS rows for files larger than TYPE_INFERENCE_MAX_BYTES
 
-        if datatype:
-            return datatype
+        Missing trailing cells of ragged rows are counted as empty. The value, empty and null counts
+        in the column statistics always cover every row, sampled or not.
 
-        try:
-            for el in elements:
-                date.parse(el)
-            return "date"
-        except ValueError:
-            pass
-        return "text"
+        :return: a ColumnTypeInference per column and the properties to record in the file's Metadata
+        """
+        inferences = [ColumnTypeInference() for _ in xrange(n_columns)]
+        sampled = os.path.getsize(path) > settings.TYPE_INFERENCE_MAX_BYTES
+        if sampled:
+            totals = [collections.Counter() for _ in xrange(n_columns)]
+            rows, n_rows = cls._reservoir_sample(cls._count_cells(rows, totals), settings.TYPE_INFERENCE_SAMPLE_ROWS)
+            rows = iter(rows)
+        else:
+            n_rows = 0
+        while True:
+            chunk = list(itertools.islice(rows, cls.CHUNK_SIZE))
+            if not chunk:
+                break
+            if not sampled:
+                n_rows += len(chunk)
+            for inference, values in zip(inferences, itertools.izip_longest(*chunk, fillvalue='')):
+                inference.update(values)
+        column_statistics = [inference.statistics for inference in inferences]
+        if sampled:
+            for statistics, total in zip(column_statistics, totals):
+                statistics.update(values=total['values'], empty=total['empty'], null=total['null'])
+        properties = {"rows": n_rows,
+                      "sampled": sampled,
+                      "column_statistics": column_statistics}
+        return inferences, properties
 
-    @staticmethod
-    def _try_type(pattern, values, datatype):
-        for value in values:
-            if not re.match(pattern, value):
-                return ""
-        return datatype
+    @classmethod
+    def _count_cells(cls, rows, totals):
+        """
+        Pass rows through while adding up the present, empty and null cells of each column in totals
+        """
+        while True:
+            chunk = list(itertools.islice(rows, cls.CHUNK_SIZE))
+            if not chunk:
+                break
+            for total, values in zip(totals, itertools.izip_longest(*chunk, fillvalue='')):
+                n_empty, n_null = ColumnTypeInference.count_neutral(values)
+                total['values'] += len(values) - n_empty - n_null
+                total['empty'] += n_empty
+                total['null'] += n_null
+            for row in chunk:
+                yield row
 
     @staticmethod
-    def _take_up_to_n_rows(reader, n):
-        rows = []
-        i = 0
-        for row in reader:
-            rows.append(row)
-            i += 1
-            if i >= n:
-                break
-        cols = zip(*rows)
-        return cols
+    def _reservoir_sample(rows, size):
+        # seeded so that re-ingesting the same file infers the same types
+        rng = random.Random(0)
+        sample = []
+        n_rows = 0
+        for n_rows, row in enumerate(rows, start=1):
+            if n_rows <= size:
+                sample.append(row)
+            else:
+                i = rng.randint(0, n_rows - 1)
+                if i < size:
+                    sample[i] = row
+        return sample, n_rows
+
+    PATTERN_BIGINT = re.compile(r'^' + BIGINT_REGEX + r'$')
+    PATTERN_DECIMAL = re.compile(r'^' + DECIMAL_REGEX + r'$')
+    PATTERN_BOOLEAN = re.compile(r'^' + BOOLEAN_REGEX + r'$', re.IGNORECASE)
+
+    @classmethod
+    def _guess_type(cls, elements):
+        inference = ColumnTypeInference()
+        inference.update(elements)
+        return inference.data_type
 
     @staticmethod
     def _is_netlogo(f):
@@ -387,23 +967,27 @@ class TabularLoader(object):
         i = 0
 
         row_len = 1
-        row = next(reader)
-
-        if len(row) == 1:
-            has_netlogo_in_first_row = row[0].find("(NetLogo") > 0
+        try:
+            row = next(reader)
 
-        row = next(reader)
-        if len(row) == 1:
-            has_netlogo_in_second_row = row[0].find(".nlogo") > 0
+            if len(row) == 1:
+                has_netlogo_in_first_row = row[0].find("(NetLogo") > 0
 
-        while i < 5:
             row = next(reader)
-            n = len(row)
-            if n != row_len:
-                has_ragged_columns = True
-                break
-
-            i += 1
+            if len(row) == 1:
+                has_netlogo_in_second_row = row[0].find(".nlogo") > 0
+
+            while i < 5:
+                row = next(reader)
+                n = len(row)
+                if n != row_len:
+                    has_ragged_columns = True
+                    break
+
+                i += 1
+        except StopIteration:
+            # too short to be a BehaviorSpace table
+            return False
         return has_netlogo_in_first_row and has_netlogo_in_second_row and has_ragged_columns
 
 
@@ -496,6 +1080,30 @@ for constructor, formats in CONSTRUCTOR_FORMATS.iteritems():
     for fmt in formats:
         FORMAT_DISPATCH[fmt] = constructor
 
+# seconds a loader may run in the metadata extraction process pool before its file is marked as failed
+DEFAULT_LOADER_TIMEOUT = 60
+
+CONSTRUCTOR_TIMEOUTS = {
+    TabularLoader.from_file: 600,
+    OGRLoader.from_file: 600,
+    GDALLoader.from_file: 600,
+}
+
+FORMAT_TIMEOUTS = \
+    collections.defaultdict(lambda: DEFAULT_LOADER_TIMEOUT)
+
+# loaders whose metadata is cached by content digest, bump a loader's VERSION whenever its output changes so that
+# metadata extracted by earlier versions is no longer used
+CACHED_LOADERS = {
+    TabularLoader.from_file: TabularLoader,
+    OGRLoader.from_file: OGRLoader,
+    GDALLoader.from_file: GDALLoader,
+}
+
+for fmt, constructor in FORMAT_DISPATCH.iteritems():
+    if constructor in CONSTRUCTOR_TIMEOUTS:
+        FORMAT_TIMEOUTS[fmt] = CONSTRUCTOR_TIMEOUTS[constructor]
+
 
 def sanitize_ext(ext):
     return ext.lower()
@@ -0,0 +1,87 @@
+"""
+Checkpoints for the stages of the metadata pipeline
+
+The output of each pipeline stage (ProjectFilePaths, ProjectGroupedFilePaths, MetadataProject) is pickled to
+CHECKPOINT_DIRECTORY/<project slug>/<stage>.pickle so that a failed ingest can resume from the last stage that
+completed, possibly on a different worker. Checkpoints are cleared once the last stage completes.
+
+Next to the checkpoints a state file records whether the ingest is running or failed, so that an ingest in progress
+is not mistaken for one to discard or resume.
+"""
+
+import cPickle as pickle
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+RUNNING = 'running'
+FAILED = 'failed'
+
+
+def checkpoint_folder(project):
+    return os.path.join(settings.CHECKPOINT_DIRECTORY, str(project.slug))
+
+
+def checkpoint_path(project, stage):
+    return os.path.join(checkpoint_folder(project), '{}.pickle'.format(stage))
+
+
+def state_path(project):
+    return os.path.join(checkpoint_folder(project), 'state')
+
+
+def _write(project, prefix, file_path, write):
+    folder = checkpoint_folder(project)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    # write to a temporary file first so that a crash never leaves a truncated file behind
+    fd, tmp_path = tempfile.mkstemp(prefix='.{}-'.format(prefix), dir=folder)
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.rename(tmp_path, file_path)
+
+
+def save(project, stage, output):
+    _write(project, stage, checkpoint_path(project, stage),
+           lambda f: pickle.dump(output, f, pickle.HIGHEST_PROTOCOL))
+    # the next stage follows
+    set_state(project, RUNNING)
+    logger.debug("saved %s checkpoint for project %s", stage, project)
+
+
+def set_state(project, state):
+    _write(project, 'state', state_path(project), lambda f: f.write(state))
+
+
+def get_state(project):
+    """
+    :return: the state of the ingest (RUNNING, FAILED or None if unknown) and the seconds since it was recorded
+    """
+    try:
+        with open(state_path(project), 'rb') as f:
+            return f.read(), time.time() - os.path.getmtime(state_path(project))
+    except (IOError, OSError):
+        return None, None
+
+
+def load(project, stage):
+    with open(checkpoint_path(project, stage), 'rb') as f:
+        return pickle.load(f)
+
+
+def exists(project, stage=None):
+    if stage is None:
+        return os.path.isdir(checkpoint_folder(project))
+    return os.path.exists(checkpoint_path(project, stage))
+
+
+def clear(project):
+    folder = checkpoint_folder(project)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
@@ -0,0 +1,261 @@
+"""
+Load the rows of tabular DataFiles into the datasets database
+
+Every DataTableGroup gets one table in the datasets database named by DataTableGroup.table_name, with a column per
+DataColumn named by DataColumn.column_name and typed after DataColumn.data_type. The rows of all of the group's
+DataFiles are streamed into it with COPY FROM STDIN in batches of DATASETS_COPY_BATCH_SIZE rows. The datasets
+connection runs in autocommit mode so each batch is committed as soon as it is copied.
+
+Groups with shapefiles get an extra PostGIS geometry column, GEOMETRY_COLUMN, holding each feature's geometry as
+EWKT, and a GiST index on it once all rows are loaded.
+"""
+
+import csv
+import dateutil.parser as date
+import itertools
+import logging
+import time
+from cStringIO import StringIO
+from datetime import datetime
+from os import path
+
+from django.conf import settings
+from django.contrib.gis.gdal import DataSource
+
+from .analyzer import TabularLoader, NULL_VALUES
+
+logger = logging.getLogger(__name__)
+
+# postgres column type for each DataColumn.DataType
+COLUMN_TYPES = {
+    'bigint': 'bigint',
+    'decimal': 'numeric',
+    'boolean': 'boolean',
+    'date': 'timestamp',
+    'text': 'text',
+}
+
+# name of the geometry column of groups with spatial DataFiles, never clashes with DataColumn.column_name which
+# always starts with the column's prefix and pk
+GEOMETRY_COLUMN = 'geom'
+
+# rows before the column names in a NetLogo BehaviorSpace table, see TabularLoader._read_netlogo_csv
+NETLOGO_PREAMBLE_ROWS = 6
+
+# range of the postgres bigint type
+BIGINT_MIN = -2 ** 63
+BIGINT_MAX = 2 ** 63 - 1
+
+
+def load_datasets(project):
+    """
+    Load the rows of every DataTableGroup in the project into the datasets database
+
+    :type project: miracle.core.models.Project
+    """
+    load_datatablegroups_rows(project.data_table_groups.all(), project)
+
+
+def load_datatablegroups_rows(datatablegroups, project):
+    for datatablegroup in datatablegroups:
+        load_datatablegroup_rows(datatablegroup, project)
+
+
+def load_datatablegroup_rows(datatablegroup, project):
+    """
+    (Re)create the table for a DataTableGroup and copy the rows of all its DataFiles into it
+
+    Values that do not match the inferred type of their column or do not fit in it are loaded as NULL.
+
+    :type datatablegroup: miracle.core.models.DataTableGroup
+    :type project: miracle.core.models.Project
+    :return: the number of rows loaded
+    """
+    columns = list(datatablegroup.columns.all())
+    if not columns:
+        logger.debug("skipping data table group %s without columns", datatablegroup.name)
+        return 0
+    datafiles = [datafile for datafile in datatablegroup.files.all() if not datafile.ignored]
+
+    quote_name = datatablegroup.connection.ops.quote_name
+    table_name = quote_name(datatablegroup.table_name)
+    column_names = [quote_name(column.column_name) for column in columns]
+    column_definitions = ['{} {}'.format(name, COLUMN_TYPES.get(column.data_type, 'text'))
+                          for name, column in zip(column_names, columns)]
+    converters = [_converter(column) for column in columns]
+    is_spatial = any(datafile.is_spatial for datafile in datafiles)
+    if is_spatial:
+        column_names.append(quote_name(GEOMETRY_COLUMN))
+        column_definitions.append('{} geometry'.format(quote_name(GEOMETRY_COLUMN)))
+        converters.append(_to_geometry)
+    # csv.writer writes the None of a row with a single value as a quoted empty string, which COPY reads as an
+    # empty string rather than NULL unless it is forced to NULL
+    copy_statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8', FORCE_NULL ({}))".format(
+        table_name, ', '.join(column_names), ', '.join(column_names))
+
+    start = time.time()
+    n_rows = 0
+    with datatablegroup.cursor as cursor:
+        datatablegroup.drop_table(cursor)
+        cursor.execute("CREATE TABLE {} ({})".format(table_name, ', '.join(column_definitions)))
+        try:
+            for datafile in datafiles:
+                file_path = path.join(project.project_path, datafile.archived_file.name)
+                if datafile.is_spatial:
+                    n_rows += _copy_shapefile(cursor, copy_statement, file_path, datafile.column_order, converters)
+                else:
+                    n_rows += _copy_datafile(cursor, copy_statement, file_path, datafile.column_order, converters)
+            if is_spatial:
+                # build the index after loading rather than maintaining it for every copied batch
+                cursor.execute("CREATE INDEX ON {} USING GIST ({})".format(table_name, quote_name(GEOMETRY_COLUMN)))
+                cursor.execute("ANALYZE {}".format(table_name))
+        except Exception:
+            logger.exception("could not load rows of data table group %s, dropping %s", datatablegroup.name,
+                             table_name)
+            datatablegroup.drop_table(cursor)
+            raise
+
+    seconds = max(time.time() - start, 1e-6)
+    logger.info("loaded %s rows from %s files into %s in %.3fs (%.0f rows/sec)",
+                n_rows, len(datafiles), table_name, seconds, n_rows / seconds)
+    return n_rows
+
+
+def _copy_datafile(cursor, copy_statement, file_path, column_order, converters):
+    with TabularLoader.open(file_path) as f:
+        rows = _data_rows(f, file_path)
+        if column_order is not None:
+            rows = _reordered_rows(rows, column_order)
+        return _copy_rows(cursor, copy_statement, rows, converters, file_path)
+
+
+def _copy_shapefile(cursor, copy_statement, file_path, column_order, converters):
+    return _copy_rows(cursor, copy_statement, _feature_rows(file_path, column_order), converters, file_path)
+
+
+def _copy_rows(cursor, copy_statement, rows, converters, file_path):
+    batch_size = settings.DATASETS_COPY_BATCH_SIZE
+    n_columns = len(converters)
+    n_rows = 0
+    n_rejected = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        buf = StringIO()
+        writer = csv.writer(buf)
+        for row in batch:
+            # pad or truncate ragged rows to the group's columns
+            if len(row) != n_columns:
+                row = (row + [''] * n_columns)[:n_columns]
+            values = [convert(value) for convert, value in zip(converters, row)]
+            n_rejected += sum(1 for value, raw in zip(values, row)
+                              if value is None and raw.strip(' ') and raw.strip(' ') not in NULL_VALUES)
+            writer.writerow(values)
+        buf.seek(0)
+        cursor.copy_expert(copy_statement, buf)
+        n_rows += len(batch)
+    if n_rejected:
+        logger.warning("%s values in %s did not match their column type and were loaded as NULL",
+                       n_rejected, file_path)
+    return n_rows
+
+
+def _data_rows(f, file_path):
+    """
+    :return: an iterator over the rows of a csv file after its header (and NetLogo preamble)
+    """
+    probe = TabularLoader.probe(f, file_path)
+    if probe.is_netlogo:
+        skip = NETLOGO_PREAMBLE_ROWS + 1
+    else:
+        skip = 1 if probe.has_header else 0
+    return itertools.islice(csv.reader(f, delimiter=probe.delimiter), skip, None)
+
+
+def _reordered_rows(rows, column_order):
+    """
+    :param column_order: index in each row of the group's columns, see DataFile.column_order
+    """
+    for row in rows:
+        n_values = len(row)
+        yield [row[i] if i < n_values else '' for i in column_order]
+
+
+def _feature_rows(file_path, column_order=None):
+    """
+    :return: an iterator over the features of a shapefile as rows of utf-8 field values in the order of the group's
+             columns, followed by the feature's geometry as EWKT
+    """
+    layer = DataSource(file_path)[0]
+    fields = layer.fields
+    if column_order is not None:
+        fields = [fields[i] for i in column_order]
+    for feature in layer:
+        row = []
+        for field in fields:
+            value = feature[field].as_string()
+            row.append(value.encode('utf-8') if value is not None else '')
+        geometry = feature.geom
+        row.append(geometry.ewkt if geometry is not None else '')
+        yield row
+
+
+def _to_bigint(value):
+    value = value.strip(' ')
+    if not TabularLoader.PATTERN_BIGINT.match(value) or not BIGINT_MIN <= int(value) <= BIGINT_MAX:
+        return None
+    return value
+
+
+def _to_decimal(value):
+    value = value.strip(' ')
+    return value if TabularLoader.PATTERN_DECIMAL.match(value) else None
+
+
+def _to_boolean(value):
+    match = TabularLoader.PATTERN_BOOLEAN.match(value.strip(' '))
+    return match.group(1).lower() if match else None
+
+
+def _to_timestamp(value, date_format=None):
+    value = value.strip(' ')
+    if not value:
+        return None
+    if date_format:
+        try:
+            return datetime.strptime(value, date_format).isoformat()
+        except ValueError:
+            pass
+    try:
+        return date.parse(value).isoformat()
+    except (ValueError, OverflowError):
+        return None
+
+
+def _to_text(value):
+    try:
+        value.decode('utf-8')
+    except UnicodeDecodeError:
+        value = value.decode('latin-1').encode('utf-8')
+    # postgres text cannot hold NUL characters
+    return value.replace('\x00', '')
+
+
+def _to_geometry(value):
+    return value or None
+
+
+def _converter(column):
+    if column.data_type == 'date' and column.date_format:
+        return lambda value: _to_timestamp(value, column.date_format)
+    return CONVERTERS.get(column.data_type, _to_text)
+
+
+CONVERTERS = {
+    'bigint': _to_bigint,
+    'decimal': _to_decimal,
+    'boolean': _to_boolean,
+    'date': _to_timestamp,
+    'text': _to_text,
+}
@@ -1,6 +1,8 @@
 """
 Explode metadata and group by column metadata
 """
+import hashlib
+import json
 import os
 from os import path
 from . import (ProjectGroupedFilePaths, MetadataDataTableGroup, MetadataDataFile, MetadataAnalysis, MetadataProject)
@@ -48,13 +50,15 @@ def to_datatablegroups(file_group, grouped_datatablegroups, datatablegroups):
     for DataTables and DatasetFiles, MetadataFileGroups are assumed
     to have at most one layer
 
+    Files are grouped by the schema_signature of their columns, so files
+    whose columns only differ in order, case or whitespace share a group.
     Metadata that has one or more columns with a None name is always
     placed in its own group since we do not want the metadata grouper
     to place two files in the same column group simply because they do
     not have column names and have the same number of columns
 
     :type file_group:
-    :type grouped_datatablegroups: dict
+    :type grouped_datatablegroups: dict of schema signature to MetadataDataTableGroup
     :type datatablegroups: list
     :return:
     """
@@ -62,20 +66,24 @@ def to_datatablegroups(file_group, grouped_datatablegroups, datatablegroups):
     layers = file_group.metadata.layers
 
     datafile = MetadataDataFile(name=file_group.title,
-                                path=file_group.group_name)
+                                path=file_group.group_name,
+                                column_statistics=file_group.metadata.properties.get('column_statistics'),
+                                layer_statistics=file_group.metadata.properties.get('layers'),
+                                columns=layers[0][1] if layers else tuple())
     if len(layers) >= 1:
         column_info = layers[0][1]
+        signature = schema_signature(column_info)
 
-        if _has_all_valid_column_names(column_info):
-            has_layer = column_info in grouped_datatablegroups
+        if signature is not None:
+            has_layer = signature in grouped_datatablegroups
             if has_layer:
-                datatablegroup = grouped_datatablegroups[column_info]
+                datatablegroup = grouped_datatablegroups[signature]
                 datatablegroup.datafiles.append(datafile)
             else:
                 datatablegroup = MetadataDataTableGroup(properties=column_info,
                                                         datafiles=[datafile],
                                                         name=datafile.name)
-                grouped_datatablegroups[column_info] = datatablegroup
+                grouped_datatablegroups[signature] = datatablegroup
         else:
             datatablegroup = MetadataDataTableGroup(properties=column_info,
                                                     datafiles=[datafile],
@@ -88,6 +96,48 @@ def to_datatablegroups(file_group, grouped_datatablegroups, datatablegroups):
         datatablegroups.append(datatablegroup)
 
 
+def normalize_column_name(name):
+    """ Lowercase a column name and collapse its whitespace """
+    if name is None:
+        return None
+    if isinstance(name, str):
+        # csv headers are byte strings, OGR field names are unicode
+        name = name.decode('utf-8', 'replace')
+    return u' '.join(name.split()).lower()
+
+
+def schema_signature(columns):
+    """
+    Canonical signature of a column schema: the sha1 of its normalized (name, type) pairs in sorted order, so that
+    schemas only differing in column order, case or whitespace share a signature
+
+    :param columns: (name, type) pairs
+    :return: the hex signature, None for schemas without columns or with unnamed or duplicate columns, which are
+             never grouped with other files
+    """
+    if not columns or not _has_all_valid_column_names(columns):
+        return None
+    names = [normalize_column_name(name) for (name, data_type) in columns]
+    if len(set(names)) != len(names):
+        return None
+    canonical = sorted(zip(names, (data_type for (name, data_type) in columns)))
+    return hashlib.sha1(json.dumps(canonical)).hexdigest()
+
+
+def column_order(columns, group_columns):
+    """
+    Map the columns of a file onto the columns of the group it was placed in, both with the same schema_signature
+
+    :return: the index in columns of each of group_columns, None if they are in the same order
+    """
+    names = [normalize_column_name(name) for (name, data_type) in columns]
+    group_names = [normalize_column_name(name) for (name, data_type) in group_columns]
+    if names == group_names:
+        return None
+    indices = dict((name, i) for (i, name) in enumerate(names))
+    return [indices[name] for name in group_names]
+
+
 def _has_all_valid_column_names(columns):
     for (cname, ctype) in columns:
         if cname is None:
@@ -114,6 +164,13 @@ def _is_file_in_folder(file_group, candidate_folder_name):
     return False
 
 
+def is_loaded(file_group):
+    """
+    :return: whether group_metadata turns the file group into a data table or an analysis
+    """
+    return _in_data_folder(file_group) or _in_src_folder(file_group)
+
+
 def _in_data_folder(metadata_file_group):
     return _is_file_in_folder(metadata_file_group, "data")
 
@@ -5,21 +5,57 @@ Load metadata extracted from a project archive into the database
 import logging
 import requests
 
+from collections import Counter, OrderedDict
 from os import path
 from django.conf import settings
 from django.db import transaction
+from django.utils import timezone
 
 from . import MetadataAnalysis, MetadataDataTableGroup, MetadataProject
-from ..deployr import login, DeployrAPI, response200orError
-from ..models import DataAnalysisScript, DataTableGroup, Project, DataFile, DataColumn
-from .. import utils
+from .grouper import column_order, schema_signature
+from ..deployr import login, DeployrAPI, DeployrUnexpectedStatusCode, response200orError
+from ..models import (AnalysisParameter, DataAnalysisScript, DataTableGroup, Project, DataFile, DataColumn,
+                      EngineSyncOperation, assign_unique_slugs)
 
 logger = logging.getLogger(__name__)
 
+# number of rows inserted per statement by bulk_create
+BULK_BATCH_SIZE = 1000
+
 
 def load_datatablegroups(metadata_datatablegroups, project):
-    for metadata_datatablegroup in metadata_datatablegroups:
-        load_datatablegroup(metadata_datatablegroup, project)
+    """
+    Convert file metadata tagged with the data datatype to DataTableGroups with their DataColumns and DataFiles
+
+    Groups, columns and files are each inserted with bulk_create and group slugs are assigned in bulk, so the number
+    of queries does not grow with the number of files.
+
+    :type metadata_datatablegroups: list[MetadataDataTableGroup]
+    :type project: Project
+    :rtype: list[DataTableGroup]
+    """
+    metadata_datatablegroups = list(metadata_datatablegroups)
+    datatablegroups = [DataTableGroup(name=metadata_datatablegroup.name,
+                                      project=project,
+                                      creator=project.creator,
+                                      schema_signature=schema_signature(metadata_datatablegroup.properties) or '')
+                       for metadata_datatablegroup in metadata_datatablegroups]
+    assign_unique_slugs(datatablegroups)
+    DataTableGroup.objects.bulk_create(datatablegroups, batch_size=BULK_BATCH_SIZE)
+
+    columns = []
+    datafiles = []
+    for datatablegroup, metadata_datatablegroup in zip(datatablegroups, metadata_datatablegroups):
+        group_datafiles = [_datafile(metadata_datafile, datatablegroup, metadata_datatablegroup.properties)
+                           for metadata_datafile in metadata_datatablegroup.datafiles]
+        group_columns = _datatablegroup_columns(metadata_datatablegroup.properties, datatablegroup)
+        _set_column_statistics(group_columns, [datafile.column_statistics for datafile in group_datafiles])
+        columns.extend(group_columns)
+        datafiles.extend(group_datafiles)
+        logger.debug("ADDED DATATABLE GROUP: %s", datatablegroup.name)
+    DataColumn.objects.bulk_create(columns, batch_size=BULK_BATCH_SIZE)
+    DataFile.objects.bulk_create(datafiles, batch_size=BULK_BATCH_SIZE)
+    return datatablegroups
 
 
 def load_datatablegroup(metadata_datatablegroup, project):
@@ -27,22 +63,16 @@ def load_datatablegroup(metadata_datatablegroup, project):
     Convert file metadata tagged with the data datatype to a DataTableGroup and set of DataTables
 
     :type metadata_datatablegroup: MetadataDataTableGroup
-    :type datatablegroupfiles: list[DataFile]
-
     :rtype: DataTableGroup
     """
-
-    datatablegroup = DataTableGroup.objects.create_data_group(name=metadata_datatablegroup.name, project=project)
-    load_datatablegroup_columns(metadata_datatablegroup.properties, datatablegroup)
-    datafiles = []
-    for metadata_datafile in metadata_datatablegroup.datafiles:
-        datatable = load_datafile(metadata_datafile, datatablegroup)
-        datafiles.append(datatable)
-    datatablegroup.tables = datafiles
-    logger.debug("ADDED DATATABLE GROUP: {}".format(datatablegroup.name))
+    return load_datatablegroups([metadata_datatablegroup], project)[0]
 
 
 def load_datatablegroup_columns(metadata_columns, datatablegroup):
+    DataColumn.objects.bulk_create(_datatablegroup_columns(metadata_columns, datatablegroup))
+
+
+def _datatablegroup_columns(metadata_columns, datatablegroup):
     columns = []
     for (table_order, metadata) in enumerate(metadata_columns, start=1):
         name, data_type = metadata
@@ -52,16 +82,78 @@ def load_datatablegroup_columns(metadata_columns, datatablegroup):
                        table_order=table_order,
                        data_type=data_type)
         )
-    DataColumn.objects.bulk_create(columns)
+    return columns
 
 
-def load_datafile(metadata_datafile, datatablegroup):
-    datafile = DataFile.objects.create(data_table_group=datatablegroup,
-                                       project=datatablegroup.project,
-                                       archived_file=metadata_datafile.path)
+def load_datafile(metadata_datafile, datatablegroup, group_columns=None):
+    """
+    :param group_columns: (name, type) pairs of the group's columns that the file's columns are mapped onto
+    """
+    datafile = _datafile(metadata_datafile, datatablegroup, group_columns)
+    datafile.save()
     return datafile
 
 
+def _datafile(metadata_datafile, datatablegroup, group_columns):
+    datafile = DataFile(data_table_group=datatablegroup,
+                        project=datatablegroup.project,
+                        archived_file=metadata_datafile.path)
+    _set_column_layout(datafile, metadata_datafile, group_columns)
+    return datafile
+
+
+def _set_column_layout(datafile, metadata_datafile, group_columns):
+    """
+    Set the order of a DataFile's columns relative to its group and its statistics, with the column statistics in the
+    order of the group's columns
+    """
+    order = None
+    if group_columns and metadata_datafile.columns:
+        order = column_order(metadata_datafile.columns, group_columns)
+    column_statistics = metadata_datafile.column_statistics
+    if order is not None and column_statistics is not None:
+        column_statistics = [column_statistics[i] for i in order]
+    datafile.column_order = order
+    datafile.column_statistics = column_statistics
+    datafile.layer_statistics = metadata_datafile.layer_statistics
+
+
+def update_column_statistics(datatablegroup):
+    """
+    Sum the column statistics of a DataTableGroup's DataFiles into its DataColumns
+
+    A date column keeps a date format only if all of its DataFiles were written in that format.
+    """
+    columns = list(datatablegroup.columns.all())
+    changed_columns = _set_column_statistics(
+        columns, datatablegroup.files.exclude(column_statistics=None).values_list('column_statistics', flat=True))
+    for column in changed_columns:
+        column.save(update_fields=['empty_count', 'null_count', 'date_format'])
+
+
+def _set_column_statistics(columns, datafile_column_statistics):
+    """
+    :param datafile_column_statistics: the column_statistics of each DataFile, None for files without any
+    :return: the columns whose statistics changed
+    """
+    totals = [Counter() for _ in columns]
+    date_formats = [set() for _ in columns]
+    for column_statistics in datafile_column_statistics:
+        if column_statistics is None:
+            continue
+        for total, formats, statistics in zip(totals, date_formats, column_statistics):
+            total.update(empty=statistics['empty'], null=statistics['null'])
+            formats.add(statistics.get('date_format'))
+    changed_columns = []
+    for column, total, formats in zip(columns, totals, date_formats):
+        date_format = formats.pop() if len(formats) == 1 and column.data_type == DataColumn.DataType.date else None
+        values = (total['empty'], total['null'], date_format or '')
+        if (column.empty_count, column.null_count, column.date_format) != values:
+            column.empty_count, column.null_count, column.date_format = values
+            changed_columns.append(column)
+    return changed_columns
+
+
 def load_analysis(metadata_analysis, project):
     """
     Convert raw analysis metadata to an appropriately parameterized DataAnalysisScript
@@ -74,6 +166,10 @@ def load_analysis(metadata_analysis, project):
     :return: an Analysis
     :rtype: Analysis
     """
+    return load_analyses([metadata_analysis], project)[0]
+
+
+def _file_type(metadata_analysis):
     base_dir, filename = path.split(metadata_analysis.path)
     name, ext = path.splitext(filename)
     ext = ext.lower()
@@ -87,37 +183,159 @@ def load_analysis(metadata_analysis, project):
         file_type = "Python"
     elif ext == ".pl":
         file_type = "Perl"
-
-    data_analysis_script = project.analyses.create(name=metadata_analysis.name,
-                                                   creator=project.creator,
-                                                   archived_file=metadata_analysis.path,
-                                                   file_type=file_type,
-                                                   enabled=True)
-    data_analysis_script.add_parameters(metadata_analysis.parameters)
+    return file_type
 
 
 def load_analyses(metadata_analyses, project):
-    """Load analyses into database"""
-    for metadata_analysis in metadata_analyses:
-        load_analysis(metadata_analysis, project)
+    """Load analyses and their parameters into database with one bulk insert each"""
+    metadata_analyses = list(metadata_analyses)
+    analyses = [DataAnalysisScript(name=metadata_analysis.name,
+                                   project=project,
+                                   creator=project.creator,
+                                   archived_file=metadata_analysis.path,
+                                   file_type=_file_type(metadata_analysis),
+                                   enabled=True)
+                for metadata_analysis in metadata_analyses]
+    assign_unique_slugs(analyses)
+    DataAnalysisScript.objects.bulk_create(analyses, batch_size=BULK_BATCH_SIZE)
+    AnalysisParameter.objects.bulk_create(
+        [AnalysisParameter(analysis=analysis, **DataAnalysisScript._parameter_fields(parameter))
+         for analysis, metadata_analysis in zip(analyses, metadata_analyses)
+         for parameter in metadata_analysis.parameters],
+        batch_size=BULK_BATCH_SIZE)
+    return analyses
+
 
+def load_deployr(metadata_analyses, project, create_working_directory=True):
+    """
+    Record the deployr calls that load the analyses into deployr (and make the deployr project) in the engine sync
+    outbox
+
+    Run this in the transaction loading the analyses: the calls are made by sync_deployr once it has committed, so
+    that no transaction is held open on the network and a deployr outage does not roll back the metadata.
+    """
+    operations = []
+    if create_working_directory:
+        operations.append(EngineSyncOperation(project=project,
+                                              operation=EngineSyncOperation.Operation.create_working_directory))
+    operations.extend(EngineSyncOperation(project=project,
+                                          operation=EngineSyncOperation.Operation.upload_script,
+                                          path=metadata_analysis.path)
+                      for metadata_analysis in metadata_analyses)
+    EngineSyncOperation.objects.bulk_create(operations, batch_size=BULK_BATCH_SIZE)
+    return operations
 
-def load_deployr(metadata_analyses, project):
-    """Load analyses into deployr and make deployr project"""
+
+def sync_deployr(project=None):
+    """
+    Make the deployr calls recorded in the engine sync outbox that are due, for all projects or a single one
+
+    Failed calls are left in the outbox to be retried with exponential backoff by a later sync. Operations are claimed
+    before they are attempted so that syncs running at the same time never make the same call twice.
+
+    :return: the number of operations attempted
+    """
+    operations = EngineSyncOperation.objects.due().select_related('project')
+    if project is not None:
+        operations = operations.filter(project=project)
+    operations_by_project = OrderedDict()
+    for operation in operations:
+        if not operation.claim():
+            continue
+        operations_by_project.setdefault(operation.project, []).append(operation)
+    for operation_project, project_operations in operations_by_project.items():
+        _sync_project(operation_project, project_operations)
+    return sum(len(project_operations) for project_operations in operations_by_project.values())
+
+
+def pending_deployr_operations(project=None):
+    pending = EngineSyncOperation.objects.pending()
+    if project is not None:
+        pending = pending.filter(project=project)
+    return pending
+
+
+def _sync_project(project, operations):
+    working_directories = [operation for operation in operations
+                           if operation.operation == EngineSyncOperation.Operation.create_working_directory]
+    # a script changed by several ingests before the sync only needs to be uploaded once
+    uploads_by_path = OrderedDict()
+    for operation in operations:
+        if operation.operation == EngineSyncOperation.Operation.upload_script:
+            uploads_by_path.setdefault(operation.path, []).append(operation)
+    done = []
+    # operations that failed or were dropped on their own
+    settled = []
     try:
         with login() as session:
-            response = DeployrAPI.create_working_directory(project.slug, session)
-            response200orError(response)
-        for metadata_analysis in metadata_analyses:
-            response = DeployrAPI.upload_script(metadata_analysis.path,
+            if working_directories:
+                try:
+                    response200orError(DeployrAPI.create_working_directory(project.slug, session))
+                except Exception as e:
+                    logger.exception("could not create the deployr working directory of project %s", project)
+                    for operation in working_directories:
+                        operation.record_failure(e)
+                    # the scripts cannot be uploaded without the working directory, retry them along with it
+                    upload_ids = [operation.pk for operations in uploads_by_path.values() for operation in operations]
+                    EngineSyncOperation.objects.filter(pk__in=upload_ids).update(
+                        status=EngineSyncOperation.Status.pending,
+                        next_attempt=max(operation.next_attempt for operation in working_directories))
+                    return
+                done.extend(working_directories)
+            script_paths = []
+            for script_path, script_operations in uploads_by_path.items():
+                if _script_exists(project, script_path, script_operations):
+                    script_paths.append(script_path)
+                else:
+                    settled.extend(script_operations)
+            uploads = DeployrAPI.upload_scripts([path.join(project.project_path, script_path)
+                                                 for script_path in script_paths],
                                                 project.slug,
                                                 session)
-            response200orError(response)
-    except requests.exceptions.ConnectionError:
+            for script_path, upload in zip(script_paths, uploads):
+                try:
+                    response200orError(upload.response)
+                except Exception as e:
+                    for operation in uploads_by_path[script_path]:
+                        operation.record_failure(e)
+                    settled.extend(uploads_by_path[script_path])
+                else:
+                    done.extend(uploads_by_path[script_path])
+            if uploads:
+                logger.debug("uploaded %s scripts, slowest took %.3fs", len(uploads),
+                             max(upload.seconds for upload in uploads))
+    except (requests.exceptions.RequestException, DeployrUnexpectedStatusCode, IOError) as e:
         logger.exception(
             "CONNECTION ERROR: the deployr server must be running and have a user " +
             "matching the deployr username (DEFAULT_DEPLOYR_USER) and password (DEFAULT_DEPLOYR_PASSWORD)")
-        raise
+        settled_ids = set(operation.pk for operation in done + settled)
+        for operation in operations:
+            if operation.pk not in settled_ids:
+                operation.record_failure(e)
+    finally:
+        EngineSyncOperation.objects.filter(pk__in=[operation.pk for operation in done]).update(
+            status=EngineSyncOperation.Status.done, date_completed=timezone.now())
+
+
+def _script_exists(project, script_path, operations):
+    """
+    Check that a script is still in the project folder before uploading it. Uploads of scripts whose analysis was
+    retired are dropped, those of scripts that should be there fail on their own without failing the whole batch.
+
+    :return: whether the script can be uploaded
+    """
+    if path.isfile(path.join(project.project_path, script_path)):
+        return True
+    operation_ids = [operation.pk for operation in operations]
+    if not project.analyses.filter(archived_file=script_path).exists():
+        logger.debug("dropping upload of retired script %s of project %s", script_path, project)
+        EngineSyncOperation.objects.filter(pk__in=operation_ids).delete()
+    else:
+        logger.error("script %s of project %s is missing", script_path, project)
+        error = IOError("script {} is missing".format(script_path))
+        for operation in operations:
+            operation.record_failure(error)
+    return False
 
 
 def load_project(metadata_project):
@@ -125,6 +343,8 @@ def load_project(metadata_project):
     Load all the extracted file metadata into the database
 
     :type metadata_project: MetadataProject
+    :return: the loaded project
+    :rtype: Project
     """
 
     metadata_analyses = metadata_project.analyses
@@ -134,5 +354,134 @@ def load_project(metadata_project):
     with transaction.atomic():
         load_analyses(metadata_analyses, project)
         load_datatablegroups(metadata_datatablegroups, project)
-        with utils.Chdir(project.project_path):
-            load_deployr(metadata_analyses, project)
+        load_deployr(metadata_analyses, project)
+    return project
+
+
+def update_project(metadata_project, diff):
+    """
+    Apply an incremental re-ingest of a project's archive to the database
+
+    Only the files that were added or changed (and the file groups they belong to) are expected in metadata_project.
+    DataFiles and analyses for removed files are retired. A changed DataFile stays in its DataTableGroup, keeping any
+    DataColumn edits, as long as its column schema is unchanged. Changed analyses keep their AnalysisOutputs and have
+    their parameters updated in place.
+
+    :type metadata_project: MetadataProject
+    :type diff: ProjectManifestDiff
+    """
+    project = Project.objects.get(slug=metadata_project.project_token)
+    with transaction.atomic():
+        update_analyses(metadata_project.analyses, diff.removed, project)
+        return update_datatablegroups(metadata_project.datatablegroups, diff.removed, project)
+
+
+def update_analyses(metadata_analyses, removed_paths, project):
+    analyses = dict((analysis.archived_file.name, analysis) for analysis in project.analyses.all())
+    for removed_path in removed_paths:
+        if removed_path in analyses:
+            logger.debug("RETIRED ANALYSIS: %s", removed_path)
+            analyses[removed_path].delete()
+            # the script is gone, there is nothing left to upload
+            EngineSyncOperation.objects.pending().filter(
+                project=project, operation=EngineSyncOperation.Operation.upload_script, path=removed_path).delete()
+    new_analyses = []
+    for metadata_analysis in metadata_analyses:
+        analysis = analyses.get(metadata_analysis.path)
+        if analysis is None:
+            new_analyses.append(metadata_analysis)
+        else:
+            analysis.update_parameters(metadata_analysis.parameters)
+    load_analyses(new_analyses, project)
+
+
+def update_datatablegroups(metadata_datatablegroups, removed_paths, project):
+    """
+    :return: the DataTableGroups whose DataFiles changed and whose rows need to be loaded again
+    """
+    datafiles = dict((datafile.archived_file.name, datafile)
+                     for datafile in project.files.select_related('data_table_group'))
+    changed_datatablegroup_ids = set()
+    for removed_path in removed_paths:
+        if removed_path in datafiles:
+            changed_datatablegroup_ids.add(datafiles[removed_path].data_table_group_id)
+            _retire_datafile(datafiles[removed_path])
+
+    schemas = {}
+    # groups loaded before schema signatures were recorded
+    for datatablegroup in project.data_table_groups.filter(schema_signature=''):
+        signature = schema_signature(_schema(datatablegroup, schemas))
+        if signature is not None:
+            datatablegroup.schema_signature = signature
+            datatablegroup.save(update_fields=['schema_signature'])
+
+    new_datatablegroups = []
+    new_datafiles = []
+    for metadata_datatablegroup in metadata_datatablegroups:
+        pending_datafiles = []
+        signature = schema_signature(metadata_datatablegroup.properties)
+        for metadata_datafile in metadata_datatablegroup.datafiles:
+            datafile = datafiles.get(metadata_datafile.path)
+            if datafile is not None:
+                datatablegroup = datafile.data_table_group
+                if datatablegroup is not None and _has_schema(datatablegroup, metadata_datatablegroup.properties,
+                                                              signature, schemas):
+                    _set_column_layout(datafile, metadata_datafile, _schema(datatablegroup, schemas))
+                    datafile.save(update_fields=['column_order', 'column_statistics', 'layer_statistics'])
+                    changed_datatablegroup_ids.add(datatablegroup.pk)
+                    continue
+                changed_datatablegroup_ids.add(datafile.data_table_group_id)
+                _retire_datafile(datafile)
+            pending_datafiles.append(metadata_datafile)
+        if not pending_datafiles:
+            continue
+
+        datatablegroup = _find_datatablegroup(signature, project)
+        if datatablegroup is None:
+            new_datatablegroups.append(metadata_datatablegroup._replace(datafiles=pending_datafiles))
+        else:
+            new_datafiles.extend(_datafile(metadata_datafile, datatablegroup, _schema(datatablegroup, schemas))
+                                 for metadata_datafile in pending_datafiles)
+            changed_datatablegroup_ids.add(datatablegroup.pk)
+    DataFile.objects.bulk_create(new_datafiles, batch_size=BULK_BATCH_SIZE)
+    changed_datatablegroup_ids.discard(None)
+    # retired groups are gone and drop out of the queryset
+    for datatablegroup in project.data_table_groups.filter(pk__in=changed_datatablegroup_ids):
+        update_column_statistics(datatablegroup)
+    # new groups get their column statistics as they are loaded
+    changed_datatablegroup_ids.update(datatablegroup.pk for datatablegroup in
+                                      load_datatablegroups(new_datatablegroups, project))
+    return project.data_table_groups.filter(pk__in=changed_datatablegroup_ids)
+
+
+def _retire_datafile(datafile):
+    logger.debug("RETIRED DATAFILE: %s", datafile.archived_file.name)
+    datatablegroup = datafile.data_table_group
+    datafile.delete()
+    if datatablegroup is not None and not datatablegroup.files.exists():
+        logger.debug("RETIRED DATATABLE GROUP: %s", datatablegroup.name)
+        datatablegroup.delete()
+
+
+def _schema(datatablegroup, schemas):
+    if datatablegroup.pk not in schemas:
+        schemas[datatablegroup.pk] = tuple((column.name or None, column.data_type)
+                                           for column in datatablegroup.columns.all())
+    return schemas[datatablegroup.pk]
+
+
+def _has_schema(datatablegroup, column_info, signature, schemas):
+    if signature is not None:
+        return datatablegroup.schema_signature == signature
+    # schemas with unnamed columns have no signature and only match exactly
+    return _schema(datatablegroup, schemas) == tuple(column_info)
+
+
+def _find_datatablegroup(signature, project):
+    """
+    Find an existing DataTableGroup in the project with the given schema signature. Schemas with unnamed columns have
+    no signature and never match, consistent with grouper.to_datatablegroups.
+    """
+    if signature is None:
+        return None
+    return project.data_table_groups.filter(schema_signature=signature).order_by('pk').first()
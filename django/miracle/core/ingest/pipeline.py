@@ -1,27 +1,133 @@
 import os
 import shutil
 
-from .unarchiver import extract
-from .analyzer import group_files
+from django.conf import settings
+from django.db import transaction
+
+from .unarchiver import extract, stage_update, commit_update, discard_update, revert_update
+from .analyzer import group_files, related_paths
 from .grouper import group_metadata
-from .loader import load_project
-from . import ProjectDirectoryAlreadyExists
+from .loader import load_project, load_deployr, update_project
+from .datasets import load_datasets, load_datatablegroups_rows
+from . import checkpoint, ProjectDirectoryAlreadyExists, ProjectFilePaths
+from ..models import Blob
+
+# pipeline stages in order, each stage consumes the checkpointed output of the previous one
+STAGES = ('extract', 'group_files', 'group_metadata', 'load_project', 'load_datasets')
+
+STAGE_FUNCTIONS = {
+    'group_files': group_files,
+    'group_metadata': group_metadata,
+    'load_project': load_project,
+    'load_datasets': load_datasets,
+}
 
 
 def run(project, archive, delete_archive_on_failure):
+    for stage in STAGES:
+        run_stage(project, stage, archive, delete_archive_on_failure)
+
+
+def resume(project):
+    """
+    Run the stages of a failed ingest that have not completed yet
+    """
+    for stage in remaining_stages(project):
+        run_stage(project, stage)
+
+
+def remaining_stages(project):
+    """
+    :return: the stages after the last checkpointed stage of an incomplete ingest
+    """
+    for i in reversed(range(len(STAGES))):
+        if checkpoint.exists(project, STAGES[i]):
+            return STAGES[i + 1:]
+    return STAGES
+
+
+def is_incomplete(project):
+    """
+    :return: whether an ingest of the project stopped partway, failing or crashing, and can be resumed or discarded.
+             Ingests still running are not incomplete unless their last stage started more than
+             METADATA_PIPELINE_STALE_SECONDS ago, i.e. their worker died.
+    """
+    if not checkpoint.exists(project):
+        return False
+    state, age = checkpoint.get_state(project)
+    return state != checkpoint.RUNNING or age > settings.METADATA_PIPELINE_STALE_SECONDS
+
+
+def is_running(project):
+    return checkpoint.exists(project) and not is_incomplete(project)
+
+
+def run_stage(project, stage, archive=None, delete_archive_on_failure=False):
+    """
+    Run a single pipeline stage on the checkpoint of the previous stage and checkpoint its output
+
+    A failed extract cleans up everything. Failures in later stages keep the extracted project and the
+    checkpoints of the completed stages so that the ingest can be resumed.
+    """
     try:
-        project_file_paths = extract(project, archive)
-        project_grouped_file_paths = group_files(project_file_paths)
-        metadata_project = group_metadata(project_grouped_file_paths)
-        load_project(metadata_project)
+        if stage == STAGES[0]:
+            output = extract(project, archive)
+        else:
+            checkpoint.set_state(project, checkpoint.RUNNING)
+            previous_output = checkpoint.load(project, STAGES[STAGES.index(stage) - 1])
+            output = STAGE_FUNCTIONS[stage](previous_output)
+        if stage == STAGES[-1]:
+            checkpoint.clear(project)
+        else:
+            checkpoint.save(project, stage, output)
+        return output
     except ProjectDirectoryAlreadyExists:
         if delete_archive_on_failure:
             if os.path.exists(archive):
                 os.unlink(archive)
         raise
     except Exception:
-        cleanup_on_error(project, archive, delete_archive_on_failure)
+        if stage == STAGES[0]:
+            cleanup_on_error(project, archive, delete_archive_on_failure)
+        else:
+            checkpoint.set_state(project, checkpoint.FAILED)
+        raise
+
+
+def update(project, archive, delete_archive_on_failure):
+    """
+    Incrementally re-ingest a new archive for an already ingested project
+
+    Only files that were added or changed since the last ingest are analyzed and loaded again.
+    """
+    staged_update = stage_update(project, archive)
+    swaps = []
+    try:
+        diff = staged_update.diff
+        changed_paths = related_paths(diff.added + diff.changed + diff.removed, staged_update.paths)
+        project_file_paths = ProjectFilePaths(project_token=project.slug, paths=changed_paths)
+        digests = dict((os.path.relpath(full_path, staged_update.project_folder), digest)
+                       for full_path, (digest, size) in staged_update.digests.items())
+        project_grouped_file_paths = group_files(project_file_paths, project_folder=staged_update.project_folder,
+                                                 digests=digests)
+        metadata_project = group_metadata(project_grouped_file_paths)
+        with transaction.atomic():
+            changed_datatablegroups = update_project(metadata_project, diff)
+            load_deployr(metadata_project.analyses, project, create_working_directory=False)
+            swaps = commit_update(project, staged_update)
+            # the previous archive is kept until the update commits
+            transaction.on_commit(project.retire_previous_archives)
+    except Exception:
+        if swaps:
+            revert_update(project, swaps)
+        if delete_archive_on_failure:
+            if os.path.exists(archive):
+                os.unlink(archive)
+            project.restore_previous_archive()
         raise
+    finally:
+        discard_update(staged_update)
+    load_datatablegroups_rows(changed_datatablegroups, project)
 
 
 def cleanup_on_error(project, archive_path, delete_archive_on_failure):
@@ -31,6 +137,9 @@ def cleanup_on_error(project, archive_path, delete_archive_on_failure):
     if delete_archive_on_failure:
         if os.path.exists(archive_path):
             os.unlink(archive_path)
+        project.restore_previous_archive()
+    checkpoint.clear(project)
+    Blob.objects.release_project_files(project)
     if os.path.exists(project_path):
         shutil.rmtree(project_path)
     if os.path.exists(packrat_path):
@@ -0,0 +1,135 @@
+"""
+Band statistics and overview pyramids for the raster DataFiles of a project
+
+GDALLoader only reads a raster's header at ingest. Once the project is loaded a background task computes the min,
+max, mean, standard deviation, nodata value and histogram of every band and builds overviews (downsampled copies
+that GDAL keeps in a .ovr file next to the raster) so that previews never have to decode the full raster.
+The statistics are stored in DataFile.layer_statistics, one entry per band.
+"""
+
+import logging
+from ctypes import c_char_p, c_double, c_int, c_void_p, POINTER
+from os import path
+
+from django.contrib.gis.gdal import GDALRaster, GDALException
+from django.contrib.gis.gdal.libgdal import lgdal
+
+from .analyzer import CONSTRUCTOR_FORMATS, GDALLoader, sanitize_ext
+
+logger = logging.getLogger(__name__)
+
+RASTER_EXTENSIONS = CONSTRUCTOR_FORMATS[GDALLoader.from_file]
+
+# overviews are halved in size until the larger dimension fits within OVERVIEW_MIN_SIZE pixels
+OVERVIEW_MIN_SIZE = 256
+OVERVIEW_RESAMPLING = 'AVERAGE'
+HISTOGRAM_BINS = 64
+
+# GDAL functions not wrapped by django.contrib.gis.gdal
+_build_overviews = lgdal.GDALBuildOverviews
+_build_overviews.argtypes = [c_void_p, c_char_p, c_int, POINTER(c_int), c_int, POINTER(c_int), c_void_p, c_void_p]
+_build_overviews.restype = c_int
+
+_get_histogram = lgdal.GDALGetRasterHistogram
+_get_histogram.argtypes = [c_void_p, c_double, c_double, c_int, POINTER(c_int), c_int, c_int, c_void_p, c_void_p]
+_get_histogram.restype = c_int
+
+
+def process_rasters(project, refresh=False):
+    """
+    Compute band statistics and build overviews for the raster DataFiles of a project
+
+    :type project: miracle.core.models.Project
+    :param refresh: also process rasters that already have statistics and overviews
+    :return: the number of rasters processed
+    """
+    n_rasters = 0
+    for datafile in project.files.filter(ignored=False):
+        if sanitize_ext(path.splitext(datafile.archived_file.name)[1]) not in RASTER_EXTENSIONS:
+            continue
+        file_path = path.join(project.project_path, datafile.archived_file.name)
+        if not (refresh or needs_processing(datafile.layer_statistics, file_path)):
+            continue
+        try:
+            datafile.layer_statistics = raster_statistics(file_path)
+        except GDALException:
+            logger.exception("could not compute statistics for raster %s", file_path)
+            continue
+        datafile.save(update_fields=['layer_statistics'])
+        n_rasters += 1
+    return n_rasters
+
+
+def needs_processing(layer_statistics, file_path):
+    """
+    Rasters need processing until they have statistics, and again when their overviews have gone missing since the
+    project folder, .ovr files included, is replaced by the extracted archive on every incremental update
+    """
+    if layer_statistics is None:
+        return True
+    has_overviews = any(band.get("overviews") for band in layer_statistics)
+    return has_overviews and not path.exists(file_path + ".ovr")
+
+
+def raster_statistics(file_path):
+    """
+    Build the overviews of a raster and compute the statistics of its bands
+
+    :return: a list with a dict of statistics for each band
+    """
+    raster = GDALRaster(file_path)
+    factors = build_overviews(raster)
+    return [band_statistics(band, factors) for band in raster.bands]
+
+
+def overview_factors(width, height):
+    factors = []
+    factor = 2
+    while max(width, height) // factor >= OVERVIEW_MIN_SIZE:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def build_overviews(raster):
+    """
+    :type raster: GDALRaster
+    :return: the reduction factors of the overviews built, empty for rasters small enough to preview as they are
+    """
+    factors = overview_factors(raster.width, raster.height)
+    if factors:
+        # on a raster opened read only GDAL writes the overviews to an external .ovr file
+        error = _build_overviews(raster.ptr, OVERVIEW_RESAMPLING, len(factors), (c_int * len(factors))(*factors),
+                                 0, None, None, None)
+        if error:
+            raise GDALException("could not build overviews for {}".format(raster.name))
+    return factors
+
+
+def band_statistics(band, overview_factors=()):
+    minimum, maximum, mean, std = band.statistics()
+    statistics = {"description": band.description or None,
+                  "min": minimum,
+                  "max": maximum,
+                  "mean": mean,
+                  "std": std,
+                  "nodata": band.nodata_value,
+                  "histogram": None,
+                  "overviews": list(overview_factors)}
+    if minimum is not None:
+        statistics["histogram"] = {"min": minimum,
+                                   "max": maximum,
+                                   "counts": histogram(band, minimum, maximum)}
+    return statistics
+
+
+def histogram(band, minimum, maximum, bins=HISTOGRAM_BINS):
+    """
+    :return: counts of the band's values in equal width bins between minimum and maximum, nodata values excluded
+    """
+    counts = (c_int * bins)()
+    # include out of range values so that values equal to maximum land in the last bin
+    error = _get_histogram(band.ptr, minimum, maximum, bins, counts, 1, 0, None, None)
+    if error:
+        raise GDALException("could not compute the histogram of band {}".format(band.description))
+    return list(counts)
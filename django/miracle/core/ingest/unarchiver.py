@@ -1,22 +1,41 @@
 from os import path
 import os
+import posixpath
 import shutil
 import pyunpack
-from ...core import utils
+import tarfile
 import tempfile
+import time
+import zipfile
+from ...core import utils
 import logging
 
 from django.conf import settings
+from django.db import transaction
 
-from . import ProjectFilePaths, PackratException, ProjectDirectoryAlreadyExists
-from ..models import Project
+from . import (ArchiveMember, ProjectFilePaths, ProjectManifestDiff, StagedProjectUpdate, ExtractionStats,
+               PackratException, ProjectDirectoryAlreadyExists)
+from .. import blobstore
+from ..models import Blob, Project
 
 logger = logging.getLogger(__name__)
 
+# size of the buffer used when streaming archive members to disk
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# size of a zip local file header without the file name and extra field
+ZIP_LOCAL_HEADER_SIZE = 30
+# members smaller than this are not checked for their compression ratio, tiny files of repeated bytes are common
+MIN_BOMB_CHECK_SIZE = 1024 * 1024
+
+
 def extract(project, archive):
     """
     Extract a project archive into the project folder
 
+    The archive is unpacked into a staging folder inside the projects folder so that
+    moving the extracted project into place is a rename on the same filesystem
+
     :param project: a project to associate the archive with
     :type project: miracle.core.models.Project
     :param archive: a path to an archive file
@@ -29,38 +48,195 @@ def extract(project, archive):
     projects_folder = settings.PROJECT_DIRECTORY
     packrat_folder =  settings.PACKRAT_DIRECTORY
 
-    tmpfolder = tempfile.mkdtemp()
     token = project.slug
     _check_already_exists(projects_folder, token)
     _check_already_exists(packrat_folder, token)
 
+    stagingfolder = _make_staging_folder()
+    digests = {}
     try:
-        _unpack(archive, tmpfolder)
-
-        files = os.listdir(tmpfolder)
-        if len(files) != 1:
-            raise PackratException("root folder is not unique. contains {}".format(files.__str__()))
-
-        project_folder = path.join(tmpfolder, files[0])
-        if not path.isdir(project_folder):
-            raise PackratException("root {} is not a folder".format(projects_folder))
-
-        project_folder_contents = os.listdir(project_folder)
-        logger.debug("project folder contents: %s", project_folder_contents)
-        if "packrat" not in project_folder_contents:
-            raise PackratException("no Packrat folder")
-        if token not in project_folder_contents:
-            raise PackratException("no project folder named {} exists".format(token))
-
-        _validate_project_structure(project_folder, token)
-        project_folder_src, paths = _get_and_add_paths(project, token, project_folder)
+        project_folder = _unpack_and_validate(archive, stagingfolder, token, digests)
+        project_folder_src, paths = _get_and_add_paths(project, token, project_folder, digests)
         _move_project_to_projects(project_folder_src, projects_folder)
         _move_packrat_to_packrats(project_folder_src, settings.PACKRAT_DIRECTORY)
 
         return ProjectFilePaths(project_token=token, paths=paths)
 
     finally:
-        _cleanup(tmpfolder)
+        _cleanup(stagingfolder)
+
+
+def validate_archive(archive, token):
+    """
+    Check the layout and size of a zip or tar archive from its member index alone, before
+    anything is decompressed to disk
+
+    The archive must contain a single root folder with a packrat folder and a project folder
+    named after the project token, and the project folder must contain src and data folders.
+    Archives exceeding ARCHIVE_MAX_MEMBERS or ARCHIVE_MAX_UNCOMPRESSED_SIZE, with members
+    outside the archive root, or that look like decompression bombs are rejected as well.
+
+    Other archive formats are only validated after they have been unpacked.
+
+    :param archive: a path to an archive file or a seekable file object
+    :param token: the project slug
+    :raises PackratException: if the archive is invalid
+    """
+    start = time.time()
+    members = _read_index(archive)
+    if members is None:
+        logger.debug("cannot read the index of %s, skipping pre-flight validation", archive)
+        return
+    _validate_index_limits(members, _archive_size(archive))
+    _validate_index_layout(members, token)
+    logger.debug("validated index of %s (%s members) in %.3fs", archive, len(members), time.time() - start)
+
+
+def stage_update(project, archive):
+    """
+    Extract a new archive for an already ingested project into a staging folder and compare
+    its manifest with the one stored for the project
+
+    Nothing in the project folder or the database is modified until the staged update is
+    passed to commit_update. Pass it to discard_update when done with it.
+
+    :type project: miracle.core.models.Project
+    :param archive: a path to an archive file
+    :type archive: str
+
+    :rtype: StagedProjectUpdate
+    """
+    token = project.slug
+    stagingfolder = _make_staging_folder()
+    digests = {}
+    try:
+        project_folder = _unpack_and_validate(archive, stagingfolder, token, digests)
+        project_folder_src = path.join(project_folder, token)
+        paths = _extract_files(project_folder_src)
+        manifest = {}
+        for file_path in paths:
+            full_path = path.join(project_folder_src, file_path)
+            if full_path not in digests:
+                digests[full_path] = blobstore.hash_file(full_path)
+            manifest[file_path] = digests[full_path]
+        stored_manifest = dict((entry.path, (entry.blob_id, entry.blob.size))
+                               for entry in project.manifest.select_related('blob'))
+        diff = _diff_manifests(stored_manifest, manifest)
+        logger.debug("staged update of %s: %s added, %s changed, %s removed, %s unchanged", token,
+                     len(diff.added), len(diff.changed), len(diff.removed), len(diff.unchanged))
+        return StagedProjectUpdate(project_token=token,
+                                   staging_folder=stagingfolder,
+                                   project_folder=project_folder_src,
+                                   paths=paths,
+                                   digests=digests,
+                                   diff=diff)
+    except Exception:
+        _cleanup(stagingfolder)
+        raise
+
+
+def commit_update(project, staged_update):
+    """
+    Replace the project's manifest and extracted files with the staged ones
+
+    Analysis outputs stored in the current project folder are carried over to the new one.
+
+    Call this in a transaction: the replaced folders are only removed once it commits. Pass the returned swaps to
+    revert_update if it rolls back instead.
+
+    :type project: miracle.core.models.Project
+    :type staged_update: StagedProjectUpdate
+    :return: list of (folder, retired folder holding what it replaced or None) pairs
+    """
+    project_folder_src = staged_update.project_folder
+    Blob.objects.replace_project_files(project, project_folder_src, staged_update.paths, staged_update.digests)
+
+    outputs_folder = path.join(project.project_path, 'outputs')
+    if path.isdir(outputs_folder):
+        if path.exists(path.join(project_folder_src, 'outputs')):
+            logger.warning("archive for %s contains an outputs folder, discarding previous outputs", project)
+        else:
+            os.rename(outputs_folder, path.join(project_folder_src, 'outputs'))
+
+    swaps = [(project.project_path, _swap_folder(project_folder_src, project.project_path)),
+             (project.packrat_path, _swap_folder(path.join(path.dirname(project_folder_src), 'packrat'),
+                                                 project.packrat_path))]
+    transaction.on_commit(lambda: [_cleanup(retired) for folder, retired in swaps if retired])
+    return swaps
+
+
+def revert_update(project, swaps):
+    """
+    Put back the folders replaced by commit_update after its transaction rolled back
+    """
+    for folder, retired in swaps:
+        if retired is None:
+            _cleanup(folder)
+            continue
+        previous_folder = path.join(retired, path.basename(folder))
+        outputs_folder = path.join(folder, 'outputs')
+        if folder == project.project_path and path.isdir(outputs_folder) and \
+                not path.exists(path.join(previous_folder, 'outputs')):
+            os.rename(outputs_folder, path.join(previous_folder, 'outputs'))
+        _cleanup(folder)
+        os.rename(previous_folder, folder)
+        _cleanup(retired)
+
+
+def discard_update(staged_update):
+    _cleanup(staged_update.staging_folder)
+
+
+def _diff_manifests(stored_manifest, manifest):
+    """
+    :param stored_manifest: dict of path to (digest, size) for the currently ingested files
+    :param manifest: dict of path to (digest, size) for the newly extracted files
+    :rtype: ProjectManifestDiff
+    """
+    added = []
+    changed = []
+    unchanged = []
+    for file_path, digest_size in manifest.iteritems():
+        if file_path not in stored_manifest:
+            added.append(file_path)
+        elif stored_manifest[file_path] != digest_size:
+            changed.append(file_path)
+        else:
+            unchanged.append(file_path)
+    removed = [file_path for file_path in stored_manifest if file_path not in manifest]
+    return ProjectManifestDiff(added=added, changed=changed, removed=removed, unchanged=unchanged)
+
+
+def _make_staging_folder():
+    return tempfile.mkdtemp(prefix='.staging-', dir=path.expanduser(settings.PROJECT_DIRECTORY))
+
+
+def _unpack_and_validate(archive, stagingfolder, token, digests):
+    """
+    Unpack the archive into the staging folder and check that it has the expected layout
+
+    :return: the unique root folder of the archive
+    """
+    validate_archive(archive, token)
+    _unpack(archive, stagingfolder, digests)
+
+    files = os.listdir(stagingfolder)
+    if len(files) != 1:
+        raise PackratException("root folder is not unique. contains {}".format(files.__str__()))
+
+    project_folder = path.join(stagingfolder, files[0])
+    if not path.isdir(project_folder):
+        raise PackratException("root {} is not a folder".format(files[0]))
+
+    project_folder_contents = os.listdir(project_folder)
+    logger.debug("project folder contents: %s", project_folder_contents)
+    if "packrat" not in project_folder_contents:
+        raise PackratException("no Packrat folder")
+    if token not in project_folder_contents:
+        raise PackratException("no project folder named {} exists".format(token))
+
+    _validate_project_structure(project_folder, token)
+    return project_folder
 
 
 def _check_already_exists(folder, slug):
@@ -88,9 +264,144 @@ def _validate_project_structure(project_folder, token):
         raise PackratException(error_message)
 
 
-def _get_and_add_paths(project, token, project_folder):
+def _read_index(archive):
+    """
+    :return: the ArchiveMembers of a zip or tar archive, None for other formats
+    """
+    if zipfile.is_zipfile(archive):
+        members = _read_zip_index(archive)
+    elif _is_tarfile(archive):
+        members = _read_tar_index(archive)
+    else:
+        members = None
+    if hasattr(archive, 'seek'):
+        archive.seek(0)
+    return members
+
+
+def _is_tarfile(archive):
+    if not hasattr(archive, 'seek'):
+        return tarfile.is_tarfile(archive)
+    archive.seek(0)
+    try:
+        with tarfile.open(fileobj=archive, mode='r|*'):
+            return True
+    except tarfile.TarError:
+        return False
+
+
+def _read_zip_index(archive):
+    # only reads the central directory at the end of the file
+    with zipfile.ZipFile(archive) as zf:
+        return [ArchiveMember(name=_member_name(info.filename),
+                              is_dir=info.filename.endswith('/'),
+                              size=info.file_size,
+                              compressed_size=info.compress_size,
+                              offset=info.header_offset)
+                for info in zf.infolist()]
+
+
+def _read_tar_index(archive):
+    # tar has no central index, so walk the member headers. member data is skipped rather than
+    # extracted, although a compressed tar still has to be decompressed to find the headers
+    if hasattr(archive, 'seek'):
+        archive.seek(0)
+        tf = tarfile.open(fileobj=archive, mode='r|*')
+    else:
+        tf = tarfile.open(archive, 'r|*')
+    with tf:
+        return [ArchiveMember(name=_member_name(member.name),
+                              is_dir=member.isdir(),
+                              size=member.size if member.isfile() else 0,
+                              compressed_size=None,
+                              offset=None)
+                for member in tf]
+
+
+def _archive_size(archive):
+    if hasattr(archive, 'seek'):
+        archive.seek(0, os.SEEK_END)
+        size = archive.tell()
+        archive.seek(0)
+        return size
+    return path.getsize(archive)
+
+
+def _member_name(name):
+    if posixpath.isabs(name) or '..' in name.split('/'):
+        raise PackratException("archive member {} is outside of the archive root".format(name))
+    name = posixpath.normpath(name)
+    return '' if name == '.' else name
+
+
+def _validate_index_limits(members, archive_size):
+    if len(members) > settings.ARCHIVE_MAX_MEMBERS:
+        raise PackratException("archive contains {} members, more than the maximum of {}".format(
+            len(members), settings.ARCHIVE_MAX_MEMBERS))
+
+    total_size = sum(member.size for member in members)
+    if total_size > settings.ARCHIVE_MAX_UNCOMPRESSED_SIZE:
+        raise PackratException("archive expands to {} bytes, more than the maximum of {}".format(
+            total_size, settings.ARCHIVE_MAX_UNCOMPRESSED_SIZE))
+
+    max_ratio = settings.ARCHIVE_MAX_COMPRESSION_RATIO
+    if total_size > MIN_BOMB_CHECK_SIZE and total_size > max_ratio * max(archive_size, 1):
+        raise PackratException("archive expands {} times, more than the maximum of {}".format(
+            total_size // max(archive_size, 1), max_ratio))
+    for member in members:
+        if member.compressed_size is not None and member.size > MIN_BOMB_CHECK_SIZE \
+                and member.size > max_ratio * max(member.compressed_size, 1):
+            raise PackratException("archive member {} expands {} times, more than the maximum of {}".format(
+                member.name, member.size // max(member.compressed_size, 1), max_ratio))
+
+    # zip bombs that reference the same compressed data from several central directory entries
+    # stay under any per member ratio, so also check that no two members overlap in the file
+    zip_members = sorted((member for member in members if member.offset is not None), key=lambda m: m.offset)
+    for member, next_member in zip(zip_members, zip_members[1:]):
+        member_end = member.offset + ZIP_LOCAL_HEADER_SIZE + len(member.name) + member.compressed_size
+        if member_end > next_member.offset:
+            raise PackratException("archive members {} and {} overlap".format(member.name, next_member.name))
+
+
+def _validate_index_layout(members, token):
+    folders = set()
+    for member in members:
+        parts = member.name.split('/') if member.name else []
+        # zip archives do not always contain entries for the folders of their files
+        last = len(parts) if member.is_dir else len(parts) - 1
+        for i in xrange(1, last + 1):
+            folders.add('/'.join(parts[:i]))
+
+    roots = set(member.name.split('/')[0] for member in members if member.name)
+    if len(roots) != 1:
+        raise PackratException("root folder is not unique. contains {}".format(sorted(roots)))
+    root = roots.pop()
+    if root not in folders:
+        raise PackratException("root {} is not a folder".format(root))
+
+    if posixpath.join(root, 'packrat') not in folders:
+        raise PackratException("no Packrat folder")
+    project_folder = posixpath.join(root, token)
+    if project_folder not in folders:
+        raise PackratException("no project folder named {} exists".format(token))
+
+    error_messages = []
+    if posixpath.join(project_folder, 'src') not in folders:
+        error_messages.append("missing a src folder")
+    if posixpath.join(project_folder, 'data') not in folders:
+        error_messages.append("missing a data folder")
+    if error_messages:
+        raise PackratException("Project archive is " + " and ".join(error_messages))
+
+
+def _get_and_add_paths(project, token, project_folder, digests=None):
+    """
+    List the extracted project files and add them to the project's manifest, replacing each
+    file with a hardlink into the blob store
+    """
     project_folder_src = path.join(project_folder, token)
     paths = _extract_files(project_folder_src)
+    Blob.objects.add_project_files(project, project_folder_src, paths, digests)
     return project_folder_src, paths
 
 
@@ -110,18 +421,83 @@ def _cleanup(tmpfolder):
         shutil.rmtree(tmpfolder)
 
 
-def _unpack(archive, folder):
+def _unpack(archive, folder, digests=None):
     """
-    Extract archive into tmpdir
+    Extract archive into a staging folder
 
-    Extraction into a temporary directory is necessary in case an archive is submitted
+    Extraction into a staging directory is necessary in case an archive is submitted
     with multiple files and/or directories in the root
 
+    Zip and tar archives are streamed member by member into the folder in process. Other
+    formats (7z, rar, ...) fall back to pyunpack and the external binaries it shells out to.
+
     :param archive:
     :type archive: str
     :param folder: folder to extract archive into
     :type folder: str
+    :param digests: if given, filled with the (digest, size) of each streamed file keyed by its extracted path
+    :type digests: dict
+    :return: the number of files and bytes extracted and how long extraction took
+    :rtype: ExtractionStats
     """
+    if digests is None:
+        digests = {}
+    start = time.time()
+    if zipfile.is_zipfile(archive):
+        n_files, n_bytes = _unpack_zip(archive, folder, digests)
+    elif tarfile.is_tarfile(archive):
+        n_files, n_bytes = _unpack_tar(archive, folder, digests)
+    else:
+        n_files, n_bytes = _unpack_external(archive, folder)
+    stats = ExtractionStats(files=n_files, bytes=n_bytes, seconds=time.time() - start)
+    _log_throughput(archive, stats)
+    return stats
+
+
+def _unpack_zip(archive, folder, digests):
+    n_files = 0
+    n_bytes = 0
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            target = _member_target(folder, info.filename)
+            if info.filename.endswith('/'):
+                _makedirs(target)
+                continue
+            _makedirs(path.dirname(target))
+            with zf.open(info) as src, open(target, 'wb') as dest:
+                digests[target] = _copy_and_hash(src, dest)
+            # preserve unix permission bits (e.g. executable shell scripts) when the archive recorded them
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(target, mode)
+            n_files += 1
+            n_bytes += info.file_size
+    return n_files, n_bytes
+
+
+def _unpack_tar(archive, folder, digests):
+    n_files = 0
+    n_bytes = 0
+    # stream mode reads the (possibly compressed) archive sequentially without seeking
+    with tarfile.open(archive, 'r|*') as tf:
+        for member in tf:
+            target = _member_target(folder, member.name)
+            if member.isdir():
+                _makedirs(target)
+            elif member.isfile():
+                _makedirs(path.dirname(target))
+                src = tf.extractfile(member)
+                with open(target, 'wb') as dest:
+                    digests[target] = _copy_and_hash(src, dest)
+                os.chmod(target, member.mode & 0o777)
+                n_files += 1
+                n_bytes += member.size
+            else:
+                logger.warning("skipping archive member %s: not a regular file or folder", member.name)
+    return n_files, n_bytes
+
+
+def _unpack_external(archive, folder):
     archive_dir, archive_name = path.split(archive)
     if not archive_dir:
         archive_dir = "."
@@ -131,13 +507,72 @@ def _unpack(archive, folder):
         except ValueError as e:
             logging.exception(e)
             raise OSError(e)
+    n_files = 0
+    n_bytes = 0
+    for (parent_dir, dirnames, fnames) in os.walk(folder):
+        for fname in fnames:
+            n_files += 1
+            n_bytes += path.getsize(path.join(parent_dir, fname))
+    return n_files, n_bytes
+
+
+def _copy_and_hash(src, dest):
+    """
+    Copy src to dest, hashing the contents for the blob store as they are written
+
+    :return: the (digest, size) of the copied contents
+    """
+    h = blobstore.new_hash()
+    size = 0
+    for block in iter(lambda: src.read(COPY_BUFFER_SIZE), b''):
+        h.update(block)
+        dest.write(block)
+        size += len(block)
+    return h.hexdigest(), size
+
+
+def _member_target(folder, member_name):
+    """
+    Resolve an archive member name to a path inside folder, rejecting members that would
+    be written outside of it (absolute paths or '..' components)
+    """
+    target = path.normpath(path.join(folder, member_name))
+    if path.isabs(member_name) or not (target == folder or target.startswith(path.join(folder, ''))):
+        raise PackratException("archive member {} is outside of the archive root".format(member_name))
+    return target
+
+
+def _makedirs(folder):
+    if not path.isdir(folder):
+        os.makedirs(folder)
+
+
+def _log_throughput(archive, stats):
+    seconds = max(stats.seconds, 1e-6)
+    logger.info("extracted %s: %s files, %s bytes in %.3fs (%.0f bytes/sec, %.1f files/sec)",
+                archive, stats.files, stats.bytes, stats.seconds,
+                stats.bytes / seconds, stats.files / seconds)
 
 def _move_project_to_projects(folder, projects_folder):
     token = path.basename(folder)
     dest = path.join(path.expanduser(projects_folder), token)
-    shutil.move(folder, dest)
+    # the staging folder lives inside the projects folder so this is an atomic rename
+    os.rename(folder, dest)
     return dest
 
+def _swap_folder(src, dest):
+    """
+    Move src to dest, moving whatever is currently at dest into a retired folder next to it
+
+    :return: the retired folder, None if dest did not exist
+    """
+    retired = None
+    if path.exists(dest):
+        retired = tempfile.mkdtemp(prefix='.retired-', dir=path.dirname(dest))
+        os.rename(dest, path.join(retired, path.basename(dest)))
+    shutil.move(src, dest)
+    return retired
+
 def _move_packrat_to_packrats(folder, packrats_folder):
     parent_folder, token = path.split(folder)
     src = path.join(parent_folder, 'packrat')
@@ -0,0 +1,85 @@
+"""
+Track the deployr jobs of every in-flight analysis run from a single process
+
+Instead of a check_analysis_job task per run, each polling its job over its own session, the monitor queries all
+in-flight jobs in concurrent batches over one pooled session. Jobs that have finished have their AnalysisOutput
+updated and a check_analysis_job task scheduled to retrieve the output files. Enabled by DEPLOYR_JOB_MONITOR, see
+the monitor_analysis_jobs command.
+"""
+
+import logging
+import time
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+from . import deployr
+from .models import AnalysisOutput
+from .tasks import app, check_analysis_job
+
+logger = logging.getLogger(__name__)
+
+
+def poll(session):
+    """
+    Query the status of every in-flight job once
+
+    :return: the number of jobs that were found to have finished
+    """
+    outputs = list(AnalysisOutput.objects.in_flight().select_related('creator'))
+    if not outputs:
+        return 0
+    responses = deployr.query_jobs([output.job_id for output in outputs], session)
+    job = deployr.Job(session)
+    timeout = timezone.now() - timedelta(seconds=settings.DEPLOYR_JOB_MONITOR_TIMEOUT)
+    finished = 0
+    for output in outputs:
+        response_json = responses.get(output.job_id)
+        if response_json is None:
+            continue
+        status = job.get_job_data(response_json)['status']
+        if job.is_job_completed(response_json):
+            logger.debug("job %s of output %s finished with status %s in project %s", output.job_id, output.pk,
+                         status, job.get_project_id(response_json))
+            output.job_status = status
+            output.save(update_fields=['job_status'])
+            check_analysis_job.apply_async((output.pk, output.job_id), {'user': output.creator},
+                                           task_id=output.collect_task_id)
+            finished += 1
+        elif output.date_created < timeout:
+            logger.warning("giving up on job %s of output %s with status %s", output.job_id, output.pk, status)
+            output.job_status = AnalysisOutput.JOB_TIMEOUT
+            output.save(update_fields=['job_status'])
+            app.backend.mark_as_failure(output.collect_task_id, deployr.DeployrJobTimeout(
+                "job {} did not complete in {} seconds".format(output.job_id, settings.DEPLOYR_JOB_MONITOR_TIMEOUT)))
+        elif status != output.job_status:
+            output.job_status = status
+            output.save(update_fields=['job_status'])
+    return finished
+
+
+def run(interval=None, once=False):
+    """
+    Poll the in-flight jobs every interval seconds, logging in again whenever deployr cannot be reached
+    """
+    if interval is None:
+        interval = settings.DEPLOYR_JOB_MONITOR_INTERVAL
+    session = None
+    while True:
+        start = time.time()
+        try:
+            if session is None:
+                session = deployr.login(pool_size=settings.DEPLOYR_JOB_MONITOR_CONCURRENCY)
+            poll(session)
+        except (requests.exceptions.RequestException, deployr.DeployrUnexpectedStatusCode):
+            logger.exception("could not poll analysis jobs")
+            if session is not None:
+                session.close()
+            session = None
+        if once:
+            break
+        time.sleep(max(interval - (time.time() - start), 0))
+    if session is not None:
+        session.close()
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from miracle.core.benchmarks import BENCHMARKS, compare
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Run one of the metadata pipeline benchmarks and print its results as JSON.
+    """
+    help = 'Run a benchmark'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark',
+                            choices=sorted(BENCHMARKS),
+                            help='The benchmark to run')
+        parser.add_argument('--param',
+                            action='append',
+                            default=[],
+                            metavar='NAME=VALUE',
+                            help='Integer parameter passed to the benchmark, e.g. --param rows=1000000')
+        parser.add_argument('--baseline',
+                            help='JSON results of an earlier run to compare against, regressions fail the command')
+        parser.add_argument('--tolerance',
+                            type=float,
+                            default=0.2,
+                            help='Fraction by which durations and memory sizes may exceed the baseline')
+        parser.add_argument('--save-baseline',
+                            help='Write the results to this file, to be used as a baseline by later runs')
+
+    def handle(self, *args, **options):
+        params = {}
+        for param in options['param']:
+            name, sep, value = param.partition('=')
+            if not sep:
+                raise CommandError("parameter {} is not of the form NAME=VALUE".format(param))
+            try:
+                params[name] = int(value)
+            except ValueError:
+                raise CommandError("parameter {} is not an integer".format(param))
+        logger.debug("running benchmark %s with %s", options['benchmark'], params)
+        results = BENCHMARKS[options['benchmark']](**params)
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        regressions = {}
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare(results, baseline, options['tolerance'])
+            results['regressions'] = dict((name, {'baseline': baseline_value, 'value': value})
+                                          for name, (baseline_value, value) in regressions.items())
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        if regressions:
+            raise CommandError("{} regressed by more than {:.0%} against {}".format(
+                ", ".join(sorted(regressions)), options['tolerance'], options['baseline']))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from miracle.core.ingest.analyzer import CACHED_LOADERS
+from miracle.core.models import MetadataCacheEntry
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Delete cached file metadata so that the files are analyzed again on their next ingest.
+    """
+    help = 'Invalidate the file metadata cache'
+
+    def add_arguments(self, parser):
+        loaders = sorted(loader.__name__ for loader in CACHED_LOADERS.values())
+        parser.add_argument('--loader',
+                            choices=loaders,
+                            help='Only invalidate metadata extracted by this loader')
+        parser.add_argument('--stale',
+                            action='store_true',
+                            default=False,
+                            help='Only invalidate metadata extracted by an older version of the loader')
+
+    def handle(self, *args, **options):
+        loaders = dict((loader.__name__, loader) for loader in CACHED_LOADERS.values())
+        names = [options['loader']] if options['loader'] else sorted(loaders)
+        if options['stale']:
+            deleted = sum(MetadataCacheEntry.objects.invalidate(name, keep_version=loaders[name].VERSION)
+                          for name in names)
+            # entries of loaders that are no longer cached at all are stale as well
+            if not options['loader']:
+                deleted += MetadataCacheEntry.objects.exclude(loader__in=names).delete()[0]
+        elif options['loader']:
+            deleted = MetadataCacheEntry.objects.invalidate(options['loader'])
+        else:
+            deleted = MetadataCacheEntry.objects.invalidate()
+        logger.info("deleted %s metadata cache entries", deleted)
@@ -1,7 +1,7 @@
 from django.core.files import File
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from miracle.core.tasks import run_metadata_pipeline
+from miracle.core.ingest import loader, pipeline, rasters
 from miracle.core.models import Project, User
 import logging
 import os
@@ -67,10 +67,20 @@ class Command(BaseCommand):
             project = Project.objects.create(name=project_shortname, creator=creator)
             project.slug = project_shortname
             project.save()
+        if pipeline.is_running(project):
+            logger.error("Project %s is still being ingested", project.slug)
+            return
         with open(abs_archive_path, 'rb') as f:
             project.archive(File(f))
         try:
-            run_metadata_pipeline(project, archive_file, delete_archive_on_failure=False)
+            if pipeline.is_incomplete(project):
+                pipeline.cleanup_on_error(project, archive_file, delete_archive_on_failure=False)
+            if project.manifest.exists():
+                pipeline.update(project, archive_file, delete_archive_on_failure=False)
+            else:
+                pipeline.run(project, archive_file, delete_archive_on_failure=False)
+            loader.sync_deployr(project)
+            rasters.process_rasters(project)
             logger.debug("Extraction succeeded for archive at %s", abs_archive_path)
         except Exception:
             logger.exception("Extraction failed for archive %s", abs_archive_path)
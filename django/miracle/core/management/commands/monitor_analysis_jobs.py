@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from miracle.core import jobmonitor
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Track the deployr jobs of all in-flight analysis runs, see miracle.core.jobmonitor. Runs until interrupted.
+    """
+    help = 'Monitor in-flight analysis jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval',
+                            type=float,
+                            help='Seconds between polls, DEPLOYR_JOB_MONITOR_INTERVAL by default')
+        parser.add_argument('--once',
+                            action='store_true',
+                            default=False,
+                            help='Poll the in-flight jobs once and exit')
+
+    def handle(self, *args, **options):
+        logger.info("monitoring analysis jobs")
+        jobmonitor.run(interval=options['interval'], once=options['once'])
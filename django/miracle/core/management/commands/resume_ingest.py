@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from miracle.core.ingest import loader, pipeline
+from miracle.core.models import Project
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Resume a failed project ingest from its last completed stage.
+    """
+    help = 'Resume a failed project ingest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('project',
+                            help='The slug of the project whose ingest failed')
+        parser.add_argument('--force',
+                            action='store_true',
+                            default=False,
+                            help='Resume an ingest that is recorded as running, e.g. after its worker was killed')
+
+    def handle(self, *args, **options):
+        project = Project.objects.get(slug=options['project'])
+        if pipeline.is_running(project) and not options['force']:
+            logger.warning("Project %s is still being ingested, use --force if its worker died", project.slug)
+            return
+        if not pipeline.is_incomplete(project) and not pipeline.is_running(project):
+            logger.warning("Project %s has no incomplete ingest to resume", project.slug)
+            return
+        logger.debug("Resuming ingest of project %s with stages %s", project.slug, pipeline.remaining_stages(project))
+        pipeline.resume(project)
+        loader.sync_deployr(project)
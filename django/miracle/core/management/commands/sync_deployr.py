@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from miracle.core.ingest import loader
+from miracle.core.models import Project
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Make the deployr calls left in the engine sync outbox, e.g. after a deployr outage
+    """
+    help = 'Sync analysis scripts to deployr'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project',
+                            help='Only sync the project with this shortname')
+
+    def handle(self, *args, **options):
+        project = None
+        if options['project']:
+            project = Project.objects.get(slug=options['project'])
+        attempted = loader.sync_deployr(project)
+        pending = loader.pending_deployr_operations(project).count()
+        logger.info("attempted %s deployr operations, %s still pending", attempted, pending)
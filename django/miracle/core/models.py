@@ -4,7 +4,7 @@ from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
 from django.core.files.storage import FileSystemStorage
 from django.core.urlresolvers import reverse_lazy
-from django.db import models, connections, transaction
+from django.db import models, connections, transaction, IntegrityError
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -12,10 +12,18 @@ from django_comments.models import Comment
 from django_extensions.db.fields import AutoSlugField
 from model_utils import Choices
 
+from collections import defaultdict
+from datetime import timedelta
+
+import cPickle as pickle
+import errno
+import json
 import logging
 import hashlib
+import operator
 import os
 import pathlib2
+import random
 import re
 import shutil
 import utils
@@ -23,7 +31,8 @@ import utils
 from pygments.lexers import guess_lexer_for_filename
 from pygments.lexers.special import TextLexer
 
-from .deployr import DeployrAPI
+from . import blobstore
+from .deployr import DeployrAPI, Job as DeployrJob
 
 logger = logging.getLogger(__name__)
 
@@ -73,6 +82,56 @@ class DatasetConnectionMixin(object):
         return self.connection.cursor()
 
 
+class BulkAutoSlugField(AutoSlugField):
+    """
+    AutoSlugField that keeps a slug assigned by assign_unique_slugs instead of querying for a unique slug while the
+    instance is saved, so that instances can be created with bulk_create
+    """
+
+    def pre_save(self, model_instance, add):
+        if model_instance.__dict__.pop('_slug_assigned', False):
+            return getattr(model_instance, self.attname)
+        return super(BulkAutoSlugField, self).pre_save(model_instance, add)
+
+
+def assign_unique_slugs(instances, field_name='slug', chunk_size=500):
+    """
+    Assign the slugs a BulkAutoSlugField would generate to unsaved instances of one model, looking up the slugs
+    already taken with one query per chunk_size instances instead of a query per candidate slug
+    """
+    if not instances:
+        return
+    model = type(instances[0])
+    field = model._meta.get_field(field_name)
+    # the slug generator truncates candidates to slug_len, which AutoSlugField.create_slug normally sets
+    field.slug_len = field.max_length
+    populate_from = field._populate_from
+    if not isinstance(populate_from, (list, tuple)):
+        populate_from = (populate_from,)
+
+    original_slugs = []
+    for instance in instances:
+        slug = field.separator.join(field.slugify_func(getattr(instance, name)) for name in populate_from)
+        original_slugs.append(field._slug_strip(slug[:field.max_length]))
+
+    # every candidate the generator can produce for a slug starts with this prefix
+    prefix_length = max(field.max_length - 10, 1)
+    prefixes = sorted(set(slug[:prefix_length] for slug in original_slugs))
+    taken = set()
+    for i in xrange(0, len(prefixes), chunk_size):
+        query = reduce(lambda q, prefix: q | models.Q(**{field_name + '__startswith': prefix}),
+                       prefixes[i:i + chunk_size], models.Q())
+        taken.update(model.objects.filter(query).values_list(field_name, flat=True))
+
+    for instance, original_slug in zip(instances, original_slugs):
+        for slug in field.slug_generator(original_slug, 2):
+            if slug and slug not in taken:
+                break
+        taken.add(slug)
+        setattr(instance, field.attname, slug)
+        instance._slug_assigned = True
+
+
 class MiracleMetadataMixin(models.Model):
     """
     Provides commonly used metadata fields for Miracle metadata
@@ -204,6 +263,15 @@ class Project(MiracleMetadataMixin):
     def project_path(self):
         return os.path.join(settings.PROJECT_DIRECTORY, str(self.slug))
 
+    def packrat_lock_digest(self):
+        """
+        :return: the hex digest of the project's packrat.lock, None if it has none
+        """
+        lock_file_path = os.path.join(self.packrat_path, 'packrat.lock')
+        if os.path.exists(lock_file_path):
+            return blobstore.hash_file(lock_file_path)[0]
+        return None
+
     def package_dependencies(self):
         lock_file_path = os.path.join(self.packrat_path, 'packrat.lock')
         if os.path.exists(lock_file_path):
@@ -214,10 +282,43 @@ class Project(MiracleMetadataMixin):
             return "No packrat.lock file found"
 
     def archive(self, incoming_file):
+        """
+        Store a newly submitted archive. The previous archive is kept until an ingest of the new one commits, see
+        retire_previous_archives and restore_previous_archive.
+        """
         p = pathlib2.Path(incoming_file.name)
         simplified_filename = ''.join([self.slug] + p.suffixes)
         self.submitted_archive.save(simplified_filename, incoming_file)
 
+    def previous_archives(self):
+        """
+        :return: paths of the archives submitted before the current one, latest first
+        """
+        folder = os.path.join(settings.ARCHIVE_DIRECTORY, os.path.dirname(project_archive_path(self, '')))
+        current = self.archive_path if self.submitted_archive else None
+        if not os.path.isdir(folder):
+            return []
+        archives = [os.path.join(folder, name) for name in os.listdir(folder)]
+        return sorted((archive for archive in archives if archive != current and os.path.isfile(archive)),
+                      key=os.path.getmtime, reverse=True)
+
+    def retire_previous_archives(self):
+        for archive in self.previous_archives():
+            logger.debug("removing archive %s replaced by %s", archive, self.submitted_archive)
+            os.unlink(archive)
+
+    def restore_previous_archive(self):
+        """
+        Make the latest previous archive the submitted archive again, after an ingest of the current one failed and
+        removed it
+        """
+        previous = self.previous_archives()
+        if previous:
+            self.submitted_archive.name = os.path.relpath(previous[0], settings.ARCHIVE_DIRECTORY)
+        else:
+            self.submitted_archive = None
+        self.save(update_fields=['submitted_archive'])
+
     def clear_archive(self, user):
         self.log("Clear project archive", user)
         # delete all data table groups, data analysis scripts, and files.
@@ -225,7 +326,14 @@ class Project(MiracleMetadataMixin):
             self.data_table_groups.all().delete()
             self.analyses.all().delete()
             self.files.all().delete()
-            self.submitted_archive.delete()
+            # archive files are only removed once the deletions commit
+            archives = self.previous_archives()
+            if self.submitted_archive:
+                archives.append(self.archive_path)
+                self.submitted_archive = None
+                self.save(update_fields=['submitted_archive'])
+            transaction.on_commit(lambda: [os.unlink(archive) for archive in archives if os.path.exists(archive)])
+            Blob.objects.release_project_files(self)
         # FIXME: add error handlers
         logger.debug("Deleting extracted project tree %s", self.project_path)
         shutil.rmtree(self.project_path, True)
@@ -288,6 +396,346 @@ class Project(MiracleMetadataMixin):
         )
 
 
+class BlobManager(models.Manager):
+
+    def add_project_files(self, project, folder, file_paths, digests=None):
+        """
+        Moves the given files into the blob store, replaces them with hardlinks and records them in the project's
+        manifest.
+
+        :param folder: folder the file paths are relative to
+        :param file_paths: paths of the extracted project files relative to folder
+        :param digests: optional dict of absolute file path to (digest, size) computed while the file was written
+        """
+        entries, sizes = self._manifest_entries(project, folder, file_paths, digests)
+        with transaction.atomic():
+            self._add_references(entries, sizes)
+            ProjectManifestEntry.objects.bulk_create(entries)
+            for entry in entries:
+                blobstore.link(os.path.join(folder, entry.path), entry.blob_id)
+        return entries
+
+    def replace_project_files(self, project, folder, file_paths, digests=None):
+        """
+        Replaces the project's manifest with the given files, see add_project_files. Blobs only referenced by the old
+        manifest are removed.
+        """
+        entries, sizes = self._manifest_entries(project, folder, file_paths, digests)
+        with transaction.atomic():
+            self._add_references(entries, sizes)
+            released_digests = self._release_references(project)
+            ProjectManifestEntry.objects.bulk_create(entries)
+            for entry in entries:
+                blobstore.link(os.path.join(folder, entry.path), entry.blob_id)
+            unreferenced_digests = self._delete_unreferenced(released_digests)
+            self._remove_on_commit(unreferenced_digests)
+        return entries
+
+    def release_project_files(self, project):
+        """
+        Drops the project's manifest and removes blobs that are no longer referenced by any project
+        """
+        with transaction.atomic():
+            released_digests = self._release_references(project)
+            unreferenced_digests = self._delete_unreferenced(released_digests)
+            self._remove_on_commit(unreferenced_digests)
+
+    def _manifest_entries(self, project, folder, file_paths, digests):
+        if digests is None:
+            digests = {}
+        sizes = {}
+        entries = []
+        for file_path in file_paths:
+            full_path = os.path.join(folder, file_path)
+            digest, size = digests.get(full_path) or blobstore.hash_file(full_path)
+            sizes[digest] = size
+            entries.append(ProjectManifestEntry(project=project, path=file_path, blob_id=digest))
+        return entries, sizes
+
+    def _add_references(self, entries, sizes):
+        reference_counts = defaultdict(int)
+        for entry in entries:
+            reference_counts[entry.blob_id] += 1
+        existing = set(self.select_for_update().filter(digest__in=sizes.keys()).values_list('digest', flat=True))
+        new_blobs = [Blob(digest=digest, size=size) for digest, size in sizes.items() if digest not in existing]
+        if new_blobs:
+            try:
+                with transaction.atomic():
+                    self.bulk_create(new_blobs)
+            except IntegrityError:
+                # a concurrent ingest added some of the same files in the meantime, insert the rest one by one
+                for blob in new_blobs:
+                    try:
+                        with transaction.atomic():
+                            blob.save(force_insert=True)
+                    except IntegrityError:
+                        pass
+        for digest, count in reference_counts.items():
+            self.filter(digest=digest).update(reference_count=models.F('reference_count') + count)
+
+    def _release_references(self, project):
+        reference_counts = project.manifest.values('blob').annotate(count=models.Count('id'))
+        digests = []
+        for row in reference_counts:
+            digests.append(row['blob'])
+            self.filter(digest=row['blob']).update(reference_count=models.F('reference_count') - row['count'])
+        project.manifest.all().delete()
+        return digests
+
+    def _delete_unreferenced(self, digests):
+        unreferenced = self.select_for_update().filter(digest__in=digests, reference_count__lte=0)
+        unreferenced_digests = list(unreferenced.values_list('digest', flat=True))
+        unreferenced.delete()
+        return unreferenced_digests
+
+    def _remove_on_commit(self, digests):
+        """
+        Remove the files of deleted blobs once the deletion commits, so that a rollback never leaves manifest entries
+        pointing at removed files. Blobs added back in the meantime by another ingest are kept.
+        """
+        def remove():
+            kept = set(self.filter(digest__in=digests).values_list('digest', flat=True))
+            for digest in digests:
+                if digest not in kept:
+                    blobstore.remove(digest)
+        if digests:
+            transaction.on_commit(remove)
+
+
+class Blob(models.Model):
+    """
+    A file stored once in the content addressed blob store. Extracted project files are hardlinks to their blob, and
+    the reference count tracks how many ProjectManifestEntries point at it.
+    """
+    digest = models.CharField(max_length=64, primary_key=True, help_text=_("SHA-256 hex digest of the file contents"))
+    size = models.BigIntegerField()
+    reference_count = models.PositiveIntegerField(default=0)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    @property
+    def path(self):
+        return blobstore.blob_path(self.digest)
+
+    def __unicode__(self):
+        return u'{} ({} bytes, {} references)'.format(self.digest, self.size, self.reference_count)
+
+
+class ProjectManifestEntry(models.Model):
+    """
+    A file extracted from a Project's submitted archive
+    """
+    project = models.ForeignKey(Project, related_name='manifest')
+    path = models.CharField(max_length=1024, help_text=_("Path of the file relative to the project folder"))
+    blob = models.ForeignKey(Blob, related_name='manifest_entries', on_delete=models.PROTECT)
+
+    @property
+    def size(self):
+        return self.blob.size
+
+    class Meta:
+        unique_together = ('project', 'path')
+
+
+class MetadataCacheEntryManager(models.Manager):
+
+    def get_many(self, keys):
+        """
+        Look up cached file metadata
+
+        :param keys: dict of file path to (digest, loader, version, options)
+        :return: dict of file path to the cached Metadata, for the paths with a cache entry
+        """
+        if not keys:
+            return {}
+        entries = {}
+        digests = set(key[0] for key in keys.values())
+        for entry in self.filter(digest__in=digests):
+            entries[(entry.digest, entry.loader, entry.version, entry.options)] = entry
+        cached = {}
+        for file_path, key in keys.items():
+            entry = entries.get(key)
+            if entry is not None:
+                metadata = pickle.loads(bytes(entry.metadata))
+                # the same contents may have been analyzed under another name
+                metadata.path = file_path
+                cached[file_path] = metadata
+        if entries:
+            self.filter(pk__in=[entry.pk for entry in entries.values()]).update(last_used=timezone.now())
+        return cached
+
+    def set_many(self, keys, metadata):
+        """
+        Cache file metadata, evicting the least recently used entries when the cache grows beyond
+        METADATA_CACHE_MAX_BYTES
+
+        Concurrent ingests of the same files may cache them at the same time, entries already cached are skipped.
+
+        :param keys: dict of file path to (digest, loader, version, options)
+        :param metadata: dict of file path to Metadata
+        """
+        entries = {}
+        for file_path, key in keys.items():
+            # failures may be transient (timeouts, missing sibling files) so they are analyzed again next time
+            if file_path in metadata and not metadata[file_path].errors and key not in entries:
+                digest, loader, version, options = key
+                data = pickle.dumps(metadata[file_path], pickle.HIGHEST_PROTOCOL)
+                entries[key] = MetadataCacheEntry(digest=digest, loader=loader, version=version, options=options,
+                                                  metadata=data, size=len(data))
+        existing = set(self.filter(digest__in=set(key[0] for key in entries))
+                       .values_list('digest', 'loader', 'version', 'options'))
+        new_entries = [entry for key, entry in entries.items() if key not in existing]
+        if not new_entries:
+            return
+        try:
+            with transaction.atomic():
+                self.bulk_create(new_entries)
+        except IntegrityError:
+            # some were cached in the meantime, insert the rest one by one
+            for entry in new_entries:
+                try:
+                    with transaction.atomic():
+                        entry.save()
+                except IntegrityError:
+                    pass
+        self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        Delete the least recently used entries until the cache holds at most max_bytes of metadata
+
+        :return: the number of deleted entries
+        """
+        if max_bytes is None:
+            max_bytes = settings.METADATA_CACHE_MAX_BYTES
+        total = self.aggregate(total=models.Sum('size'))['total'] or 0
+        if total <= max_bytes:
+            return 0
+        evicted = []
+        for pk, size in self.order_by('last_used').values_list('pk', 'size').iterator():
+            if total <= max_bytes:
+                break
+            evicted.append(pk)
+            total -= size
+        self.filter(pk__in=evicted).delete()
+        logger.debug("evicted %s metadata cache entries", len(evicted))
+        return len(evicted)
+
+    def invalidate(self, loader=None, keep_version=None):
+        """
+        Delete cache entries, all of them or only those of the given loader
+
+        :param keep_version: if given, keep the entries created by this version of the loader
+        :return: the number of deleted entries
+        """
+        entries = self.all()
+        if loader is not None:
+            entries = entries.filter(loader=loader)
+        if keep_version is not None:
+            entries = entries.exclude(version=keep_version)
+        deleted, _ = entries.delete()
+        return deleted
+
+
+class MetadataCacheEntry(models.Model):
+    """
+    Metadata extracted from a file by one version of a loader, keyed by the contents' digest so that identical files
+    are only analyzed once across ingests and projects
+    """
+    digest = models.CharField(max_length=64, help_text=_("SHA-256 hex digest of the analyzed contents"))
+    loader = models.CharField(max_length=64)
+    version = models.PositiveIntegerField()
+    options = models.CharField(max_length=40, blank=True,
+                               help_text=_("Digest of the file extension and settings the metadata depends on"))
+    metadata = models.BinaryField(help_text=_("Pickled miracle.core.ingest.analyzer.Metadata"))
+    size = models.PositiveIntegerField()
+    date_created = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = MetadataCacheEntryManager()
+
+    def __unicode__(self):
+        return u'{} {} v{}'.format(self.digest, self.loader, self.version)
+
+    class Meta:
+        unique_together = ('digest', 'loader', 'version', 'options')
+
+
+class EngineSyncOperationQuerySet(models.query.QuerySet):
+
+    def pending(self):
+        return self.filter(status__in=(EngineSyncOperation.Status.pending, EngineSyncOperation.Status.running))
+
+    def due(self, now=None):
+        # running operations are due again once their claim expires, their sync died before settling them
+        return self.pending().filter(next_attempt__lte=now or timezone.now())
+
+
+class EngineSyncOperation(models.Model):
+    """
+    A call to the analysis execution engine (DeployR) recorded in the same transaction as the metadata it depends on
+    and performed after that transaction commits, see miracle.core.ingest.loader.sync_deployr
+    """
+    Operation = Choices(
+        ('create_working_directory', _('Create working directory')),
+        ('upload_script', _('Upload script')),
+    )
+    Status = Choices(
+        ('pending', _('Pending')),
+        ('running', _('Running')),
+        ('done', _('Done')),
+        ('failed', _('Failed')),
+    )
+    project = models.ForeignKey(Project, related_name='engine_sync_operations')
+    operation = models.CharField(max_length=32, choices=Operation)
+    path = models.CharField(max_length=1024, blank=True,
+                            help_text=_("Path of the script to upload relative to the project folder"))
+    status = models.CharField(max_length=16, choices=Status, default=Status.pending, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+
+    objects = EngineSyncOperationQuerySet.as_manager()
+
+    def claim(self):
+        """
+        Mark the operation as running for ENGINE_SYNC_CLAIM_TIMEOUT seconds unless a concurrent sync changed it since
+        it was read
+
+        :return: whether the operation was claimed
+        """
+        expires = timezone.now() + timedelta(seconds=settings.ENGINE_SYNC_CLAIM_TIMEOUT)
+        claimed = EngineSyncOperation.objects.filter(pk=self.pk, status=self.status, next_attempt=self.next_attempt) \
+            .update(status=EngineSyncOperation.Status.running, next_attempt=expires)
+        if claimed:
+            self.status = EngineSyncOperation.Status.running
+            self.next_attempt = expires
+        return bool(claimed)
+
+    def record_failure(self, error):
+        """
+        Schedule the operation to be retried with exponential backoff, giving up after ENGINE_SYNC_MAX_ATTEMPTS
+        """
+        self.attempts += 1
+        self.last_error = u'{}'.format(error)
+        if self.attempts >= settings.ENGINE_SYNC_MAX_ATTEMPTS:
+            self.status = EngineSyncOperation.Status.failed
+        else:
+            self.status = EngineSyncOperation.Status.pending
+            backoff = settings.ENGINE_SYNC_RETRY_BACKOFF * 2 ** (self.attempts - 1)
+            self.next_attempt = timezone.now() + timedelta(seconds=backoff)
+        self.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+
+    def __unicode__(self):
+        return u'{} {} {} ({})'.format(self.project, self.operation, self.path, self.status)
+
+    class Meta:
+        ordering = ['id']
+
+
 class BookmarkedProject(models.Model):
 
     project = models.ForeignKey(Project)
@@ -315,7 +763,7 @@ class DataAnalysisScript(MiracleMetadataMixin):
         ('Perl', _('Perl script')),
     )
 
-    slug = AutoSlugField(populate_from='name', unique=True, overwrite=True)
+    slug = BulkAutoSlugField(populate_from='name', unique=True, overwrite=True)
     project = models.ForeignKey(Project, related_name="analyses")
     archived_file = models.FileField(help_text=_("The archived file corresponding to this AnalysisScript"))
     provenance = JSONField(null=True, blank=True)
@@ -353,15 +801,50 @@ class DataAnalysisScript(MiracleMetadataMixin):
 
     def add_parameters(self, parameters):
         """ parameters is a list of dictionaries with (currently) DeployR specific keys """
+        AnalysisParameter.objects.bulk_create([AnalysisParameter(analysis=self, **self._parameter_fields(parameter))
+                                               for parameter in parameters])
+
+    def update_parameters(self, parameters):
+        """
+        Synchronizes this script's parameters with a new list of parameter dictionaries (see add_parameters). Existing
+        parameters are matched by name and updated in place so that ParameterValues recorded for past outputs are kept.
+        """
+        existing_parameters = dict((p.name, p) for p in self.parameters.all())
+        new_parameters = []
         for parameter in parameters:
-            self.parameters.create(
-                name=parameter["name"],
-                label=parameter["label"],
-                data_type=parameter["render"],
-                default_value=str(parameter["default"]),
-                value_list=parameter.get("valueList"),
-                value_range=parameter.get("valueRange"),
-            )
+            fields = self._parameter_fields(parameter)
+            analysis_parameter = existing_parameters.pop(fields['name'], None)
+            if analysis_parameter is None:
+                new_parameters.append(AnalysisParameter(analysis=self, **fields))
+            elif any(getattr(analysis_parameter, k) != v for k, v in fields.items()):
+                for k, v in fields.items():
+                    setattr(analysis_parameter, k, v)
+                analysis_parameter.save()
+        AnalysisParameter.objects.bulk_create(new_parameters)
+        if existing_parameters:
+            self.parameters.filter(pk__in=[p.pk for p in existing_parameters.values()]).delete()
+
+    @staticmethod
+    def _parameter_fields(parameter):
+        return dict(
+            name=parameter["name"],
+            label=parameter["label"],
+            data_type=parameter["render"],
+            default_value=str(parameter["default"]),
+            value_list=parameter.get("valueList"),
+            value_range=parameter.get("valueRange"),
+        )
+
+    def run_parameters(self, values=None):
+        """
+        :param values: dict of AnalysisParameter id to value, parameters without a value get their default value
+        :return: the parameters of a run with the given values, in the form RunAnalysisView receives them
+        """
+        if values is None:
+            values = {}
+        return [dict(id=p.pk, name=p.name, label=p.label, type='primitive', data_type=p.data_type,
+                     value=values.get(p.pk, p.default_value))
+                for p in self.parameters.all()]
 
     def get_deployr_parameters_dict(self, values=None):
         if values is None:
@@ -371,6 +854,31 @@ class DataAnalysisScript(MiracleMetadataMixin):
             for p in self.parameters.all()
         )
 
+    def script_digest(self):
+        """
+        :return: the hex digest of the script's contents, as recorded in the project manifest when it has an entry
+        """
+        digests = self.project.manifest.filter(path=str(self.archived_file)).values_list('blob_id', flat=True)
+        for digest in digests:
+            return digest
+        return blobstore.hash_file(self.path)[0]
+
+    def output_cache_key(self, parameters):
+        """
+        Key under which the output of running this analysis with the given parameter values is cached, see
+        AnalysisOutputQuerySet.cached: a hash of the script's contents, the project's packrat.lock and the normalized
+        values of all of the analysis' parameters, defaults included
+
+        :param parameters: list of dicts with the id and value of an AnalysisParameter
+        """
+        values = dict((parameter['id'], parameter.get('value')) for parameter in parameters)
+        normalized = sorted((parameter.name, parameter.normalize(values.get(parameter.pk, parameter.default_value)))
+                            for parameter in self.parameters.all())
+        key = {'script': self.script_digest(),
+               'packrat': self.project.packrat_lock_digest(),
+               'parameters': normalized}
+        return hashlib.sha256(json.dumps(key, sort_keys=True)).hexdigest()
+
     @property
     def basename(self):
         return os.path.basename(str(self.archived_file))
@@ -437,11 +945,80 @@ class AnalysisParameter(models.Model):
     def convert(self, value):
         return AnalysisParameter.TYPE_CONVERTERS[self.data_type](value)
 
+    def sweep_values(self):
+        """
+        :return: the values a sweep runs this parameter through: its value_list, else the values from start to end of its
+                 value_range, else its default value. Ranges are computed as they are indexed, they may be huge.
+        """
+        if self.value_list:
+            return list(self.value_list)
+        if self.value_range and len(self.value_range) == 3 and self.value_range[2] > 0:
+            start, end, step = self.value_range
+            # allow for floating point error in the number of steps
+            size = max(int((end - start) / float(step) + 1e-9) + 1, 0)
+            return SweepRange(start, step, size)
+        return [self.default_value]
+
+    def normalize(self, value):
+        """
+        Canonical JSON serializable form of a value for this parameter, e.g. 5, "5" and 5.0 are the same numeric value
+        """
+        if isinstance(value, basestring):
+            value = value.strip()
+        try:
+            if self.data_type == AnalysisParameter.ParameterType.logical:
+                if isinstance(value, basestring):
+                    return value.lower() in ('true', 't', 'yes', '1')
+                return bool(value)
+            if self.data_type == AnalysisParameter.ParameterType.integer:
+                return int(float(value))
+            if self.data_type == AnalysisParameter.ParameterType.numeric:
+                return float(value)
+            if self.data_type == AnalysisParameter.ParameterType.complex:
+                return repr(complex(value))
+        except (TypeError, ValueError):
+            pass
+        return value
+
     def __unicode__(self):
         return u'{} ({})'.format(self.label, self.name)
 
 
+class AnalysisOutputQuerySet(models.query.QuerySet):
+
+    def unfinished(self):
+        return self.exclude(job_id='').exclude(
+            job_status__in=DeployrJob.FINISHED_STATUSES + (AnalysisOutput.JOB_TIMEOUT,))
+
+    def in_flight(self):
+        """
+        Outputs whose deployr job is tracked by the job monitor and has not finished yet
+        """
+        return self.unfinished().filter(monitored=True)
+
+    def cached(self, cache_key):
+        """
+        :return: the latest output with the given AnalysisOutput.cache_key whose files have been collected, if any
+        """
+        return (self.filter(cache_key=cache_key, job_status='Completed', date_completed__isnull=False)
+                .order_by('-date_created').first())
+
+    def running(self, cache_key):
+        """
+        :return: the latest output of a run with the given AnalysisOutput.cache_key that is still in progress, its
+                 files included, if any
+        """
+        started = timezone.now() - timedelta(seconds=settings.ANALYSIS_RUN_COALESCE_SECONDS)
+        return (self.filter(cache_key=cache_key, date_created__gte=started, date_completed=None)
+                .exclude(job_status__in=AnalysisOutput.FAILED_STATUSES)
+                .order_by('-date_created').first())
+
+
 class AnalysisOutput(models.Model):
+    # job_status of jobs the job monitor gave up on
+    JOB_TIMEOUT = 'Timeout'
+    # job_status of runs that will never have their output collected, check_analysis_job sets 'Failed' when it fails
+    FAILED_STATUSES = tuple(status for status in DeployrJob.FINISHED_STATUSES if status != 'Completed') + (JOB_TIMEOUT,)
 
     analysis = models.ForeignKey(DataAnalysisScript, related_name='outputs')
     name = models.CharField(max_length=255, help_text=_("User assigned name for this script run"))
@@ -450,6 +1027,19 @@ class AnalysisOutput(models.Model):
     creator = models.ForeignKey(User)
     response = JSONField(help_text=_("Internal raw HTTP response from executing the script against DeployR/OpenCPU"),
                          null=True, blank=True)
+    job_id = models.CharField(max_length=128, blank=True, help_text=_("DeployR job producing this output"))
+    job_status = models.CharField(max_length=32, blank=True, help_text=_("Last known DeployR status of the job"))
+    collect_task_id = models.CharField(max_length=255, blank=True,
+                                       help_text=_("Id of the check_analysis_job task collecting the output, the one "
+                                                   "clients poll"))
+    monitored = models.BooleanField(default=False,
+                                    help_text=_("True if the job is tracked by the monitor_analysis_jobs process"))
+    cache_key = models.CharField(max_length=64, blank=True, db_index=True,
+                                 help_text=_("DataAnalysisScript.output_cache_key of the run"))
+    date_completed = models.DateTimeField(null=True, blank=True,
+                                          help_text=_("When the output files of the run were collected"))
+
+    objects = AnalysisOutputQuerySet.as_manager()
 
     @property
     def project(self):
@@ -471,6 +1061,131 @@ class ParameterValue(models.Model):
     value = models.CharField(max_length=255, help_text=_("Assigned value for the given input parameter"))
 
 
+class SweepRange(object):
+    """
+    The values of a parameter's value_range, computed on access instead of being stored
+    """
+
+    def __init__(self, start, step, size):
+        self.start = start
+        self.step = step
+        self.size = size
+        self.exact = all(isinstance(v, (int, long)) for v in (start, step))
+
+    def __len__(self):
+        # len() cannot go beyond sys.maxint, use sweep_size
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        value = self.start + i * self.step
+        return value if self.exact else round(value, 12)
+
+    def __iter__(self):
+        return (self[i] for i in xrange(self.size))
+
+
+def sweep_size(values):
+    """
+    :return: the number of values in a list or SweepRange of values
+    """
+    return values.size if isinstance(values, SweepRange) else len(values)
+
+
+class AnalysisSweep(models.Model):
+    """
+    Runs of an analysis over many points of its parameter space, a few at a time, see miracle.core.tasks.advance_sweep
+    """
+    analysis = models.ForeignKey(DataAnalysisScript, related_name='sweeps')
+    creator = models.ForeignKey(User)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_completed = models.DateTimeField(null=True, blank=True)
+    concurrency = models.PositiveIntegerField(help_text=_("Maximum number of runs of the sweep in progress at once"))
+    sampled = models.BooleanField(default=False,
+                                  help_text=_("True if the points are a random sample of the Cartesian product"))
+
+    @staticmethod
+    def expand(values, samples=None, rng=random):
+        """
+        Expand the values of each parameter into the points of a sweep
+
+        :param values: list of (parameter id, list of values) pairs
+        :param samples: number of points to sample from the Cartesian product of the values, all of them if None
+        :return: the points in Cartesian product order, each a list of (parameter id, value) pairs
+        """
+        sizes = [sweep_size(parameter_values) for parameter_id, parameter_values in values]
+        total = reduce(operator.mul, sizes, 1)
+        if samples is None or samples >= total:
+            indices = xrange(total)
+        else:
+            # decode sampled indices instead of generating the whole product, which may not even fit an xrange
+            sampled = set()
+            while len(sampled) < samples:
+                sampled.add(rng.randrange(total))
+            indices = sorted(sampled)
+        points = []
+        for index in indices:
+            point = []
+            for (parameter_id, parameter_values), size in reversed(zip(values, sizes)):
+                index, i = divmod(index, size)
+                point.append((parameter_id, parameter_values[i]))
+            points.append(point[::-1])
+        return points
+
+    def progress(self):
+        """
+        :return: dict with the number of points of the sweep in total and pending, running, completed or failed
+        """
+        # runs that have not finished in time since their point started are assumed to have been lost, e.g. with a
+        # crashed task
+        stale = timezone.now() - timedelta(seconds=settings.ANALYSIS_SWEEP_RUN_TIMEOUT)
+        progress = dict(total=0, pending=0, running=0, completed=0, failed=0)
+        for task_id, output_id, job_status, date_completed, date_started, date_created in self.points.values_list(
+                'collect_task_id', 'output_id', 'output__job_status', 'output__date_completed', 'date_started',
+                'output__date_created'):
+            progress['total'] += 1
+            if not task_id:
+                progress['pending'] += 1
+            elif output_id is None:
+                # the run could not be started or its output was deleted
+                progress['failed'] += 1
+            elif date_completed is not None:
+                progress['completed'] += 1
+            # points started before date_started was recorded fall back to when their output was created
+            elif job_status in AnalysisOutput.FAILED_STATUSES or (date_started or date_created) < stale:
+                progress['failed'] += 1
+            else:
+                progress['running'] += 1
+        return progress
+
+    def __unicode__(self):
+        return u'sweep of {} by {}'.format(self.analysis, self.creator)
+
+    class Meta:
+        ordering = ['-date_created']
+
+
+class AnalysisSweepPoint(models.Model):
+    # collect_task_id of points whose run could not be started
+    NOT_STARTED = 'not-started'
+
+    sweep = models.ForeignKey(AnalysisSweep, related_name='points')
+    index = models.PositiveIntegerField()
+    values = JSONField(help_text=_("List of [AnalysisParameter id, value] pairs"))
+    output = models.ForeignKey(AnalysisOutput, related_name='sweep_points', null=True, blank=True,
+                               on_delete=models.SET_NULL)
+    collect_task_id = models.CharField(max_length=255, blank=True,
+                                       help_text=_("Id of the task to poll for the output, blank until the run starts"))
+    date_started = models.DateTimeField(null=True, blank=True,
+                                        help_text=_("When the sweep started the point's run, or shared an identical "
+                                                    "run already in progress"))
+
+    class Meta:
+        ordering = ['index']
+        unique_together = ('sweep', 'index')
+
+
 def _analysis_output_path(instance, filename):
     return os.path.join(instance.folder, 'outputs', filename)
 
@@ -498,6 +1213,32 @@ class AnalysisOutputFile(models.Model):
     def get_absolute_url(self):
         return reverse_lazy('core:output-download', args=[self.pk])
 
+    def reserve_path(self, filename):
+        """
+        Claim an unused name in storage for the output file so that it can be written in place instead of being copied
+        in through output_file.save. The file is created empty to keep concurrent writers from claiming the same name.
+
+        :return: the absolute path to write the file to
+        """
+        field = self.output_file.field
+        name = field.generate_filename(self, filename)
+        while True:
+            name = field.storage.get_available_name(name)
+            file_path = field.storage.path(name)
+            try:
+                os.makedirs(os.path.dirname(file_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.close(os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.output_file.name = name
+        return file_path
+
     def __unicode__(self):
         return u"output file {}".format(self.output_file)
 
@@ -518,6 +1259,14 @@ class DataTableGroupQuerySet(models.query.QuerySet):
                            models.Q(project__group__user=user) |
                            (models.Q(deleted_on__isnull=True) & models.Q(published_on__isnull=False))).distinct('id')
 
+    def with_schema_of(self, datatablegroup):
+        """
+        DataTableGroups in any project whose columns have the same schema signature as the given group
+        """
+        if not datatablegroup.schema_signature:
+            return self.none()
+        return self.filter(schema_signature=datatablegroup.schema_signature).exclude(pk=datatablegroup.pk)
+
 
 class DataTableGroupManager(models.Manager):
 
@@ -531,7 +1280,7 @@ class DataTableGroupManager(models.Manager):
         return DataTableGroup.objects.create(*args, **kwargs)
 
 
-class DataTableGroup(MiracleMetadataMixin):
+class DataTableGroup(DatasetConnectionMixin, MiracleMetadataMixin):
     """
     A DataTableGroup wraps schema + metadata for associated DataColumns. For example, an Excel file with N sheets where
     each sheet has a different schema would be represented as N DataTableGroups, and be archived with a single CSV
@@ -543,7 +1292,7 @@ class DataTableGroup(MiracleMetadataMixin):
     (http://www2.archivists.org/_groups/standards-committee/open-archival-information-system-oais)
     """
 
-    slug = AutoSlugField(populate_from='name', unique=True, overwrite=True)
+    slug = BulkAutoSlugField(populate_from='name', unique=True, overwrite=True)
     project = models.ForeignKey(Project, related_name="data_table_groups")
     provenance = JSONField(help_text=_("Provenance metadata for this DataTableGroup, applicable to all children"),
                            null=True, blank=True)
@@ -552,6 +1301,9 @@ class DataTableGroup(MiracleMetadataMixin):
     data_type = models.CharField(max_length=50, blank=True)
     schema = JSONField(help_text=_("Column schema for this DataTableGroup, applicable to all child DataTables"),
                        null=True, blank=True)
+    schema_signature = models.CharField(max_length=40, blank=True, db_index=True,
+                                        help_text=_("Order, case and whitespace insensitive hash of the column schema, "
+                                                    "blank if some columns are unnamed"))
     external_url = models.URLField(blank=True)
 
     objects = DataTableGroupManager.from_queryset(DataTableGroupQuerySet)()
@@ -560,6 +1312,28 @@ class DataTableGroup(MiracleMetadataMixin):
     def uploads_path(self):
         return os.path.join(self.project.uploads_path, 'data', self.slug)
 
+    @property
+    def table_name(self):
+        """
+        Name of the table holding the rows of this group's DataFiles in the datasets database. Only derived from the pk
+        so that renaming the group keeps its table.
+        """
+        return self.sanitize_identifier('datatablegroup')
+
+    def drop_table(self, cursor=None, table_name=None):
+        """
+        :param table_name: the table to drop, this group's by default. Deleted groups no longer have a pk so their
+                           table name has to be taken before the deletion.
+        """
+        if table_name is None:
+            table_name = self.table_name
+        statement = "DROP TABLE IF EXISTS {}".format(self.connection.ops.quote_name(table_name))
+        if cursor is None:
+            with self.cursor as cursor:
+                cursor.execute(statement)
+        else:
+            cursor.execute(statement)
+
     def get_absolute_url(self):
         return reverse_lazy('core:dataset-detail', args=[self.pk])
 
@@ -570,9 +1344,21 @@ class DataFile(models.Model):
     project = models.ForeignKey(Project, related_name='files')
     data_table_group = models.ForeignKey(DataTableGroup, null=True, related_name='files')
     archived_file = models.FileField(help_text=_("Archival data information package file"))
+    column_statistics = JSONField(help_text=_("Value, empty and null counts for each column of this file"),
+                                  null=True, blank=True)
+    layer_statistics = JSONField(help_text=_("Feature count, geometry type, extent and SRS for each layer of a "
+                                             "spatial file"),
+                                 null=True, blank=True)
+    column_order = JSONField(help_text=_("Index in this file of each of its DataTableGroup's columns, null if they "
+                                         "are in the same order"),
+                             null=True, blank=True)
+
+    @property
+    def is_spatial(self):
+        return os.path.splitext(self.archived_file.name)[1].lower() == '.shp'
 
 
-class DataColumn(models.Model):
+class DataColumn(DatasetConnectionMixin, models.Model):
 
     """
     Metadata for a Column in a given DataTableGroup to capture basic type and description info.
@@ -592,12 +1378,25 @@ class DataColumn(models.Model):
     description = models.TextField(blank=True)
     data_type = models.CharField(max_length=128, choices=DataType, default=DataType.text)
     table_order = models.PositiveIntegerField(default=1, help_text=_("This column's one-based index into the table"))
+    empty_count = models.PositiveIntegerField(default=0, help_text=_("Number of empty cells across all DataFiles"))
+    null_count = models.PositiveIntegerField(default=0,
+                                             help_text=_("Number of null markers (NA, NULL, ...) across all DataFiles"))
+    date_format = models.CharField(max_length=64, blank=True,
+                                   help_text=_("strptime format shared by all values of a date column, if any"))
+
+    @property
+    def column_name(self):
+        """ Name of this column in its DataTableGroup's table in the datasets database """
+        return self.sanitize_identifier(self.name)
 
     def all_values(self, distinct=False):
         ''' returns a list resulting from select name from data table using miracle_data database '''
-        statement = "SELECT {} {} FROM {}".format('DISTINCT' if distinct else '', self.name, self.table.name)
-        self.cursor.execute(statement)
-        return self.cursor.fetchall()
+        quote_name = self.connection.ops.quote_name
+        statement = "SELECT {} {} FROM {}".format('DISTINCT' if distinct else '', quote_name(self.column_name),
+                                                  quote_name(self.data_table_group.table_name))
+        with self.cursor as cursor:
+            cursor.execute(statement)
+            return cursor.fetchall()
 
     @property
     def project(self):
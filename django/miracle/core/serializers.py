@@ -118,6 +118,7 @@ class DataColumnSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = DataColumn
+        read_only_fields = ('empty_count', 'null_count', 'date_format')
 
 
 class DataTableGroupSerializer(serializers.HyperlinkedModelSerializer):
@@ -144,7 +145,8 @@ class DataFileSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = DataFile
-        fields = ('id', 'archived_file', 'ignored')
+        fields = ('id', 'archived_file', 'ignored', 'layer_statistics')
+        read_only_fields = ('layer_statistics',)
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -1,8 +1,8 @@
 from django.db import transaction
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from .models import Project, Group
+from .models import DataTableGroup, Project, Group
 
 
 @receiver(post_save, sender=Project)
@@ -17,3 +17,13 @@ def create_project_group(sender, instance, created, raw, using, update_fields, *
         group.user_set.add(instance.creator)
         instance.group = group
         instance.save()
+
+
+@receiver(post_delete, sender=DataTableGroup)
+def drop_datatablegroup_table(sender, instance, using, **kwargs):
+    """
+    Drop the rows loaded for a deleted DataTableGroup from the datasets database once the deletion is committed
+    """
+    # the deletion clears the pk before the transaction commits
+    table_name = instance.table_name
+    transaction.on_commit(lambda: instance.drop_table(table_name=table_name), using=using)
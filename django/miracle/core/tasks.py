@@ -1,60 +1,338 @@
 from __future__ import absolute_import
 
-from django.core import files
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
 from celery import chain
+from celery.exceptions import Retry
+from celery.utils import uuid
 
 from miracle.celery import app
 from . import deployr
-from .models import DataAnalysisScript, AnalysisOutput, ParameterValue, AnalysisParameter
+from .models import (DataAnalysisScript, AnalysisOutput, AnalysisOutputFile, ParameterValue, AnalysisParameter,
+                     AnalysisSweep, AnalysisSweepPoint, sweep_size)
 
 import os
 
 # Metadata Pipeline Imports
-from .ingest import pipeline
+from .ingest import loader, pipeline, rasters, IngestInProgress
 
-import json
 import logging
+import random
 
 logger = logging.getLogger(__name__)
 
-@app.task(bind=True)
-def run_analysis_task(self, analysis_id, parameters, user=None):
+def start_analysis_run(analysis_id, parameters, user):
+    """
+    Start running an analysis on deployr, see request_analysis_run
+
+    :return: the AsyncResult to poll for the AnalysisOutput, that of the check_analysis_job task collecting it
+    """
+    output, task_id = request_analysis_run(analysis_id, parameters, user)
+    return check_analysis_job.AsyncResult(task_id)
+
+
+def request_analysis_run(analysis_id, parameters, user):
+    """
+    Start running an analysis on deployr
+
+    Runs are cached by DataAnalysisScript.output_cache_key: when the analysis already ran with the same parameter values,
+    script and packages the existing output is returned, and when an identical run is in progress it is shared.
+
+    :return: the AnalysisOutput of the run and the id of the task to poll for it
+    """
     if user is None:
         raise ValueError("Must pass in a Django User to execute analysis {}".format(user))
     logger.debug("user %s requesting script execution (%s) with parameters (type: %s) %s", user, analysis_id,
                  type(parameters), parameters)
-    analysis = DataAnalysisScript.objects.get(pk=analysis_id)
+    with transaction.atomic():
+        # lock the analysis so that identical requests arriving together do not both start a run
+        analysis = DataAnalysisScript.objects.select_for_update().get(pk=analysis_id)
+        cache_key = analysis.output_cache_key(parameters)
+        cached = AnalysisOutput.objects.cached(cache_key)
+        if cached is not None:
+            logger.debug("returning cached output %s of analysis %s", cached.pk, analysis_id)
+            task_id = uuid()
+            check_analysis_job.backend.mark_as_done(task_id, cached)
+            return cached, task_id
+        running = AnalysisOutput.objects.running(cache_key)
+        if running is not None:
+            logger.debug("sharing run %s of analysis %s", running.pk, analysis_id)
+            return running, running.collect_task_id
+
+        output = AnalysisOutput.objects.create(analysis=analysis, name=analysis.default_output_name, creator=user,
+                                               cache_key=cache_key, collect_task_id=uuid(),
+                                               monitored=settings.DEPLOYR_JOB_MONITOR)
+        for parameter in parameters:
+            analysis_parameter = AnalysisParameter.objects.get(id=parameter['id'])
+            ParameterValue.objects.create(parameter=analysis_parameter, output=output, value=parameter['value'])
+        transaction.on_commit(lambda: run_analysis_task.delay(output.pk, parameters, user=user))
+    return output, output.collect_task_id
+
+
+@app.task(bind=True)
+def run_analysis_task(self, output_id, parameters, user=None):
+    """
+    Submit the analysis run of an AnalysisOutput to deployr and schedule check_analysis_job, under the output's
+    collect_task_id, to collect its output once it completes. With DEPLOYR_JOB_MONITOR the job is left to the
+    monitor_analysis_jobs process instead, which schedules check_analysis_job when the job has finished.
+    """
+    output = AnalysisOutput.objects.select_related('analysis__project').get(pk=output_id)
+    analysis = output.analysis
+    try:
+        deployr_input_parameters_dict = analysis.to_deployr_input_parameters(parameters)
+        job = deployr.submit_script(script_name=analysis.basename, parameters=deployr_input_parameters_dict,
+                                    workdir=analysis.project.slug, user=user,
+                                    job_name='{}-{}'.format(analysis.name, output.pk))
+    except Exception as e:
+        output.job_status = 'Failed'
+        output.save(update_fields=['job_status'])
+        # the output will never be collected, report the failure under the id clients poll
+        self.backend.mark_as_failure(output.collect_task_id, e)
+        raise
+    output.job_id = job.job_id
+    output.job_status = 'Submitted'
+    output.save(update_fields=['job_id', 'job_status'])
+    if output.monitored:
+        return output.collect_task_id
+    return check_analysis_job.apply_async((output.pk, job.job_id), {'user': user}, task_id=output.collect_task_id,
+                                          countdown=settings.DEPLOYR_JOB_POLL_INITIAL).id
 
-    output = AnalysisOutput.objects.create(analysis=analysis, name=analysis.default_output_name, creator=user)
-    for parameter in parameters:
-        analysis_parameter = AnalysisParameter.objects.get(id=parameter['id'])
-        ParameterValue.objects.create(parameter=analysis_parameter, output=output, value=parameter['value'])
-    deployr_input_parameters_dict = analysis.to_deployr_input_parameters(parameters)
-    self.update_state(state='PROCESSING')
-    job = deployr.run_script(script_name=analysis.basename, parameters=deployr_input_parameters_dict,
-                             workdir=analysis.project.slug, user=user,
-                             job_name='{}-{}'.format(analysis.name, output.pk))
-    output.response = job.response.text
-    output.save()
-    self.update_state(state='RETRIEVING_OUTPUT',
-                      meta={'response': output.response})
-    results = job.retrieve_files()
-    # results is a list of tuples (file, metadata)
-    for result in results:
-        temporary_file = result[0]
-        metadata = result[1]
-        logger.debug("creating analysis output file from [%s, %s]", temporary_file, metadata)
-        with open(temporary_file, 'rb') as output_file:
-            # metadata is a python dict at this point, still need to serialize it back to JSON before storing it
-            analysis_output_file = output.files.create(metadata=json.dumps(metadata))
-            analysis_output_file.output_file.save(metadata['filename'], files.File(output_file), save=True)
-    self.update_state(state='COMPLETED',
+
+@app.task(bind=True, max_retries=None)
+def check_analysis_job(self, output_id, job_id, user=None):
+    """
+    Store the results of a completed deployr job in its AnalysisOutput
+
+    Jobs that are still running are checked again later, waiting DEPLOYR_JOB_POLL_INITIAL seconds and then twice as
+    long after every check up to DEPLOYR_JOB_POLL_MAX seconds, so that no worker ever sleeps on a job. The output is
+    marked as failed when it cannot be collected, so that identical runs are no longer coalesced onto it.
+    """
+    output = AnalysisOutput.objects.get(pk=output_id)
+    try:
+        return _collect_analysis_output(self, output, job_id, user)
+    except Retry:
+        raise
+    except Exception:
+        if output.job_status not in AnalysisOutput.FAILED_STATUSES:
+            output.job_status = 'Failed'
+            output.save(update_fields=['job_status'])
+        raise
+
+
+def _collect_analysis_output(task, output, job_id, user):
+    with deployr.login(user, pool_size=settings.DEPLOYR_DOWNLOAD_CONCURRENCY) as session:
+        job = deployr.Job(session, job_id=job_id)
+        if job.check_status() is None:
+            checks = task.request.retries + 1
+            if checks >= settings.DEPLOYR_JOB_MAX_CHECKS:
+                output.job_status = AnalysisOutput.JOB_TIMEOUT
+                output.save(update_fields=['job_status'])
+                raise deployr.DeployrJobTimeout("job {} did not complete in {} checks".format(job_id, checks))
+            countdown = min(settings.DEPLOYR_JOB_POLL_INITIAL * 2 ** task.request.retries,
+                            settings.DEPLOYR_JOB_POLL_MAX)
+            logger.debug("job %s has not completed, checking again in %ss", job_id, countdown)
+            raise task.retry(countdown=countdown)
+        output.response = job.response.text
+        output.job_status = job.status
+        output.save()
+        task.update_state(state='RETRIEVING_OUTPUT',
+                          meta={'response': output.response})
+        # files are downloaded straight to the storage paths reserved for them
+        output_files = {}
+
+        def destination(result):
+            output_file = AnalysisOutputFile(output=output)
+            file_path = output_file.reserve_path(result['filename'])
+            output_files[file_path] = output_file
+            return file_path
+        try:
+            transfers = job.retrieve_files(destination)
+        except:
+            for file_path in output_files:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            raise
+    for transfer in transfers:
+        logger.debug("creating analysis output file %s from %s", transfer.path, transfer.result)
+        output_file = output_files[transfer.path]
+        output_file.metadata = dict(transfer.result, transfer={'bytes': transfer.bytes, 'seconds': transfer.seconds})
+        output_file.save()
+    # only now is the output complete enough to be returned for identical runs
+    output.date_completed = timezone.now()
+    output.save(update_fields=['date_completed'])
+    task.update_state(state='COMPLETED',
                       meta={'output_id': output.pk})
     return output
 
 
+def start_analysis_sweep(analysis_id, user, values=None, samples=None, concurrency=None, seed=None):
+    """
+    Run an analysis over the Cartesian product of parameter values, or a random sample of its points
+
+    :param values: dict of AnalysisParameter id to the list of values to run it with, parameters left out run
+                   through their AnalysisParameter.sweep_values
+    :param samples: number of points to sample, all of them if None
+    :param concurrency: maximum number of runs in progress at once, ANALYSIS_SWEEP_CONCURRENCY by default
+    :return: the AnalysisSweep
+    """
+    if values is None:
+        values = {}
+    if concurrency is None:
+        concurrency = settings.ANALYSIS_SWEEP_CONCURRENCY
+    analysis = DataAnalysisScript.objects.get(pk=analysis_id)
+    parameters = list(analysis.parameters.all())
+    unknown = set(values) - set(parameter.pk for parameter in parameters)
+    if unknown:
+        raise ValueError("analysis {} has no parameters {}".format(analysis_id, sorted(unknown)))
+    # value ranges are only sized here, their values are computed for the points that are run
+    parameter_values = [(parameter.pk, list(values[parameter.pk]) if values.get(parameter.pk)
+                         else parameter.sweep_values())
+                        for parameter in parameters]
+    total = 1
+    for parameter_id, sweep_values in parameter_values:
+        total *= sweep_size(sweep_values)
+    n_points = total if samples is None else min(samples, total)
+    if n_points > settings.ANALYSIS_SWEEP_MAX_POINTS:
+        raise ValueError("sweep of {} points exceeds the limit of {}".format(n_points,
+                                                                           settings.ANALYSIS_SWEEP_MAX_POINTS))
+    points = AnalysisSweep.expand(parameter_values, samples=samples, rng=random.Random(seed))
+    with transaction.atomic():
+        sweep = AnalysisSweep.objects.create(analysis=analysis, creator=user, concurrency=max(concurrency, 1),
+                                             sampled=n_points < total)
+        AnalysisSweepPoint.objects.bulk_create([AnalysisSweepPoint(sweep=sweep, index=index, values=point)
+                                                for index, point in enumerate(points)])
+        transaction.on_commit(lambda: advance_sweep.delay(sweep.pk))
+    return sweep
+
+
+@app.task(bind=True, max_retries=None)
+def advance_sweep(self, sweep_id):
+    """
+    Start the pending runs of a sweep while fewer than its concurrency are in progress, checking again every
+    ANALYSIS_SWEEP_POLL_INTERVAL seconds until all of them have finished
+
+    :return: the progress of the completed sweep
+    """
+    sweep = AnalysisSweep.objects.select_related('analysis', 'creator').get(pk=sweep_id)
+    while True:
+        progress = sweep.progress()
+        available = sweep.concurrency - progress['running']
+        if available <= 0 or not progress['pending']:
+            break
+        # cached runs finish as soon as they start so keep going until the sweep is at its concurrency
+        for point in sweep.points.filter(collect_task_id='')[:available]:
+            try:
+                parameters = sweep.analysis.run_parameters(dict(point.values))
+                point.output, point.collect_task_id = request_analysis_run(sweep.analysis_id, parameters,
+                                                                           sweep.creator)
+            except Exception:
+                # count the point as failed instead of leaving the rest of the sweep pending forever
+                logger.exception("could not start point %s of sweep %s", point.index, sweep_id)
+                point.output, point.collect_task_id = None, AnalysisSweepPoint.NOT_STARTED
+            point.date_started = timezone.now()
+            point.save(update_fields=['output', 'collect_task_id', 'date_started'])
+    if progress['pending'] or progress['running']:
+        raise self.retry(countdown=settings.ANALYSIS_SWEEP_POLL_INTERVAL)
+    sweep.date_completed = timezone.now()
+    sweep.save(update_fields=['date_completed'])
+    logger.debug("sweep %s finished: %s", sweep_id, progress)
+    return progress
+
+
+def metadata_pipeline_chain(project, archive=None, delete_archive_on_failure=True, stages=pipeline.STAGES):
+    """
+    Build a chain of tasks running the given metadata pipeline stages. Stages exchange their outputs through
+    checkpoints so they can run on different workers.
+
+    The id of the last task in the chain is the one to poll: when an earlier stage fails it is marked as failed too.
+    """
+    final_task_id = uuid()
+    signatures = [run_metadata_pipeline_stage.si(project, stage, archive, delete_archive_on_failure, final_task_id)
+                  for stage in stages]
+    signatures[-1].set(task_id=final_task_id)
+    return chain(*signatures)
+
+
+def start_metadata_pipeline(project, archive, delete_archive_on_failure=True):
+    """
+    Start ingesting a newly submitted project archive
+
+    :return: the AsyncResult to poll for completion
+    """
+    if pipeline.is_running(project):
+        raise IngestInProgress("project {} is still being ingested".format(project))
+    if pipeline.is_incomplete(project):
+        logger.debug("discarding incomplete ingest of project %s", project)
+        pipeline.cleanup_on_error(project, archive, delete_archive_on_failure=False)
+    if project.manifest.exists():
+        # already ingested, only re-analyze the files that changed
+        return run_metadata_update.delay(project, archive, delete_archive_on_failure)
+    return metadata_pipeline_chain(project, archive, delete_archive_on_failure).apply_async()
+
+
+@app.task(bind=True)
+def run_metadata_pipeline_stage(self, project, stage, archive=None, delete_archive_on_failure=True,
+                                final_task_id=None):
+    logger.debug("running metadata pipeline stage %s for project %s", stage, project)
+    try:
+        pipeline.run_stage(project, stage, archive, delete_archive_on_failure=delete_archive_on_failure)
+    except Exception as e:
+        if final_task_id and final_task_id != self.request.id:
+            # the remaining stages of the chain will never run, report the failure under the id clients poll
+            self.backend.mark_as_failure(final_task_id, e)
+        raise
+    if stage == 'load_project':
+        sync_deployr.delay(project)
+    if stage == pipeline.STAGES[-1]:
+        process_project_rasters.delay(project)
+
+
 @app.task(bind=True)
 def run_metadata_pipeline(self, project, archive, delete_archive_on_failure=True):
     logger.debug("running metadata pipeline for project %s on archive %s", project, archive)
-    return pipeline.run(project, archive, delete_archive_on_failure=delete_archive_on_failure)
+    return metadata_pipeline_chain(project, archive, delete_archive_on_failure).apply_async().id
+
+
+@app.task(bind=True)
+def resume_metadata_pipeline(self, project):
+    stages = pipeline.remaining_stages(project)
+    logger.debug("resuming metadata pipeline for project %s with stages %s", project, stages)
+    return metadata_pipeline_chain(project, stages=stages).apply_async().id
+
+
+@app.task(bind=True)
+def run_metadata_update(self, project, archive, delete_archive_on_failure=True):
+    logger.debug("running incremental metadata pipeline for project %s on archive %s", project, archive)
+    result = pipeline.update(project, archive, delete_archive_on_failure=delete_archive_on_failure)
+    sync_deployr.delay(project)
+    process_project_rasters.delay(project)
+    return result
+
+
+@app.task(bind=True)
+def process_project_rasters(self, project, refresh=False):
+    """
+    Compute band statistics and build overviews for the rasters of an ingested project, see ingest.rasters
+    """
+    n_rasters = rasters.process_rasters(project, refresh=refresh)
+    logger.debug("processed %s rasters of project %s", n_rasters, project)
+    return n_rasters
+
+
+@app.task(bind=True)
+def sync_deployr(self, project=None):
+    """
+    Make the deployr calls recorded in the engine sync outbox, see ingest.loader.load_deployr. Runs again when the
+    next failed call is due for a retry, and periodically through CELERYBEAT_SCHEDULE so that calls are still made
+    when that run is lost or the worker dies mid-sync.
+    """
+    attempted = loader.sync_deployr(project)
+    pending = loader.pending_deployr_operations(project)
+    if pending.exists() and attempted:
+        next_attempt = pending.aggregate(next_attempt=Min('next_attempt'))['next_attempt']
+        countdown = max((next_attempt - timezone.now()).total_seconds(), 0)
+        logger.debug("retrying deployr sync of project %s in %.0fs", project, countdown)
+        sync_deployr.apply_async((project,), countdown=countdown)
+    return pending.count()
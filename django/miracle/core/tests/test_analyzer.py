@@ -1,9 +1,17 @@
+import collections
+import mock
 import os
+import shutil
+import tempfile
+import time
 from django.test.utils import override_settings
 
-from ..ingest.analyzer import (group_files, ShapefileFileGroup, ProjectGroupedFilePaths,
-                               OtherFile, extract_metadata, sanitize_ext, TabularLoader)
-from ..ingest.unarchiver import ProjectFilePaths
+from ..ingest import analyzer
+from ..ingest.analyzer import (group_files, ShapefileFileGroup, ProjectGroupedFilePaths, ColumnTypeInference,
+                               OtherFile, analyze_paths, extract_metadata, sanitize_ext, TabularLoader, _cache_keys)
+from ..ingest.unarchiver import ProjectFilePaths, validate_archive
+from ..benchmarks import generate_archive, generate_project
+from ..models import MetadataCacheEntry
 from .common import BaseMiracleTest
 
 
@@ -25,6 +33,12 @@ class AnalyzerTest(BaseMiracleTest):
         self.assertItemsEqual(columns,
                               ((u'Density', 'decimal'), (u'Name', 'text'),
                                (u'Created', 'date'), (u'Population', 'decimal')))
+        statistics = data.properties['layers'][0]
+        self.assertEqual(statistics['features'], 3)
+        self.assertEqual(statistics['geometry_type'], 'Point')
+        for actual, expected in zip(statistics['extent'], (-165.27, -53.15, 177.13, 78.2)):
+            self.assertAlmostEqual(actual, expected, places=2)
+        self.assertIn('WGS_1984', statistics['srs'])
 
     def test_asc(self):
         test_data = self.get_test_data("sample.asc")
@@ -49,6 +63,24 @@ class AnalyzerTest(BaseMiracleTest):
         data = extract_metadata(self.get_test_data("headless.csv"))
         self.assertEqual(data.layers[0], (None, ((None, 'bigint'), (None, 'text'), (None, 'date'))))
 
+    def test_delimiters_are_detected(self):
+        folder = tempfile.mkdtemp()
+        try:
+            tsv_path = os.path.join(folder, "table.tsv")
+            with open(tsv_path, "wb") as f:
+                f.write("id\tnames\n1\ta,b\n2\tc\n")
+            data = extract_metadata(tsv_path)
+            self.assertEqual(data.layers[0], (None, (('id', 'bigint'), ('names', 'text'))))
+            self.assertEqual(data.properties['delimiter'], '\t')
+
+            csv_path = os.path.join(folder, "semicolons.csv")
+            with open(csv_path, "wb") as f:
+                f.write("id;weight\n1;2.5\n3;4\n")
+            data = extract_metadata(csv_path)
+            self.assertEqual(data.layers[0], (None, (('id', 'bigint'), ('weight', 'decimal'))))
+        finally:
+            shutil.rmtree(folder)
+
     def test_netlogocsv(self):
         data = extract_metadata(self.get_test_data("netlogo.csv"))
         return True
@@ -68,6 +100,142 @@ class AnalyzerTest(BaseMiracleTest):
                               ((u'Density', 'decimal'), (u'Name', 'text'),
                                (u'Created', 'date'), (u'Population', 'decimal')))
 
+    def test_analyze_paths_in_parallel(self):
+        paths = ["head.csv", "cities.shp", "missing.shp", "sample.asc"]
+        metadata = analyze_paths(self.TEST_DATA_DIR, paths, processes=2)
+        self.assertItemsEqual(metadata.keys(), paths)
+        self.assertEqual(metadata["head.csv"].layers[0], (None, (('ID', 'bigint'), ('Town', 'text'))))
+        self.assertEqual(metadata["sample.asc"].properties.get('width'), 4)
+        # a file that cannot be read is recorded as an error instead of aborting the analysis
+        self.assertEqual(metadata["missing.shp"].layers, [])
+        self.assertEqual(len(metadata["missing.shp"].errors), 1)
+
+    def test_stuck_workers_are_replaced(self):
+        def analyze_path(project_folder, file_path):
+            if file_path.startswith("stuck"):
+                time.sleep(60)
+            return analyzer._failed_metadata(file_path, "analyzed")
+        paths = ["stuck.csv", "a.csv", "b.csv", "c.csv"]
+        with mock.patch.object(analyzer, '_analyze_path', analyze_path), \
+                mock.patch.object(analyzer, 'FORMAT_TIMEOUTS', collections.defaultdict(lambda: 1)):
+            metadata = analyze_paths(self.TEST_DATA_DIR, paths, processes=2)
+        self.assertEqual(metadata["stuck.csv"].errors, ["timed out after 1 seconds"])
+        # files queued behind the stuck one still run
+        for file_path in paths[1:]:
+            self.assertEqual(metadata[file_path].errors, ["analyzed"])
+
+    def test_file_groups_are_analyzed_lazily(self):
+        file_group = OtherFile(self.get_test_data("head.csv"), 0)
+        self.assertFalse(file_group.is_analyzed)
+        self.assertEqual(file_group.metadata.layers[0], (None, (('ID', 'bigint'), ('Town', 'text'))))
+        self.assertTrue(file_group.is_analyzed)
+
+        folder = tempfile.mkdtemp()
+        try:
+            paths = ["data/head.csv", "docs/head.csv"]
+            for file_path in paths:
+                os.mkdir(os.path.join(folder, os.path.dirname(file_path)))
+                shutil.copy(self.get_test_data("head.csv"), os.path.join(folder, file_path))
+            project_grouped_file_paths = group_files(ProjectFilePaths(project_token="test", paths=paths),
+                                                     project_folder=folder, digests={})
+            # only files that are loaded as data or analyses are analyzed up front
+            self.assertEqual([file_group.is_analyzed for file_group in project_grouped_file_paths.grouped_paths],
+                             [True, False])
+            # the deferred analysis reads the file from the project folder whatever the current directory is
+            cwd = os.getcwd()
+            os.chdir(tempfile.gettempdir())
+            try:
+                self.assertEqual(project_grouped_file_paths.grouped_paths[1].metadata.layers[0],
+                                 (None, (('ID', 'bigint'), ('Town', 'text'))))
+            finally:
+                os.chdir(cwd)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_metadata_is_cached_by_digest(self):
+        metadata = analyze_paths(self.TEST_DATA_DIR, ["head.csv", "missing.shp"],
+                                 digests={"head.csv": "a" * 64, "missing.shp": "b" * 64})
+        self.assertEqual(MetadataCacheEntry.objects.count(), 1)
+        # another file with the same contents is not analyzed again
+        cached = analyze_paths(self.TEST_DATA_DIR, ["headless.csv"], digests={"headless.csv": "a" * 64})
+        self.assertEqual(cached["headless.csv"].path, "headless.csv")
+        self.assertEqual(cached["headless.csv"].layers, metadata["head.csv"].layers)
+
+        # the extension and the type inference settings are part of the key
+        keys = _cache_keys(["head.csv", "head.tsv"], {"head.csv": "a" * 64, "head.tsv": "a" * 64})
+        self.assertNotEqual(keys["head.csv"], keys["head.tsv"])
+        with override_settings(TYPE_INFERENCE_SAMPLE_ROWS=10):
+            self.assertNotEqual(_cache_keys(["head.csv"], {"head.csv": "a" * 64})["head.csv"], keys["head.csv"])
+        # an entry cached by a concurrent ingest in the meantime is skipped
+        with mock.patch.object(MetadataCacheEntry.objects, 'filter', return_value=MetadataCacheEntry.objects.none()):
+            MetadataCacheEntry.objects.set_many({"head.csv": keys["head.csv"]}, metadata)
+        self.assertEqual(MetadataCacheEntry.objects.count(), 1)
+
+        with mock.patch.object(TabularLoader, 'VERSION', TabularLoader.VERSION + 1):
+            analyzed = analyze_paths(self.TEST_DATA_DIR, ["headless.csv"], digests={"headless.csv": "a" * 64})
+        self.assertNotEqual(analyzed["headless.csv"].layers, metadata["head.csv"].layers)
+        self.assertEqual(MetadataCacheEntry.objects.invalidate(keep_version=TabularLoader.VERSION), 1)
+
+        with override_settings(METADATA_CACHE_MAX_BYTES=0):
+            MetadataCacheEntry.objects.evict()
+        self.assertFalse(MetadataCacheEntry.objects.exists())
+
+    def test_column_types_are_inferred_from_every_row(self):
+        folder = tempfile.mkdtemp()
+        csv_path = os.path.join(folder, "late.csv")
+        with open(csv_path, "wb") as f:
+            f.write("id,value,flag\n")
+            for i in xrange(25000):
+                f.write("{},{},{}\n".format(i, i, "" if i % 2 else "true"))
+            f.write("25000,0.5,NA\n")
+        try:
+            data = extract_metadata(csv_path)
+            self.assertEqual(data.layers[0], (None, (('id', 'bigint'), ('value', 'decimal'), ('flag', 'boolean'))))
+            self.assertEqual(data.properties['rows'], 25001)
+            self.assertEqual(data.properties['column_statistics'][2], {"values": 12500, "empty": 12500, "null": 1, "date_format": None})
+
+            with override_settings(TYPE_INFERENCE_MAX_BYTES=0, TYPE_INFERENCE_SAMPLE_ROWS=100):
+                data = extract_metadata(csv_path)
+            self.assertTrue(data.properties['sampled'])
+            self.assertEqual(data.properties['rows'], 25001)
+            # the types come from the sample but the counts still cover every row
+            self.assertEqual(data.properties['column_statistics'][2], {"values": 12500, "empty": 12500, "null": 1, "date_format": None})
+        finally:
+            shutil.rmtree(folder)
+
+    def test_batched_classification_matches_per_cell(self):
+        chunks = [
+            ["1", " 2 ", "", "NA", "-3"],
+            ["1", "2", "null", "na"],
+            ["4.5", "1e5", "", "  "],
+            ["true", "'No'", "F", "N/A", ""],
+            ["1", "multi\nline", "NULL "],
+            ["00", "x", "None"],
+        ]
+        for n in xrange(1, len(chunks) + 1):
+            for start in xrange(len(chunks) - n + 1):
+                batched = ColumnTypeInference()
+                per_cell = ColumnTypeInference()
+                for chunk in chunks[start:start + n]:
+                    batched.update(chunk)
+                    per_cell.update_per_cell(chunk)
+                self.assertEqual((batched.data_type, batched.statistics), (per_cell.data_type, per_cell.statistics))
+
+    def test_date_format_is_learned(self):
+        inference = ColumnTypeInference()
+        inference.update(["2016-01-02", "", "2016-12-31"])
+        self.assertEqual(inference.data_type, "date")
+        self.assertEqual(inference.statistics["date_format"], "%Y-%m-%d")
+        # dateutil still accepts other spellings but the column no longer has a single format
+        inference.update(["Jan 3 2016"])
+        self.assertEqual(inference.data_type, "date")
+        self.assertIsNone(inference.statistics["date_format"])
+        inference.update(["not a date"])
+        self.assertEqual(inference.data_type, "text")
+
+        data = extract_metadata(self.get_test_data("headless.csv"))
+        self.assertEqual(data.properties["column_statistics"][2]["date_format"], "%a %b %d %H:%M:%S UTC %Y")
+
     def test_guess_type(self):
         self.assertEqual(TabularLoader._guess_type(("1.0","2.0")), "decimal")
         self.assertEqual(TabularLoader._guess_type(("1","-2.0")), "decimal")
@@ -85,3 +253,25 @@ class AnalyzerTest(BaseMiracleTest):
 
         self.assertEqual(TabularLoader._guess_type((' "t"', ' false')), "boolean")
         self.assertEqual(TabularLoader._guess_type((' "t"', 'faLse')), "boolean")
+
+    def test_synthetic_project(self):
+        folder = tempfile.mkdtemp()
+        try:
+            archive = generate_archive(folder, "synthetic", data_files=2, rows=20, columns=3, features=5,
+                                       raster_size=8)
+            validate_archive(archive, "synthetic")
+
+            root = generate_project(folder, "project", data_files=2, rows=20, columns=3, features=5, raster_size=8)
+            data = os.path.join(root, "project", "data")
+            tables = [extract_metadata(os.path.join(data, name)) for name in ("table0.csv", "table1.csv")]
+            self.assertEqual(tables[0].layers, tables[1].layers)
+            self.assertEqual(tables[0].properties['rows'], 20)
+            netlogo = extract_metadata(os.path.join(data, "experiment0.csv"))
+            self.assertEqual(netlogo.properties['model_name'], ["experiment"])
+            sites = extract_metadata(os.path.join(data, "sites0.shp"))
+            self.assertEqual(sites.properties['layers'][0]['features'], 5)
+            self.assertItemsEqual(sites.layers[0][1], ((u'ID', 'bigint'), (u'VALUE', 'decimal'), (u'NAME', 'text')))
+            elevation = extract_metadata(os.path.join(data, "elevation0.asc"))
+            self.assertEqual(elevation.properties.get('width'), 8)
+        finally:
+            shutil.rmtree(folder)
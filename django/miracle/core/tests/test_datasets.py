@@ -0,0 +1,25 @@
+import os
+import shutil
+
+from .common import BaseMiracleTest
+from ..ingest.datasets import load_datatablegroup_rows
+from ..models import DataColumn, DataFile
+
+
+class DatasetsTest(BaseMiracleTest):
+
+    def test_single_column_nulls(self):
+        project = self.default_project
+        datatablegroup = self.create_data_table_group(name='single')
+        column = DataColumn.objects.create(data_table_group=datatablegroup, name='value', data_type='bigint')
+        os.makedirs(os.path.join(project.project_path, 'data'))
+        try:
+            with open(os.path.join(project.project_path, 'data', 'single.csv'), 'w') as f:
+                f.write("value\n1\n\n3\n99999999999999999999\n")
+            DataFile.objects.create(project=project, data_table_group=datatablegroup, archived_file='data/single.csv')
+            # empty cells of a one column file and values that do not fit a bigint are loaded as NULL
+            self.assertEqual(load_datatablegroup_rows(datatablegroup, project), 4)
+            self.assertItemsEqual(column.all_values(), [(1,), (None,), (3,), (None,)])
+        finally:
+            shutil.rmtree(project.project_path)
+            datatablegroup.drop_table()
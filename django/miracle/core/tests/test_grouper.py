@@ -1,6 +1,7 @@
 from .common import BaseMiracleTest
 from ..ingest.analyzer import ShapefileFileGroup, OtherFile, Metadata, DataTypes
-from ..ingest.grouper import MetadataDataTableGroup, to_datatablegroups, group_metadata
+from ..ingest.grouper import (MetadataDataTableGroup, to_datatablegroups, group_metadata, schema_signature,
+                               column_order)
 from ..ingest import ProjectGroupedFilePaths
 
 class MetadataGrouperTest(BaseMiracleTest):
@@ -42,7 +43,33 @@ class MetadataGrouperTest(BaseMiracleTest):
             to_datatablegroups(metadata.grouped_paths[i], column_metadata, datatablegroups)
 
         column_sets = column_metadata.keys()
-        self.assertIn((("a", "Real"), ("d", "String")), column_sets)
-        self.assertIn((("id", "Real"), ("count", "Real")), column_sets)
+        self.assertIn(schema_signature((("a", "Real"), ("d", "String"))), column_sets)
+        self.assertIn(schema_signature((("id", "Real"), ("count", "Real"))), column_sets)
         self.assertEqual(len(column_sets), 2)
         self.assertEqual(len(datatablegroups), 1)
+
+    def test_schema_signature(self):
+        columns = (("ID", "bigint"), ("Town Name", "text"))
+        self.assertEqual(schema_signature(columns), schema_signature(((u" town  name", "text"), ("id", "bigint"))))
+        self.assertNotEqual(schema_signature(columns), schema_signature((("ID", "text"), ("Town Name", "text"))))
+        # unnamed or ambiguous columns never match other files
+        self.assertIsNone(schema_signature(((None, "bigint"), ("Town Name", "text"))))
+        self.assertIsNone(schema_signature((("id", "bigint"), ("ID", "bigint"))))
+        self.assertIsNone(schema_signature(()))
+
+        self.assertIsNone(column_order(columns, (("id", "bigint"), ("town name", "text"))))
+        self.assertEqual(column_order(columns, (("Town Name", "text"), ("ID", "bigint"))), [1, 0])
+
+    def test_reordered_columns_are_grouped(self):
+        m1 = Metadata("data/a.csv", DataTypes.data, {}, [(None, (("ID", "bigint"), ("Town", "text")))])
+        m2 = Metadata("data/b.csv", DataTypes.data, {}, [(None, (("town ", "text"), ("id", "bigint")))])
+        column_metadata = {}
+        datatablegroups = []
+        to_datatablegroups(OtherFile(file_path="data/a.csv", ind=0, metadata=m1), column_metadata, datatablegroups)
+        to_datatablegroups(OtherFile(file_path="data/b.csv", ind=1, metadata=m2), column_metadata, datatablegroups)
+
+        self.assertEqual(len(column_metadata), 1)
+        datatablegroup = column_metadata.values()[0]
+        self.assertEqual(datatablegroup.properties, (("ID", "bigint"), ("Town", "text")))
+        self.assertEqual([datafile.columns for datafile in datatablegroup.datafiles],
+                         [(("ID", "bigint"), ("Town", "text")), (("town ", "text"), ("id", "bigint"))])
@@ -2,11 +2,15 @@ import os
 import mock
 import requests
 
+from django.utils import timezone
+
 from .common import BaseMiracleTest
-from ..ingest.loader import load_analyses, load_datatablegroup, load_deployr
-from ..ingest.grouper import MetadataProject, MetadataAnalysis, MetadataDataTableGroup, MetadataDataFile
-from ..models import DataAnalysisScript, DataTableGroup
-from .. import utils
+from ..ingest.loader import (load_analyses, load_datatablegroup, load_datatablegroups, load_deployr, sync_deployr,
+                             pending_deployr_operations)
+from ..ingest.grouper import (MetadataProject, MetadataAnalysis, MetadataDataTableGroup, MetadataDataFile,
+                               schema_signature)
+from ..models import DataAnalysisScript, DataTableGroup, EngineSyncOperation
+from ..deployr import DeployrAPI, DeployrUnexpectedStatusCode
 
 class MetadataGroupLoadersTest(BaseMiracleTest):
     TEST_PROJECT_DIRECTORY = os.path.join(os.getcwd(),
@@ -53,6 +57,48 @@ class MetadataGroupLoadersTest(BaseMiracleTest):
 
         a_datatablegroup = DataTableGroup.objects.filter(name="datagroup a").first()
         self.assertEquals(len(a_datatablegroup.columns.filter(name="", data_type="String")), 1)
+        self.assertEqual(a_datatablegroup.schema_signature, "")
+
+    def test_load_datatablegroups_in_bulk(self):
+        project = self.create_project(name="test")
+        DataTableGroup.objects.create_data_group(name="data", project=project)
+        metadata_datatablegroups = []
+        for g in xrange(3):
+            columns = (("id{}".format(g), "bigint"),)
+            datafiles = [MetadataDataFile(name=str(f), path="data/{}/{}.csv".format(g, f), columns=columns)
+                         for f in xrange(50)]
+            metadata_datatablegroups.append(MetadataDataTableGroup(name="data", properties=columns,
+                                                                   datafiles=datafiles))
+
+        # slug lookup and one insert each for groups, columns and files
+        with self.assertNumQueries(4):
+            datatablegroups = load_datatablegroups(metadata_datatablegroups, project)
+        self.assertEqual([datatablegroup.slug for datatablegroup in datatablegroups], ["data-2", "data-3", "data-4"])
+        self.assertEqual(project.files.count(), 150)
+        self.assertEqual(datatablegroups[1].columns.get().name, "id1")
+
+        datatablegroups[0].name = "renamed"
+        datatablegroups[0].save()
+        self.assertEqual(datatablegroups[0].slug, "renamed")
+
+    def test_load_reordered_datafiles(self):
+        project = self.create_project(name="test")
+        columns = (("id", "bigint"), ("town", "text"))
+        statistics = [{"values": 1, "empty": 0, "null": 0, "date_format": None},
+                      {"values": 0, "empty": 1, "null": 0, "date_format": None}]
+        d1 = MetadataDataFile(name="a", path="data/a.csv", column_statistics=statistics, columns=columns)
+        d2 = MetadataDataFile(name="b", path="data/b.csv", column_statistics=statistics,
+                              columns=(("Town", "text"), ("ID", "bigint")))
+        datatablegroup = load_datatablegroup(MetadataDataTableGroup(name="towns", properties=columns,
+                                                                    datafiles=[d1, d2]), project)
+
+        self.assertEqual(datatablegroup.schema_signature, schema_signature(columns))
+        a, b = datatablegroup.files.order_by('archived_file')
+        self.assertIsNone(a.column_order)
+        self.assertEqual(b.column_order, [1, 0])
+        # column statistics are stored in the order of the group's columns
+        self.assertEqual(b.column_statistics, statistics[::-1])
+        self.assertEqual(list(datatablegroup.columns.values_list('empty_count', flat=True)), [1, 1])
 
     @mock.patch('miracle.core.ingest.loader.login')
     @mock.patch('miracle.core.ingest.loader.DeployrAPI.upload_script')
@@ -70,5 +116,60 @@ class MetadataGroupLoadersTest(BaseMiracleTest):
         metadata_analysis = MetadataAnalysis(name="init",
                                              path="src/init.R",
                                              parameters=self.default_analysisscript_params)
-        with utils.Chdir(os.path.join(self.TEST_PROJECT_DIRECTORY, "test")):
-            load_deployr([metadata_analysis], project)
+        load_deployr([metadata_analysis], project)
+        # nothing is sent to deployr until the outbox is synced
+        self.assertFalse(upload_script.called)
+        self.assertEqual(pending_deployr_operations(project).count(), 2)
+
+        # operations claimed by a concurrent sync are left to it until its claim expires
+        stale = list(EngineSyncOperation.objects.all())
+        for operation in EngineSyncOperation.objects.all():
+            self.assertTrue(operation.claim())
+        self.assertFalse(stale[0].claim())
+        self.assertEqual(sync_deployr(project), 0)
+        self.assertEqual(pending_deployr_operations(project).count(), 2)
+        EngineSyncOperation.objects.update(next_attempt=timezone.now())
+
+        cwd.return_value = mock.Mock(status_code=503)
+        self.assertEqual(sync_deployr(project), 2)
+        self.assertFalse(upload_script.called)
+        operation = EngineSyncOperation.objects.get(operation=EngineSyncOperation.Operation.create_working_directory)
+        self.assertEqual(operation.attempts, 1)
+        # not due for a retry yet
+        self.assertEqual(sync_deployr(project), 0)
+
+        # a failed login is retried later like any other failure
+        cwd.return_value = post_result_mock
+        login.side_effect = DeployrUnexpectedStatusCode(mock.Mock(status_code=502))
+        EngineSyncOperation.objects.update(next_attempt=timezone.now())
+        self.assertEqual(sync_deployr(project), 2)
+        self.assertEqual(sorted(EngineSyncOperation.objects.values_list('attempts', flat=True)), [1, 2])
+        login.side_effect = None
+
+        # the upload of a script that is no longer in the project is dropped without failing the others
+        load_deployr([MetadataAnalysis(name="retired", path="src/retired.R", parameters=[])], project,
+                     create_working_directory=False)
+        EngineSyncOperation.objects.update(next_attempt=timezone.now())
+        with self.settings(PROJECT_DIRECTORY=self.TEST_PROJECT_DIRECTORY):
+            self.assertEqual(sync_deployr(project), 3)
+        self.assertEqual(upload_script.call_count, 1)
+        self.assertEqual(upload_script.call_args[0][0], os.path.join(self.TEST_PROJECT_DIRECTORY, "test", "src/init.R"))
+        self.assertFalse(pending_deployr_operations(project).exists())
+        self.assertFalse(EngineSyncOperation.objects.filter(path="src/retired.R").exists())
+
+    @mock.patch('miracle.core.deployr.time.sleep')
+    @mock.patch('miracle.core.ingest.loader.DeployrAPI.upload_script')
+    def test_upload_scripts_retries(self, upload_script, sleep):
+        unavailable = mock.Mock(status_code=503)
+        ok = mock.Mock(status_code=200)
+        upload_script.side_effect = [unavailable, requests.exceptions.Timeout(), ok]
+        with self.settings(DEPLOYR_UPLOAD_RETRIES=2, DEPLOYR_RETRY_BACKOFF=1):
+            uploads = DeployrAPI.upload_scripts(["src/a.R"], "test", mock.Mock())
+        self.assertEqual(uploads[0].response, ok)
+        self.assertEqual(uploads[0].attempts, 3)
+        self.assertEqual([args[0][0] for args in sleep.call_args_list], [1, 2])
+
+        upload_script.side_effect = None
+        upload_script.return_value = ok
+        uploads = DeployrAPI.upload_scripts(["src/a.R", "src/b.R", "src/c.R"], "test", mock.Mock(), concurrency=2)
+        self.assertEqual([upload.path for upload in uploads], ["src/a.R", "src/b.R", "src/c.R"])
@@ -1,8 +1,9 @@
 from django.core.exceptions import ValidationError
+import mock
 import string
 
 from .common import BaseMiracleTest, logger
-from ..models import (DataColumn, DatasetConnectionMixin, Group, Project)
+from ..models import (DataColumn, DatasetConnectionMixin, DataTableGroup, Group, Project)
 
 """
 Miracle core metadata app model tests
@@ -30,6 +31,19 @@ class MetadataTest(BaseMiracleTest):
         dataset = project.data_table_groups.create(name='Test Miracle Dataset', creator=self.default_user)
         self.assertTrue(dataset.slug)
 
+    @mock.patch('miracle.core.signals.transaction.on_commit')
+    @mock.patch.object(DataTableGroup, 'drop_table', autospec=True)
+    def test_datatablegroup_table(self, drop_table, on_commit):
+        dataset = self.create_data_table_group(name='Test Miracle Dataset')
+        table_name = dataset.table_name
+        dataset.name = 'Renamed Dataset'
+        dataset.save()
+        self.assertEqual(dataset.table_name, table_name)
+        dataset.delete()
+        # the table dropped once the deletion commits is the one the group had before it lost its pk
+        on_commit.call_args[0][0]()
+        drop_table.assert_called_once_with(dataset, table_name=table_name)
+
 
 class ProjectGroupMembershipTest(BaseMiracleTest):
 
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from ..ingest import rasters
+from .common import BaseMiracleTest
+
+
+class RasterTest(BaseMiracleTest):
+
+    def setUp(self, **kwargs):
+        super(RasterTest, self).setUp(**kwargs)
+        self.folder = tempfile.mkdtemp()
+        self.raster_path = os.path.join(self.folder, "sample.asc")
+        shutil.copy(self.get_test_data("sample.asc"), self.raster_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_band_statistics(self):
+        statistics = rasters.raster_statistics(self.raster_path)
+        self.assertEqual(len(statistics), 1)
+        band = statistics[0]
+        self.assertEqual((band["min"], band["max"], band["nodata"]), (1, 100, -9999))
+        self.assertAlmostEqual(band["mean"], 28.35)
+        # nodata cells are left out of the histogram
+        self.assertEqual(len(band["histogram"]["counts"]), rasters.HISTOGRAM_BINS)
+        self.assertEqual(sum(band["histogram"]["counts"]), 20)
+        self.assertEqual(band["histogram"]["counts"][-1], 1)
+        # too small to need overviews
+        self.assertEqual(band["overviews"], [])
+
+    def test_overviews(self):
+        self.assertEqual(rasters.overview_factors(4096, 1000), [2, 4, 8, 16])
+        self.assertEqual(rasters.overview_factors(200, 100), [])
+        with mock.patch.object(rasters, 'OVERVIEW_MIN_SIZE', 2):
+            statistics = rasters.raster_statistics(self.raster_path)
+        self.assertEqual(statistics[0]["overviews"], [2])
+        self.assertTrue(os.path.exists(self.raster_path + ".ovr"))
+        self.assertFalse(rasters.needs_processing(statistics, self.raster_path))
+        # overviews lost when an update replaced the project folder are built again
+        os.remove(self.raster_path + ".ovr")
+        self.assertTrue(rasters.needs_processing(statistics, self.raster_path))
+        self.assertTrue(rasters.needs_processing(None, self.raster_path))
@@ -1,16 +1,28 @@
 from os import path
+import glob
 import shutil
 import os
 import mock
+import random
 import requests
+import tempfile
+from datetime import timedelta
+
+from celery.exceptions import Retry
 
 from django.core.files import File
 from django.conf import settings
 from django.test.utils import override_settings
+from django.utils import timezone
 
 from .common import BaseMiracleTest
-from ..models import DataTableGroup, DataColumn, DataFile, Project
-from miracle.core.tasks import run_metadata_pipeline
+from ..ingest import checkpoint, pipeline, IngestInProgress
+from .. import blobstore, jobmonitor
+from ..deployr import DeployrJobTimeout
+from ..models import (AnalysisOutput, AnalysisParameter, AnalysisSweep, AnalysisSweepPoint, Blob, DataTableGroup,
+                      DataColumn, DataFile, Project, sweep_size)
+from miracle.core.tasks import (advance_sweep, check_analysis_job, run_metadata_pipeline, run_metadata_update,
+                                start_analysis_run, start_analysis_sweep, start_metadata_pipeline)
 
 
 class PipelineTaskTests(BaseMiracleTest):
@@ -26,6 +38,13 @@ class PipelineTaskTests(BaseMiracleTest):
         token = project.name
         src = project.archive_path
         os.unlink(src)
+        # on_commit callbacks never run in tests, remove what they would have
+        for archive in project.previous_archives():
+            os.unlink(archive)
+        for retired in glob.glob(path.join(settings.PROJECT_DIRECTORY, '.retired-*')) + \
+                glob.glob(path.join(settings.PACKRAT_DIRECTORY, '.retired-*')):
+            shutil.rmtree(retired)
+        Blob.objects.release_project_files(project)
         project_folder = path.join(settings.PROJECT_DIRECTORY, token)
         packrat_folder = path.join(settings.PACKRAT_DIRECTORY, token)
         if path.exists(project_folder):
@@ -60,5 +79,315 @@ class PipelineTaskTests(BaseMiracleTest):
             self.assertEqual(len(DataTableGroup.objects.filter(name="data")), 1)
             self.assertEqual(len(DataFile.objects.all()), 1)
             self.assertEqual(len(DataColumn.objects.all()), 2)
+            # rows are loaded into the datasets database
+            self.assertItemsEqual(DataColumn.objects.get(name="a").all_values(), [(1,), (2,), (4,)])
+            self.assertItemsEqual(DataColumn.objects.get(name="b").all_values(distinct=True), [(2,), (3,)])
         finally:
             self.cleanup(project)
+
+    @mock.patch('miracle.core.ingest.loader.login')
+    @mock.patch('miracle.core.ingest.loader.DeployrAPI.upload_script')
+    @mock.patch('miracle.core.ingest.loader.DeployrAPI.create_working_directory')
+    @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
+                       CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory')
+    def test_metadata_pipeline_update(self, cwd, upload_script, login):
+        post_result_mock = mock.Mock()
+        post_result_mock.status_code = 200
+        cwd.return_value = post_result_mock
+        upload_script.return_value = post_result_mock
+        login.return_value = mock.MagicMock(spec=requests.Session)
+
+        token = "test"
+        project = self.create_project(name=token)
+        src = path.join(self.TEST_PROJECT_DIRECTORY, "skeleton")
+        project.archive(File(open(self.make_archive(src), 'r')))
+
+        updated_src = path.join(tempfile.mkdtemp(), "skeleton")
+        try:
+            run_metadata_pipeline.delay(project, project.archive_path)
+            column_ids = list(DataColumn.objects.values_list('id', flat=True))
+
+            # edit the analysis script and add a second data file with the same schema
+            shutil.copytree(src, updated_src)
+            project_src = path.join(updated_src, "test", "test")
+            with open(path.join(project_src, "src", "init.R"), "a") as f:
+                f.write("# edited\n")
+            shutil.copy(path.join(project_src, "data", "data.csv"), path.join(project_src, "data", "data2.csv"))
+            project.archive(File(open(self.make_archive(updated_src), 'r')))
+            init_script = path.join(project.project_path, "src", "init.R")
+            with open(init_script) as f:
+                init_source = f.read()
+
+            # an update rolled back after its files were swapped in puts the previous files back
+            def fail_on_retire(func, using=None):
+                if getattr(func, '__name__', None) == 'retire_previous_archives':
+                    raise IOError
+            with mock.patch('django.db.transaction.on_commit', side_effect=fail_on_retire):
+                self.assertRaises(IOError, pipeline.update, project, project.archive_path, False)
+            with open(init_script) as f:
+                self.assertEqual(f.read(), init_source)
+            self.assertEqual(project.manifest.count(), 3)
+            self.assertTrue(all(path.exists(blobstore.blob_path(digest))
+                                for digest in project.manifest.values_list('blob_id', flat=True)))
+
+            run_metadata_update.delay(project, project.archive_path)
+            self.assertEqual(upload_script.call_count, 2)
+            self.assertEqual(DataFile.objects.count(), 2)
+            self.assertEqual(DataTableGroup.objects.count(), 1)
+            self.assertItemsEqual(DataColumn.objects.values_list('id', flat=True), column_ids)
+            self.assertEqual(project.manifest.count(), 4)
+            # the previous archive is only removed once the update commits
+            self.assertEqual(len(project.previous_archives()), 1)
+        finally:
+            self.cleanup(project)
+            shutil.rmtree(path.dirname(updated_src))
+
+    @mock.patch('miracle.core.ingest.loader.login')
+    @mock.patch('miracle.core.ingest.loader.DeployrAPI.upload_script')
+    @mock.patch('miracle.core.ingest.loader.DeployrAPI.create_working_directory')
+    def test_metadata_pipeline_resume(self, cwd, upload_script, login):
+        post_result_mock = mock.Mock()
+        post_result_mock.status_code = 200
+        cwd.return_value = post_result_mock
+        upload_script.return_value = post_result_mock
+        login.return_value = mock.MagicMock(spec=requests.Session)
+
+        token = "test"
+        project = self.create_project(name=token)
+        src = path.join(self.TEST_PROJECT_DIRECTORY, "skeleton")
+        project.archive(File(open(self.make_archive(src), 'r')))
+
+        checkpoint_directory = tempfile.mkdtemp()
+        try:
+            with override_settings(CHECKPOINT_DIRECTORY=checkpoint_directory):
+                with mock.patch.dict(pipeline.STAGE_FUNCTIONS, load_project=mock.Mock(side_effect=IOError)):
+                    self.assertRaises(IOError, pipeline.run, project, project.archive_path, False)
+                self.assertTrue(pipeline.is_incomplete(project))
+                self.assertEqual(pipeline.remaining_stages(project), ('load_project', 'load_datasets'))
+
+                # an ingest between stages is running and is neither discarded nor resumed
+                checkpoint.set_state(project, checkpoint.RUNNING)
+                self.assertTrue(pipeline.is_running(project))
+                self.assertRaises(IngestInProgress, start_metadata_pipeline, project, project.archive_path)
+                self.assertTrue(checkpoint.exists(project, 'group_metadata'))
+                with override_settings(METADATA_PIPELINE_STALE_SECONDS=-1):
+                    self.assertTrue(pipeline.is_incomplete(project))
+
+                pipeline.resume(project)
+                self.assertFalse(pipeline.is_incomplete(project))
+                self.assertEqual(DataFile.objects.count(), 1)
+                self.assertEqual(DataColumn.objects.count(), 2)
+        finally:
+            self.cleanup(project)
+            shutil.rmtree(checkpoint_directory)
+
+
+class AnalysisTaskTests(BaseMiracleTest):
+
+    @mock.patch('miracle.core.deployr.login')
+    @mock.patch('miracle.core.deployr.Job.retrieve_files')
+    @mock.patch('miracle.core.deployr.Job.check_status', autospec=True)
+    @override_settings(CELERY_ALWAYS_EAGER=True,
+                       BROKER_BACKEND='memory')
+    def test_analysis_job_is_checked_until_complete(self, check_status, retrieve_files, login):
+        login.return_value = mock.MagicMock(spec=requests.Session)
+        retrieve_files.return_value = []
+        response = mock.Mock(text='"done"')
+
+        def complete_on_third_check(job, job_id=None):
+            if check_status.call_count < 3:
+                return None
+            job.response = response
+            job.status = 'Completed'
+            job.completed = True
+            return response
+        check_status.side_effect = complete_on_third_check
+
+        output = AnalysisOutput.objects.create(analysis=self.default_analysis, name="run", creator=self.default_user)
+        check_analysis_job.apply((output.pk, "job-id"), {'user': self.default_user})
+        self.assertEqual(check_status.call_count, 3)
+        self.assertEqual(AnalysisOutput.objects.get(pk=output.pk).response, "done")
+        self.assertIsNotNone(AnalysisOutput.objects.get(pk=output.pk).date_completed)
+
+        # outputs that cannot be collected are marked as failed
+        retrieve_files.side_effect = IOError
+        failed = AnalysisOutput.objects.create(analysis=self.default_analysis, name="run", creator=self.default_user)
+        self.assertRaises(IOError, check_analysis_job.apply((failed.pk, "job-id"), {'user': self.default_user}).get)
+        failed = AnalysisOutput.objects.get(pk=failed.pk)
+        self.assertEqual((failed.job_status, failed.date_completed), ('Failed', None))
+        retrieve_files.side_effect = None
+
+        check_status.side_effect = None
+        check_status.return_value = None
+        with override_settings(DEPLOYR_JOB_MAX_CHECKS=2):
+            result = check_analysis_job.apply((output.pk, "job-id"), {'user': self.default_user})
+        self.assertRaises(DeployrJobTimeout, result.get)
+
+    @mock.patch('miracle.core.deployr.login')
+    @mock.patch('miracle.core.deployr.Job.get')
+    @mock.patch('miracle.core.deployr.Job.check_status', autospec=True)
+    @override_settings(DEPLOYR_HOST='localhost')
+    def test_output_files_are_retrieved_in_place(self, check_status, get, login):
+        login.return_value = mock.MagicMock(spec=requests.Session)
+        outputs_folder = path.join(self.default_project.project_path, 'outputs')
+        self.addCleanup(shutil.rmtree, self.default_project.project_path, True)
+
+        def completed(job, job_id=None):
+            job.results = [{'filename': name, 'url': 'http://localhost/' + name}
+                           for name in ('figure.png', 'table.csv', 'missing.txt')]
+            job.response = mock.Mock(text='"done"')
+            job.status = 'Completed'
+            job.completed = True
+            return job.response
+        check_status.side_effect = completed
+
+        def download(url, **kwargs):
+            name = url.rsplit('/', 1)[1]
+            return mock.Mock(ok=name != 'missing.txt', iter_content=lambda size: iter([name, '-contents']))
+        get.side_effect = download
+
+        output = AnalysisOutput.objects.create(analysis=self.default_analysis, name="run", creator=self.default_user)
+        check_analysis_job.apply((output.pk, "job-id"), {'user': self.default_user}).get()
+        output_files = dict((f.metadata['filename'], f) for f in output.files.all())
+        self.assertItemsEqual(output_files, ['figure.png', 'table.csv'])
+        for name, output_file in output_files.items():
+            self.assertEqual(path.dirname(output_file.path), outputs_folder)
+            with open(output_file.path) as f:
+                self.assertEqual(f.read(), name + '-contents')
+            self.assertEqual(output_file.metadata['transfer']['bytes'], len(name + '-contents'))
+        # the partial download of the missing file is removed
+        self.assertItemsEqual(os.listdir(outputs_folder), ['figure.png', 'table.csv'])
+
+        # files with the same name from another run are kept next to the first ones
+        rerun = AnalysisOutput.objects.create(analysis=self.default_analysis, name="rerun", creator=self.default_user)
+        check_analysis_job.apply((rerun.pk, "job-id"), {'user': self.default_user}).get()
+        self.assertEqual(len(os.listdir(outputs_folder)), 4)
+
+    @mock.patch('miracle.core.jobmonitor.check_analysis_job.apply_async')
+    @mock.patch('miracle.core.deployr.query_jobs')
+    def test_job_monitor_collects_finished_jobs(self, query_jobs, apply_async):
+        def job_response(status):
+            return {'deployr': {'response': {'job': {'job': 'id', 'status': status, 'project': 'PROJECT-1'}}}}
+        outputs = [AnalysisOutput.objects.create(analysis=self.default_analysis, name=name, creator=self.default_user,
+                                                 job_id=name, job_status='Submitted', collect_task_id=name + '-task',
+                                                 monitored=True)
+                   for name in ('completed', 'running', 'unreachable')]
+        query_jobs.return_value = {'completed': job_response('Completed'), 'running': job_response('Running')}
+
+        self.assertEqual(jobmonitor.poll(mock.Mock()), 1)
+        self.assertItemsEqual(query_jobs.call_args[0][0], ['completed', 'running', 'unreachable'])
+        apply_async.assert_called_once_with((outputs[0].pk, 'completed'), {'user': self.default_user},
+                                            task_id='completed-task')
+        self.assertEqual(list(AnalysisOutput.objects.order_by('pk').values_list('job_status', flat=True)),
+                         ['Completed', 'Running', 'Submitted'])
+        self.assertItemsEqual(AnalysisOutput.objects.in_flight().values_list('job_id', flat=True),
+                              ['running', 'unreachable'])
+
+    @mock.patch('miracle.core.tasks.check_analysis_job.backend')
+    def test_identical_runs_share_output(self, backend):
+        parameters = dict((parameter.name, parameter) for parameter in self.default_analysis.parameters.all())
+        run = start_analysis_run(self.default_analysis.pk, [{'id': parameters['sdp2'].pk, 'value': 0.5}],
+                                 self.default_user)
+        # the same values spelled differently, with defaults filled in, are the same run
+        shared = start_analysis_run(self.default_analysis.pk, [{'id': parameters['sdp2'].pk, 'value': ' 0.50'},
+                                                               {'id': parameters['sdb3'].pk, 'value': '30'}],
+                                    self.default_user)
+        self.assertEqual(shared.id, run.id)
+        other = start_analysis_run(self.default_analysis.pk, [{'id': parameters['sdp2'].pk, 'value': 0.4}],
+                                   self.default_user)
+        self.assertNotEqual(other.id, run.id)
+        self.assertEqual(AnalysisOutput.objects.count(), 2)
+
+        output = AnalysisOutput.objects.get(collect_task_id=run.id)
+        output.job_status = 'Completed'
+        output.save()
+        # still collecting its files
+        collecting = start_analysis_run(self.default_analysis.pk, [{'id': parameters['sdp2'].pk, 'value': 0.5}],
+                                        self.default_user)
+        self.assertEqual(collecting.id, run.id)
+        self.assertFalse(backend.mark_as_done.called)
+        output.date_completed = timezone.now()
+        output.save()
+        cached = start_analysis_run(self.default_analysis.pk, [{'id': parameters['sdp2'].pk, 'value': 0.5}],
+                                    self.default_user)
+        backend.mark_as_done.assert_called_once_with(cached.id, output)
+        self.assertEqual(AnalysisOutput.objects.count(), 2)
+
+    def test_sweep_expansion(self):
+        values = [(1, ['a', 'b']), (2, [10, 20, 30])]
+        points = AnalysisSweep.expand(values)
+        self.assertEqual(len(points), 6)
+        self.assertEqual(points[0], [(1, 'a'), (2, 10)])
+        self.assertEqual(points[4], [(1, 'b'), (2, 20)])
+        sampled = AnalysisSweep.expand(values, samples=3, rng=random.Random(1))
+        self.assertEqual(len(sampled), 3)
+        self.assertTrue(all(point in points for point in sampled))
+        self.assertEqual(sampled, AnalysisSweep.expand(values, samples=3, rng=random.Random(1)))
+
+        # ranges are never materialized
+        huge = AnalysisParameter(name="n", value_range=[0, 10 ** 12, 1]).sweep_values()
+        self.assertEqual(sweep_size(huge), 10 ** 12 + 1)
+        self.assertEqual(huge[10 ** 12], 10 ** 12)
+        self.assertEqual(len(AnalysisSweep.expand([(1, huge), (2, [10, 20])], samples=5, rng=random.Random(1))), 5)
+
+    @mock.patch('miracle.core.tasks.request_analysis_run')
+    @mock.patch('miracle.core.tasks.advance_sweep.delay')
+    @override_settings(ANALYSIS_SWEEP_MAX_POINTS=10)
+    def test_sweep_runs_within_concurrency(self, delay, request_analysis_run):
+        parameters = dict((parameter.name, parameter) for parameter in self.default_analysis.parameters.all())
+        values = dict((parameter.pk, [parameter.default_value]) for parameter in parameters.values())
+        values[parameters['sdp2'].pk] = [0.1, 0.2, 0.3]
+        self.assertRaises(ValueError, start_analysis_sweep, self.default_analysis.pk, self.default_user,
+                          values={-1: [1]})
+        values[parameters['sdb3'].pk] = range(4)
+        self.assertRaises(ValueError, start_analysis_sweep, self.default_analysis.pk, self.default_user,
+                          values=values)
+        AnalysisParameter.objects.filter(pk=parameters['sdb3'].pk).update(value_range=[0, 10 ** 9, 1])
+        self.assertRaises(ValueError, start_analysis_sweep, self.default_analysis.pk, self.default_user)
+        values[parameters['sdb3'].pk] = [30]
+        sweep = start_analysis_sweep(self.default_analysis.pk, self.default_user, values=values, concurrency=2)
+        self.assertEqual(sweep.points.count(), 3)
+
+        def start_run(analysis_id, run_parameters, user):
+            output = AnalysisOutput.objects.create(analysis=self.default_analysis, name="run",
+                                                   creator=self.default_user, job_status='Submitted')
+            return output, 'task-{}'.format(output.pk)
+        request_analysis_run.side_effect = start_run
+
+        with mock.patch.object(advance_sweep, 'retry', return_value=Retry()):
+            self.assertRaises(Retry, advance_sweep, sweep.pk)
+            self.assertEqual(request_analysis_run.call_count, 2)
+            AnalysisOutput.objects.filter(sweep_points__index=0).update(job_status='Completed',
+                                                                       date_completed=timezone.now())
+            self.assertRaises(Retry, advance_sweep, sweep.pk)
+            self.assertEqual(request_analysis_run.call_count, 3)
+        AnalysisOutput.objects.update(job_status='Completed', date_completed=timezone.now())
+        AnalysisOutput.objects.filter(sweep_points__index=2).update(job_status='Failed', date_completed=None)
+        AnalysisOutput.objects.filter(sweep_points__index=1).update(date_completed=None, job_status='Running')
+        with mock.patch.object(advance_sweep, 'retry', return_value=Retry()):
+            self.assertRaises(Retry, advance_sweep, sweep.pk)
+        # runs that never finish are eventually counted as failed
+        with override_settings(ANALYSIS_SWEEP_RUN_TIMEOUT=-1):
+            self.assertEqual(advance_sweep(sweep.pk), dict(total=3, pending=0, running=0, completed=1, failed=2))
+        sdp2_values = [dict((p['id'], p['value']) for p in call[0][1])[parameters['sdp2'].pk]
+                       for call in request_analysis_run.call_args_list]
+        self.assertEqual(sdp2_values, [0.1, 0.2, 0.3])
+        self.assertIsNotNone(AnalysisSweep.objects.get(pk=sweep.pk).date_completed)
+
+    @mock.patch('miracle.core.tasks.request_analysis_run')
+    @mock.patch('miracle.core.tasks.advance_sweep.delay')
+    def test_sweep_points_that_cannot_start_fail(self, delay, request_analysis_run):
+        parameters = dict((parameter.name, parameter.pk) for parameter in self.default_analysis.parameters.all())
+        sweep = start_analysis_sweep(self.default_analysis.pk, self.default_user,
+                                     values={parameters['sdp2']: [0.1, 0.2], parameters['sdb3']: [30]}, concurrency=2)
+        # the second point shares a run of the same parameters started long before the sweep
+        shared = AnalysisOutput.objects.create(analysis=self.default_analysis, name="run", creator=self.default_user,
+                                               job_status='Running')
+        AnalysisOutput.objects.filter(pk=shared.pk).update(date_created=timezone.now() - timedelta(days=1))
+        request_analysis_run.side_effect = [ValueError("deployr is down"), (shared, 'task-shared')]
+        with mock.patch.object(advance_sweep, 'retry', return_value=Retry()), \
+                override_settings(ANALYSIS_SWEEP_RUN_TIMEOUT=60 * 60):
+            self.assertRaises(Retry, advance_sweep, sweep.pk)
+            self.assertEqual(sweep.progress(), dict(total=2, pending=0, running=1, completed=0, failed=1))
+        self.assertEqual(sweep.points.get(index=0).collect_task_id, AnalysisSweepPoint.NOT_STARTED)
@@ -1,11 +1,16 @@
 import shutil
+import tempfile
+import zipfile
 
 import mock
 import os
 from os import path
 from django.conf import settings
+from django.test.utils import override_settings
 
-from ...core.ingest.unarchiver import extract, _validate_project_structure, PackratException
+from ...core.ingest.unarchiver import (extract, validate_archive, _unpack, _validate_project_structure,
+                                       PackratException)
+from ..models import Blob, ProjectManifestEntry
 from .common import BaseMiracleTest
 
 
@@ -13,9 +18,8 @@ class ArchiveExtractorTest(BaseMiracleTest):
     PROJECT_TEST_DIR = "miracle/core/tests/projects"
 
     @staticmethod
-    def make_archive(src):
-        shutil.make_archive(src, "zip", root_dir=src)
-        return src + ".zip"
+    def make_archive(src, archive_format="zip"):
+        return shutil.make_archive(src, archive_format, root_dir=src)
 
     @staticmethod
     def cleanup(src, token):
@@ -40,6 +44,90 @@ class ArchiveExtractorTest(BaseMiracleTest):
         finally:
             self.cleanup(archive, token)
 
+    def test_tar_archive_extractor(self):
+        token = "test"
+        project = self.create_project(name=token)
+        src = path.join(self.PROJECT_TEST_DIR, "skeleton")
+        archive = self.make_archive(src, "gztar")
+        try:
+            project_folder = extract(project, archive)
+            self.assertItemsEqual(project_folder.paths,
+                                  ["README.md", "src/init.R", "data/data.csv"])
+            self.assertFalse([name for name in os.listdir(settings.PROJECT_DIRECTORY) if name.startswith('.staging-')])
+        finally:
+            self.cleanup(archive, token)
+
+    def test_extracted_files_are_linked_into_blob_store(self):
+        token = "test"
+        project = self.create_project(name=token)
+        src = path.join(self.PROJECT_TEST_DIR, "skeleton")
+        archive = self.make_archive(src)
+        try:
+            extract(project, archive)
+            entries = project.manifest.all()
+            self.assertItemsEqual([entry.path for entry in entries], ["README.md", "src/init.R", "data/data.csv"])
+            for entry in entries:
+                self.assertEqual(entry.blob.reference_count, 1)
+                project_file = path.join(project.project_path, entry.path)
+                self.assertEqual(os.stat(project_file).st_ino, os.stat(entry.blob.path).st_ino)
+            blob_paths = [entry.blob.path for entry in entries]
+            Blob.objects.release_project_files(project)
+            self.assertFalse(Blob.objects.filter(reference_count__gt=0).exists())
+            self.assertFalse([blob_path for blob_path in blob_paths if path.exists(blob_path)])
+        finally:
+            self.cleanup(archive, token)
+
+    def test_blobs_added_concurrently_are_shared(self):
+        project = self.create_project(name="test")
+        Blob.objects.create(digest="a" * 64, size=1, reference_count=1)
+        entries = [ProjectManifestEntry(project=project, path="a.csv", blob_id="a" * 64),
+                   ProjectManifestEntry(project=project, path="b.csv", blob_id="b" * 64)]
+        # the blob is inserted by another ingest after this one looked for the existing blobs
+        with mock.patch.object(Blob.objects, 'select_for_update', return_value=Blob.objects.none()):
+            Blob.objects._add_references(entries, {"a" * 64: 1, "b" * 64: 2})
+        self.assertEqual(dict(Blob.objects.values_list('digest', 'reference_count')), {"a" * 64: 2, "b" * 64: 1})
+
+    def test_unpack_rejects_members_outside_root(self):
+        folder = tempfile.mkdtemp()
+        archive = path.join(folder, "evil.zip")
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("../evil.txt", "evil")
+        try:
+            with self.assertRaises(PackratException):
+                _unpack(archive, path.join(folder, "out"))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_validate_archive(self):
+        src = path.join(self.PROJECT_TEST_DIR, "skeleton")
+        for archive_format in ("zip", "gztar"):
+            archive = self.make_archive(src, archive_format)
+            try:
+                validate_archive(archive, "test")
+                with open(archive, 'rb') as f:
+                    validate_archive(f, "test")
+                with self.assertRaises(PackratException):
+                    validate_archive(archive, "other")
+                with override_settings(ARCHIVE_MAX_MEMBERS=2), self.assertRaises(PackratException):
+                    validate_archive(archive, "test")
+            finally:
+                os.unlink(archive)
+
+    def test_validate_archive_rejects_zip_bombs(self):
+        folder = tempfile.mkdtemp()
+        archive = path.join(folder, "bomb.zip")
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+            for name in ("test/packrat/", "test/test/src/", "test/test/data/"):
+                zf.writestr(name, "")
+            zf.writestr("test/test/data/zeros.csv", "0" * 10 * 1024 * 1024)
+        try:
+            with self.assertRaises(PackratException):
+                validate_archive(archive, "test")
+            with override_settings(ARCHIVE_MAX_COMPRESSION_RATIO=10000):
+                validate_archive(archive, "test")
+        finally:
+            shutil.rmtree(folder)
+
     @mock.patch('miracle.core.ingest.unarchiver.path')
     def test_validate_project_structure(self, mock_path):
         mock_path.isdir.return_value = True
@@ -22,6 +22,8 @@ urlpatterns = [
     # FIXME: consider merging these one-off /analysis endpoints into a single endpoint with an action parameter
     url(r'^analysis/run/$', views.RunAnalysisView.as_view(), name='run-analysis'),
     url(r'^analysis/run/status/$', views.CheckAnalysisRunStatusView.as_view(), name='check-analysis-run-status'),
+    url(r'^analysis/sweep/$', views.RunAnalysisSweepView.as_view(), name='run-analysis-sweep'),
+    url(r'^analysis/sweep/(?P<pk>\d+)/$', views.AnalysisSweepStatusView.as_view(), name='analysis-sweep-status'),
     url(r'^analysis/output/share/$', views.ShareOutputView.as_view(), name='share-output'),
     url(r'^user/(?P<username>[\w.@+-]+)/activity/$', views.UserActivityView.as_view(), name='user-activity'),
     url(r'^account/profile/$', views.UserProfileView.as_view(), name='profile'),
@@ -2,7 +2,7 @@ from celery.result import AsyncResult
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.core.urlresolvers import reverse_lazy
+from django.core.urlresolvers import reverse, reverse_lazy
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.utils.translation import ugettext_lazy as _
@@ -19,13 +19,16 @@ from revproxy.views import ProxyView
 
 
 from .models import (Project, ActivityLog, MiracleUser, DataTableGroup, DataAnalysisScript, AnalysisOutput, DataColumn,
-                     AnalysisOutputFile)
+                     AnalysisOutputFile, AnalysisSweep, AnalysisSweepPoint)
 from .serializers import (ProjectSerializer, DataFileSerializer, UserSerializer, DataTableGroupSerializer,
                           DataAnalysisScriptSerializer, AnalysisOutputSerializer, DataColumnSerializer,
                           ActivityLogSerializer,
                           )
 from .permissions import (CanViewReadOnlyOrEditProject, CanViewReadOnlyOrEditProjectResource, )
-from .tasks import run_analysis_task, run_metadata_pipeline
+from .tasks import start_analysis_run, start_analysis_sweep, start_metadata_pipeline
+from .ingest import IngestInProgress, PackratException
+from .ingest.pipeline import is_running
+from .ingest.unarchiver import validate_archive
 
 import logging
 from os import path
@@ -158,11 +161,58 @@ class RunAnalysisView(APIView):
         pk = int(query_params.get('pk'))
         parameters = loads(query_params.get('parameters'))
         logger.debug("running analysis id %s with parameters %s", pk, parameters)
-        async_result = run_analysis_task.delay(pk, parameters, user=request.user)
+        async_result = start_analysis_run(pk, parameters, user=request.user)
         logger.debug("running analysis task with id %s", async_result.id)
         return Response({'task_id': async_result.id}, status=202)
 
 
+class RunAnalysisSweepView(APIView):
+    renderer_classes = (renderers.JSONRenderer,)
+    # FIXME: revisit permissions
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request):
+        """
+        Starts a parameter sweep of an analysis and returns a 202 with the URL to poll for the progress of the sweep.
+
+        Expects the analysis pk, optionally the values to sweep each parameter through (parameter id to list of values,
+        other parameters go through their value_list or value_range), the number of points to sample and the number
+        of runs to keep in progress at once.
+        """
+        data = request.data
+        try:
+            analysis = get_object_or_404(DataAnalysisScript, pk=int(data.get('pk')))
+            values = dict((int(parameter_id), parameter_values)
+                          for parameter_id, parameter_values in (data.get('values') or {}).items())
+            options = dict((name, int(data[name])) for name in ('samples', 'concurrency', 'seed')
+                           if data.get(name) is not None)
+            sweep = start_analysis_sweep(analysis.pk, request.user, values=values, **options)
+        except (TypeError, ValueError) as e:
+            return Response({'error_message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        logger.debug("started sweep %s of analysis %s", sweep.pk, analysis.pk)
+        return Response({'sweep_id': sweep.pk,
+                         'status_url': reverse('core:analysis-sweep-status', args=[sweep.pk]),
+                         'progress': sweep.progress()},
+                        status=status.HTTP_202_ACCEPTED)
+
+
+class AnalysisSweepStatusView(APIView):
+    renderer_classes = (renderers.JSONRenderer,)
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, pk):
+        sweep = get_object_or_404(AnalysisSweep, pk=pk, creator=request.user)
+        # points whose run could not be started have no task to poll
+        points = [{'index': index, 'values': values, 'output': output_id,
+                   'task_id': task_id if task_id and task_id != AnalysisSweepPoint.NOT_STARTED else None}
+                  for index, values, output_id, task_id
+                  in sweep.points.values_list('index', 'values', 'output_id', 'collect_task_id')]
+        return Response({'sweep_id': sweep.pk,
+                         'ready': sweep.date_completed is not None,
+                         'progress': sweep.progress(),
+                         'points': points})
+
+
 class OutputViewSet(viewsets.ModelViewSet):
     serializer_class = AnalysisOutputSerializer
     renderer_classes = (renderers.JSONRenderer,)
@@ -339,9 +389,21 @@ class FileUploadView(APIView):
         file_obj = request.FILES['file']
         project_id = request.data.get('id')
         project = get_object_or_404(Project, pk=project_id)
+        try:
+            # reject malformed archives from their index before storing or decompressing anything
+            validate_archive(file_obj, project.slug)
+        except PackratException as e:
+            logger.debug("rejecting archive %s for project %s: %s", file_obj.name, project, e)
+            return Response(data={'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if is_running(project):
+            return Response(data={'message': _('This project is still being ingested, try again once it completes')},
+                            status=status.HTTP_409_CONFLICT)
         project.archive(file_obj)
         # should analyze payload
-        task = run_metadata_pipeline.delay(project, project.archive_path)
+        try:
+            task = start_metadata_pipeline(project, project.archive_path)
+        except IngestInProgress as e:
+            return Response(data={'message': str(e)}, status=status.HTTP_409_CONFLICT)
         response = Response(data=task.id, status=status.HTTP_202_ACCEPTED)
         return response
 
@@ -13,6 +13,7 @@ from __future__ import print_function
 # Build projectpaths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 import sys
+from datetime import timedelta
 
 from django.core.exceptions import ImproperlyConfigured
 
@@ -262,6 +263,13 @@ ARCHIVE_URL = '/archives/'
 BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/1'
 CELERY_ACCEPT_CONTENT = ['json', 'pickle']
+# drain the engine sync outbox periodically, in case a worker died or a scheduled retry was lost
+CELERYBEAT_SCHEDULE = {
+    'sync-deployr': {
+        'task': 'miracle.core.tasks.sync_deployr',
+        'schedule': timedelta(minutes=5),
+    },
+}
 
 def make_project_paths(project_directory):
     os.makedirs(project_directory)
@@ -275,6 +283,80 @@ ARCHIVE_DIRECTORY = MEDIA_ROOT = safe_make_paths('/miracle/archives',
                                                  os.path.abspath('archives'), make_archive_path)
 PACKRAT_DIRECTORY = safe_make_paths('/miracle/packrat',
                                     os.path.abspath('packrat'), make_project_paths)
+CHECKPOINT_DIRECTORY = safe_make_paths('/miracle/checkpoints',
+                                       os.path.abspath('checkpoints'), make_project_paths)
+# Content addressed store for extracted project files. Project trees are built from hardlinks into this folder so it
+# must be on the same filesystem as PROJECT_DIRECTORY.
+BLOB_DIRECTORY = os.path.join(PROJECT_DIRECTORY, '.blobs')
+
+# Number of processes used to extract file metadata from an uploaded project archive. Set to 0 to use one process per
+# CPU on the worker. With 1 the files are analyzed in the worker itself, without the per-format timeouts of
+# ingest.analyzer.FORMAT_TIMEOUTS, which only apply with 2 or more processes.
+METADATA_EXTRACTION_PROCESSES = 1
+# An ingest whose current stage started this many seconds ago is assumed to have died with its worker, and is
+# discarded when a new archive is uploaded for the project
+METADATA_PIPELINE_STALE_SECONDS = 6 * 60 * 60
+
+# Seconds to wait for a connection to DeployR and for its response
+DEPLOYR_TIMEOUT = (10, 120)
+# Number of analysis scripts uploaded to DeployR at the same time
+DEPLOYR_UPLOAD_CONCURRENCY = 4
+# Retries for uploads that fail to connect, time out or get a 502, 503 or 504, waiting DEPLOYR_RETRY_BACKOFF seconds
+# before the first retry and doubling the wait for every further retry
+DEPLOYR_UPLOAD_RETRIES = 3
+DEPLOYR_RETRY_BACKOFF = 0.5
+# Number of analysis output files downloaded from DeployR at the same time, and the size of the blocks they are
+# streamed to disk in
+DEPLOYR_DOWNLOAD_CONCURRENCY = 4
+DEPLOYR_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Analysis jobs are first checked DEPLOYR_JOB_POLL_INITIAL seconds after they are submitted, then twice as long
+# after every check up to DEPLOYR_JOB_POLL_MAX seconds, and given up on after DEPLOYR_JOB_MAX_CHECKS checks
+DEPLOYR_JOB_POLL_INITIAL = 1
+DEPLOYR_JOB_POLL_MAX = 30
+DEPLOYR_JOB_MAX_CHECKS = 60
+# Track analysis jobs from the monitor_analysis_jobs process instead of a check_analysis_job task per job. The monitor
+# queries every in-flight job each DEPLOYR_JOB_MONITOR_INTERVAL seconds, DEPLOYR_JOB_MONITOR_CONCURRENCY at a time,
+# and gives up on jobs that have not finished DEPLOYR_JOB_MONITOR_TIMEOUT seconds after they were submitted
+DEPLOYR_JOB_MONITOR = False
+DEPLOYR_JOB_MONITOR_INTERVAL = 2
+DEPLOYR_JOB_MONITOR_CONCURRENCY = 8
+DEPLOYR_JOB_MONITOR_TIMEOUT = 60 * 60
+# Identical analysis runs requested within this many seconds of a run that has not finished yet share that run
+ANALYSIS_RUN_COALESCE_SECONDS = 60 * 60
+# Parameter sweeps run at most ANALYSIS_SWEEP_MAX_POINTS points, ANALYSIS_SWEEP_CONCURRENCY at a time unless
+# requested otherwise, and start new runs as earlier ones finish every ANALYSIS_SWEEP_POLL_INTERVAL seconds
+ANALYSIS_SWEEP_MAX_POINTS = 1000
+ANALYSIS_SWEEP_CONCURRENCY = 4
+ANALYSIS_SWEEP_POLL_INTERVAL = 5
+# Runs of a sweep that have not finished this many seconds after they started are counted as failed so that the
+# sweep completes
+ANALYSIS_SWEEP_RUN_TIMEOUT = 6 * 60 * 60
+# Engine sync operations that keep failing are retried ENGINE_SYNC_RETRY_BACKOFF seconds later, doubling the wait
+# for every further attempt, until ENGINE_SYNC_MAX_ATTEMPTS attempts have failed
+ENGINE_SYNC_MAX_ATTEMPTS = 8
+ENGINE_SYNC_RETRY_BACKOFF = 30
+# Seconds an engine sync operation stays claimed by the sync attempting it, after which it is retried in case that
+# sync died
+ENGINE_SYNC_CLAIM_TIMEOUT = 10 * 60
+
+# Upper bound on the size of the pickled file metadata kept in the metadata cache, least recently used entries are
+# evicted beyond it
+METADATA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Column types of tabular data files are inferred from every row of files up to TYPE_INFERENCE_MAX_BYTES and from a
+# random sample of TYPE_INFERENCE_SAMPLE_ROWS rows of larger files
+TYPE_INFERENCE_MAX_BYTES = 256 * 1024 * 1024
+TYPE_INFERENCE_SAMPLE_ROWS = 100000
+
+# Number of rows sent to the datasets database per COPY statement when loading tabular data files
+DATASETS_COPY_BATCH_SIZE = 50000
+
+# Limits checked against the index of an uploaded zip or tar archive before any of it is decompressed
+ARCHIVE_MAX_MEMBERS = 100000
+ARCHIVE_MAX_UNCOMPRESSED_SIZE = 20 * 1024 ** 3
+# uncompressed / compressed size above which an archive (or one of its members) is rejected as a decompression bomb
+ARCHIVE_MAX_COMPRESSION_RATIO = 200
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.9/howto/static-files/
 